@@ -0,0 +1,405 @@
+"""
+xAI API 呼叫的限流層 (chat、vision、images.generate 都經過這裡)：
+- 每位使用者、每個模型各一個 token bucket (每分鐘請求數 + 突發量)
+- 全域同時呼叫數依 AIMD 自動調整：成功且延遲正常時慢慢加 1，遇到 429 或延遲過高時乘法遞減
+  (延遲指 xAI 的回應速度：串流看首個 token，一次回覆依輸出 token 數換算，不含生成長回答與推送 LINE 的時間)
+- 等待同時呼叫名額的請求依使用者輪流 (round-robin) 放行，重度使用者不會餓死其他人
+- 429 / 暫時性 5xx 依 Retry-After (沒有時用指數退避) 加上隨機抖動後重試
+"""
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import deque, OrderedDict
+from email.utils import parsedate_to_datetime
+
+from openai import RateLimitError, APIStatusError
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS = (500, 502, 503, 504)
+MAX_USER_BUCKETS = 10000  # 超過時淘汰最久沒用的使用者 bucket (已補滿的 bucket 淘汰不影響行為)
+REFERENCE_OUTPUT_TOKENS = 300  # 輸出超過這個 token 數的回覆，延遲依比例換算成這個長度的耗時再與 target_latency 比較
+
+
+class LocalRateLimitError(Exception):
+    """本地限流：預估要等超過 max_wait 秒，直接放棄 (不送出請求)"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """每秒補充 rate 個、最多存 burst 個"""
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def wait_time(self, now):
+        """還要等幾秒才有一個 token (0 表示現在就有)"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class AimdConcurrency:
+    """AIMD 同時呼叫數上限：成功 +1/limit (約每輪 +1)，壅塞時乘以 decrease_factor (cooldown 內最多降一次)"""
+
+    def __init__(self, initial=8, minimum=1, maximum=32, target_latency=20.0, decrease_factor=0.5, latency_factor=0.9, cooldown=2.0):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(self.maximum, max(self.minimum, initial)))
+        self.target_latency = target_latency
+        self.decrease_factor = decrease_factor  # 遇到 429
+        self.latency_factor = latency_factor    # 延遲超過 target_latency
+        self.cooldown = cooldown
+        self._last_decrease = 0.0
+
+    @property
+    def current(self):
+        return int(self.limit)
+
+    def on_success(self, latency, now):
+        if self.target_latency and latency > self.target_latency:
+            self._decrease(self.latency_factor, now)
+        else:
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def on_throttled(self, now):
+        self._decrease(self.decrease_factor, now)
+
+    def _decrease(self, factor, now):
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.limit = max(self.minimum, self.limit * factor)
+
+
+def retry_after_seconds(error):
+    """從例外的回應標頭取出 Retry-After (秒數或 HTTP 日期)；沒有時回傳 None"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+def congestion_latency(result, elapsed):
+    """
+    預設的壅塞訊號：一次回覆的耗時包含生成所有輸出 token 的時間，長回答本來就慢，
+    依 usage.completion_tokens 換算成 REFERENCE_OUTPUT_TOKENS 長度的耗時；沒有 usage (例如圖片) 時直接用耗時。
+    """
+    tokens = getattr(getattr(result, "usage", None), "completion_tokens", None)
+    if isinstance(tokens, int) and tokens > REFERENCE_OUTPUT_TOKENS:
+        return elapsed * REFERENCE_OUTPUT_TOKENS / tokens
+    return elapsed
+
+
+def is_retryable(error):
+    if isinstance(error, RateLimitError):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code in RETRYABLE_STATUS
+
+
+class _LimiterCore:
+    """同步/非同步版本共用的狀態 (呼叫端負責加鎖)"""
+
+    def __init__(self, user_rpm, user_burst, model_rpm, default_model_rpm, concurrency, max_wait, max_retries, backoff_base, backoff_max):
+        self.user_rate = user_rpm / 60.0
+        self.user_burst = user_burst
+        self.model_rpm = dict(model_rpm)  # model -> 每分鐘請求數
+        self.default_model_rpm = default_model_rpm
+        self.concurrency = concurrency
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.user_buckets = OrderedDict()
+        self.model_buckets = {}
+        self.inflight = 0
+        self.waiters = {}     # user_id -> deque[ticket]
+        self.turns = deque()  # 有人在等的 user_id，輪流放行
+        self.counters = {"calls": 0, "throttled": 0, "retries": 0, "rejected": 0}
+
+    def user_wait(self, user_id, now):
+        """使用者 bucket：有 token 就取走並回傳 0，否則回傳要等的秒數"""
+        bucket = self.user_buckets.get(user_id)
+        if bucket is None:
+            bucket = self.user_buckets[user_id] = TokenBucket(self.user_rate, self.user_burst, now)
+            if len(self.user_buckets) > MAX_USER_BUCKETS:
+                self.user_buckets.popitem(last=False)
+        self.user_buckets.move_to_end(user_id)
+        wait = bucket.wait_time(now)
+        if wait == 0:
+            bucket.take()
+        return wait
+
+    def model_wait(self, model, now):
+        bucket = self.model_buckets.get(model)
+        if bucket is None:
+            rpm = self.model_rpm.get(model, self.default_model_rpm)
+            bucket = self.model_buckets[model] = TokenBucket(rpm / 60.0, max(1, rpm // 10), now)
+        wait = bucket.wait_time(now)
+        if wait == 0:
+            bucket.take()
+        return wait
+
+    def enqueue(self, user_id, ticket):
+        queue = self.waiters.get(user_id)
+        if queue is None:
+            queue = self.waiters[user_id] = deque()
+            self.turns.append(user_id)
+        queue.append(ticket)
+
+    def cancel(self, user_id, ticket):
+        queue = self.waiters.get(user_id)
+        if queue is not None and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del self.waiters[user_id]
+                self.turns.remove(user_id)
+
+    def grant_next(self):
+        """還有名額時依使用者輪流放行，回傳被放行的 ticket 清單"""
+        granted = []
+        while self.turns and self.inflight < self.concurrency.current:
+            user_id = self.turns.popleft()
+            queue = self.waiters[user_id]
+            granted.append(queue.popleft())
+            self.inflight += 1
+            if queue:
+                self.turns.append(user_id)  # 還有請求，排到最後等下一輪
+            else:
+                del self.waiters[user_id]
+        return granted
+
+    def release(self, latency, throttled, now):
+        self.inflight -= 1
+        if throttled:
+            self.concurrency.on_throttled(now)
+        elif latency is not None:
+            self.concurrency.on_success(latency, now)
+        return self.grant_next()
+
+    def backoff(self, error, attempt):
+        """下一次重試前要等的秒數 (Retry-After + 抖動，或 full-jitter 指數退避)"""
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self.backoff_base)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def stats(self):
+        return {
+            "inflight": self.inflight,
+            "limit": self.concurrency.current,
+            "waiting": sum(len(q) for q in self.waiters.values()),
+            **self.counters,
+        }
+
+
+class AiLimiter:
+    """
+    同步版本 (Flask/執行緒)。用法：limiter.call(user_id, model, lambda: ai_client.chat.completions.create(...))
+    串流呼叫時 fn 內應包含整個串流的讀取，才會在讀完之前佔住名額；此時 fn 的耗時包含生成與推送，
+    應以 latency_fn 回傳首個 token 的等待時間作為壅塞訊號。
+    """
+
+    def __init__(self, user_rpm=10, user_burst=5, model_rpm=None, default_model_rpm=60, max_concurrency=32, initial_concurrency=8,
+                 target_latency=20.0, max_wait=30.0, max_retries=2, backoff_base=1.0, backoff_max=20.0):
+        self._core = _LimiterCore(
+            user_rpm, user_burst, model_rpm or {}, default_model_rpm,
+            AimdConcurrency(initial=initial_concurrency, maximum=max_concurrency, target_latency=target_latency),
+            max_wait, max_retries, backoff_base, backoff_max,
+        )
+        self._lock = threading.Lock()
+
+    def call(self, user_id, model, fn, should_retry=None, latency_fn=congestion_latency):
+        """
+        依序等待：使用者 bucket → 同時呼叫名額 (公平排隊) → 模型 bucket，然後執行 fn()。
+        可重試的錯誤在 should_retry() 為 True (預設) 且還在 max_wait 內時重試。
+        latency_fn(result, elapsed) 回傳給 AIMD 的延遲秒數 (None 表示這次不調整)。
+        """
+        core = self._core
+        deadline = time.monotonic() + core.max_wait
+        attempt = 0
+        while True:
+            self._acquire(user_id, model, deadline)
+            start = time.monotonic(); throttled = False; latency = None
+            try:
+                result = fn()
+                latency = latency_fn(result, time.monotonic() - start)
+                return result
+            except Exception as e:
+                throttled = isinstance(e, RateLimitError)
+                if not is_retryable(e) or attempt >= core.max_retries or (should_retry is not None and not should_retry()):
+                    raise
+                delay = core.backoff(e, attempt)
+                if time.monotonic() + delay > deadline:
+                    raise
+                attempt += 1
+                with self._lock:
+                    core.counters["retries"] += 1
+                logger.warning(f"xAI ({model}) 回應 {type(e).__name__}，{delay:.1f} 秒後第 {attempt} 次重試。")
+            finally:
+                with self._lock:
+                    if throttled:
+                        core.counters["throttled"] += 1
+                    granted = core.release(latency, throttled, time.monotonic())
+                for ticket in granted:
+                    ticket.set()
+            time.sleep(delay)
+
+    def _acquire(self, user_id, model, deadline):
+        core = self._core
+        # 1. 使用者 bucket
+        while True:
+            with self._lock:
+                wait = core.user_wait(user_id, time.monotonic())
+            if wait == 0:
+                break
+            self._sleep_or_reject(wait, deadline, f"使用者 {user_id} 請求過於頻繁")
+        # 2. 同時呼叫名額 (依使用者輪流放行)
+        ticket = threading.Event()
+        with self._lock:
+            core.counters["calls"] += 1
+            core.enqueue(user_id, ticket)
+            for t in core.grant_next():
+                t.set()
+        if not ticket.wait(max(0.0, deadline - time.monotonic())):
+            with self._lock:
+                if not ticket.is_set():
+                    core.cancel(user_id, ticket)
+                    core.counters["rejected"] += 1
+                    raise LocalRateLimitError("等待 AI 呼叫名額逾時", retry_after=core.max_wait)
+        # 3. 模型 bucket (已佔住名額；等待通常很短)
+        try:
+            while True:
+                with self._lock:
+                    wait = core.model_wait(model, time.monotonic())
+                if wait == 0:
+                    return
+                self._sleep_or_reject(wait, deadline, f"模型 {model} 請求過於頻繁")
+        except LocalRateLimitError:
+            with self._lock:
+                granted = core.release(None, False, time.monotonic())
+            for t in granted:
+                t.set()
+            raise
+
+    def _sleep_or_reject(self, wait, deadline, message):
+        if time.monotonic() + wait > deadline:
+            with self._lock:
+                self._core.counters["rejected"] += 1
+            raise LocalRateLimitError(message, retry_after=wait)
+        time.sleep(wait)
+
+    def stats(self):
+        with self._lock:
+            return self._core.stats()
+
+
+class AsyncAiLimiter:
+    """AiLimiter 的 asyncio 版本：await limiter.call(user_id, model, lambda: client.chat.completions.create(...))"""
+
+    def __init__(self, user_rpm=10, user_burst=5, model_rpm=None, default_model_rpm=60, max_concurrency=64, initial_concurrency=16,
+                 target_latency=20.0, max_wait=30.0, max_retries=2, backoff_base=1.0, backoff_max=20.0):
+        self._core = _LimiterCore(
+            user_rpm, user_burst, model_rpm or {}, default_model_rpm,
+            AimdConcurrency(initial=initial_concurrency, maximum=max_concurrency, target_latency=target_latency),
+            max_wait, max_retries, backoff_base, backoff_max,
+        )
+
+    async def call(self, user_id, model, coro_fn, should_retry=None, latency_fn=congestion_latency):
+        core = self._core
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + core.max_wait
+        attempt = 0
+        while True:
+            await self._acquire(user_id, model, deadline)
+            start = loop.time(); throttled = False; latency = None
+            try:
+                result = await coro_fn()
+                latency = latency_fn(result, loop.time() - start)
+                return result
+            except Exception as e:
+                throttled = isinstance(e, RateLimitError)
+                if not is_retryable(e) or attempt >= core.max_retries or (should_retry is not None and not should_retry()):
+                    raise
+                delay = core.backoff(e, attempt)
+                if loop.time() + delay > deadline:
+                    raise
+                attempt += 1
+                core.counters["retries"] += 1
+                logger.warning(f"xAI ({model}) 回應 {type(e).__name__}，{delay:.1f} 秒後第 {attempt} 次重試。")
+            finally:
+                if throttled:
+                    core.counters["throttled"] += 1
+                self._wake(core.release(latency, throttled, time.monotonic()))
+            await asyncio.sleep(delay)
+
+    async def _acquire(self, user_id, model, deadline):
+        core = self._core
+        loop = asyncio.get_running_loop()
+        while (wait := core.user_wait(user_id, time.monotonic())) > 0:
+            await self._sleep_or_reject(wait, deadline, f"使用者 {user_id} 請求過於頻繁")
+        ticket = loop.create_future()
+        core.counters["calls"] += 1
+        core.enqueue(user_id, ticket)
+        self._wake(core.grant_next())
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket), max(0.0, deadline - loop.time()))
+        except asyncio.TimeoutError:
+            if not ticket.done():
+                core.cancel(user_id, ticket)
+                core.counters["rejected"] += 1
+                raise LocalRateLimitError("等待 AI 呼叫名額逾時", retry_after=core.max_wait)
+        except asyncio.CancelledError:
+            if ticket.done():
+                self._wake(core.release(None, False, time.monotonic()))  # 已拿到名額才被取消：還回去
+            else:
+                core.cancel(user_id, ticket)
+            raise
+        try:
+            while (wait := core.model_wait(model, time.monotonic())) > 0:
+                await self._sleep_or_reject(wait, deadline, f"模型 {model} 請求過於頻繁")
+        except BaseException:
+            self._wake(core.release(None, False, time.monotonic()))
+            raise
+
+    async def _sleep_or_reject(self, wait, deadline, message):
+        if asyncio.get_running_loop().time() + wait > deadline:
+            self._core.counters["rejected"] += 1
+            raise LocalRateLimitError(message, retry_after=wait)
+        await asyncio.sleep(wait)
+
+    @staticmethod
+    def _wake(granted):
+        for ticket in granted:
+            if not ticket.done():
+                ticket.set_result(True)
+
+    def stats(self):
+        return self._core.stats()
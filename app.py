@@ -1,20 +1,12 @@
-import os
 import time
-import json
-import psycopg2
 import logging
-import httpx # 保留，openai SDK 可能會用到
+import httpx # OpenAI client 的超時設定
 import hashlib
 import requests
-import datetime
 import base64
-import io
-from urllib.parse import quote_plus
-from bs4 import BeautifulSoup # 用於解析 HTML
-# from PIL import Image # 暫時不用
 
-from flask import Flask, request, abort
-from linebot import LineBotApi, WebhookHandler
+from flask import Flask, request, abort, Response
+from linebot import LineBotApi, SignatureValidator
 from linebot.exceptions import InvalidSignatureError, LineBotApiError
 # 加入 ImageMessage, ImageSendMessage
 from linebot.models import (
@@ -22,22 +14,40 @@ from linebot.models import (
     ImageMessage, ImageSendMessage
 )
 
-from dotenv import load_dotenv
-from openai import OpenAI, RateLimitError, APIConnectionError, AuthenticationError, APITimeoutError, APIStatusError # 使用 OpenAI SDK
-from threading import Thread
-
-# --- 載入環境變數 & 基本設定 ---
-load_dotenv()
+from openai import OpenAI, APIError, AuthenticationError # 使用 OpenAI SDK
+from bot_logic import (
+    MAX_HISTORY_TURNS, IMAGE_GEN_TRIGGER_HALF, IMAGE_GEN_TRIGGER_FULL, IMAGE_GEN_MODEL,
+    FETCH_HEADERS, FETCH_TIMEOUT, TEXT_SUMMARY_CHARS, MAX_FETCH_BYTES, FETCH_CHUNK_BYTES,
+    webhook_event_rows, needs_auto_search, build_search_url, new_html_extractor, decode_text_prefix, format_web_info,
+    build_time_note, build_user_content, pick_model,
+    ai_error_reply, new_history_messages,
+    new_event_queue, new_event_queue_gate, new_ai_limiter, new_prompt_builder, new_history_cache, new_search_cache, new_image_preprocessor, new_image_store, new_profiler
+)
+from settings import (
+    LINE_CHANNEL_ACCESS_TOKEN, LINE_CHANNEL_SECRET, GROK_API_KEY, DATABASE_URL, XAI_API_BASE_URL, LINE_API_ENDPOINT, LINE_DATA_ENDPOINT,
+    WEB_CONCURRENCY, DISPATCH_WORKERS, DISPATCH_QUEUE_SIZE, AI_MAX_CONCURRENCY_SYNC,
+    STREAM_RESPONSES, STREAM_CHUNK_CHARS, STREAM_CHUNK_SECONDS, STREAM_MAX_EARLY_PUSHES,
+    DB_POOL_MIN, DB_POOL_MAX_SYNC, DB_POOL_TIMEOUT, HISTORY_RETAIN_MESSAGES, HISTORY_PRUNE_EVERY, HISTORY_WRITE_BEHIND, HISTORY_FLUSH_INTERVAL, HISTORY_BATCH_SIZE,
+    GENERATED_IMAGE_MAX_BYTES, HEALTH_PROBE_INTERVAL, HEALTH_PROBE_TIMEOUT, MIGRATE_ON_START, METRICS_TOKEN, PORT
+)
+from event_queue import EventQueueConsumer, QueueFullError
+from ai_limiter import AiLimiter, LocalRateLimitError
+from lifecycle import LazyClient, HealthProbes, WORKER_LIFECYCLE
+from migrate import run_migrations
+from metrics import REGISTRY, CONTENT_TYPE, STAGE_SECONDS, stage, record_error, register_cache_stats, access_allowed
+from image_pipeline import ImageTooLargeError, ImageProcessingError, read_bounded
+from generated_images import IMAGE_ROUTE_PREFIX, IMMUTABLE_CACHE_CONTROL
+from history_store import create_history_repository
+from streaming import StreamChunker, stream_deltas
+
+# --- 基本設定 (環境變數集中在 settings.py，兩個進入點共用) ---
 app = Flask(__name__)
 app.logger.setLevel(logging.INFO)
 
-# --- 環境變數讀取與驗證 ---
-channel_access_token = os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
-channel_secret = os.getenv('LINE_CHANNEL_SECRET')
-grok_api_key_from_env = os.getenv('GROK_API_KEY') # 這裡仍用 GROK_API_KEY 這個名字讀取 xAI 的 Key
-DATABASE_URL = os.getenv('DATABASE_URL')
-XAI_API_BASE_URL = os.getenv("XAI_API_BASE_URL", "https://api.x.ai/v1") # <-- xAI API 端點 (如果需要可自訂)
-TAIWAN_TZ = datetime.timezone(datetime.timedelta(hours=8)) # 設定時區為台灣時間 (UTC+8)
+# --- 環境變數驗證 ---
+channel_access_token = LINE_CHANNEL_ACCESS_TOKEN
+channel_secret = LINE_CHANNEL_SECRET
+grok_api_key_from_env = GROK_API_KEY # 這裡仍用 GROK_API_KEY 這個名字讀取 xAI 的 Key
 
 # 檢查 API Key
 grok_api_key = None
@@ -61,139 +71,179 @@ if not DATABASE_URL:
     app.logger.error("錯誤：DATABASE_URL 未設定！請在 Render 連接資料庫。")
     exit()
 
-# --- Line Bot SDK 初始化 (v2) ---
-try:
-    line_bot_api = LineBotApi(channel_access_token)
-    handler = WebhookHandler(channel_secret)
-    app.logger.info("Line Bot SDK v2 初始化成功。")
-except Exception as e:
-    app.logger.error(f"無法初始化 Line Bot SDK: {e}")
-    exit()
+# --- Line Bot SDK / OpenAI Client (for xAI)：第一次使用時才建立 (匯入時不連線，gunicorn preload 後每個 worker 各自建立) ---
+signature_validator = SignatureValidator(channel_secret)
+line_bot_api = LazyClient(
+    lambda: LineBotApi(channel_access_token, endpoint=LINE_API_ENDPOINT, data_endpoint=LINE_DATA_ENDPOINT), "Line Bot SDK v2"
+)
+ai_client = LazyClient(lambda: OpenAI(
+    api_key=grok_api_key,
+    base_url=XAI_API_BASE_URL,
+    timeout=httpx.Timeout(60.0, connect=10.0), # 在這裡設定超時
+    max_retries=0 # 重試由 ai_limiter 統一處理 (依 Retry-After + 抖動)
+), f"OpenAI client for xAI Grok ({XAI_API_BASE_URL})")
+
+
+# --- 共用元件 (模型、關鍵字等共用設定與建立元件的函數見 bot_logic.py) ---
+# xAI 呼叫限流：每個 worker 執行緒最多一個呼叫，同時呼叫數上限預設與 worker 數相同
+ai_limiter = new_ai_limiter(AiLimiter, AI_MAX_CONCURRENCY_SYNC, AI_MAX_CONCURRENCY_SYNC)
+if WEB_CONCURRENCY > 1: app.logger.warning(f"xAI 限流為每個 worker 各自計算，{WEB_CONCURRENCY} 個 worker 的實際上限為設定值的 {WEB_CONCURRENCY} 倍。")
+prompt_builder = new_prompt_builder()
+
+# --- 資料庫 (連線池) ---
+history_repo = create_history_repository(
+    DATABASE_URL, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX_SYNC, checkout_timeout=DB_POOL_TIMEOUT,
+    retain_messages=HISTORY_RETAIN_MESSAGES, prune_every=HISTORY_PRUNE_EVERY, write_behind=HISTORY_WRITE_BEHIND,
+    flush_interval=HISTORY_FLUSH_INTERVAL, batch_size=HISTORY_BATCH_SIZE
+)
 
-# --- 初始化 OpenAI Client (for xAI) ---
-ai_client = None
-try:
-    app.logger.info(f"準備初始化 OpenAI client for xAI Grok，目標 URL: {XAI_API_BASE_URL}")
-    ai_client = OpenAI(
-        api_key=grok_api_key,
-        base_url=XAI_API_BASE_URL,
-        timeout=httpx.Timeout(60.0, connect=10.0) # 在這裡設定超時
-    )
-    # --- 簡單測試 API Key ---
-    try:
-        app.logger.info("嘗試使用 xAI API Key 獲取模型列表...")
-        models = ai_client.models.list()
-        app.logger.info(f">>> xAI API Key 測試 (模型列表) 成功，模型數: {len(models.data)}")
-        if models.data:
-            app.logger.info(f"    部分可用模型: {[m.id for m in models.data[:5]]}")
-    except AuthenticationError as e:
-        app.logger.error(f"!!! xAI API Key 測試 (模型列表) 失敗: 認證錯誤 (401)! 請確認 API Key 對 {XAI_API_BASE_URL} 有效。", exc_info=False)
-    except Exception as e:
-        app.logger.error(f"!!! xAI API Key 測試 (模型列表) 發生其他錯誤: {type(e).__name__}: {e}", exc_info=True)
-    app.logger.info("OpenAI client for xAI Grok 初始化流程完成。")
-except Exception as e:
-    app.logger.error(f"無法初始化 OpenAI client for xAI: {e}", exc_info=True)
-
-
-# --- 其他設定與函數 ---
-MAX_HISTORY_TURNS = 5
-SEARCH_KEYWORDS = ["天氣", "新聞", "股價", "今日", "今天", "最新", "誰是", "什麼是", "介紹", "查詢", "搜尋"] # 自動搜尋關鍵字 (可擴充)
-IMAGE_GEN_TRIGGER_HALF = "畫一張:" # 半形冒號
-IMAGE_GEN_TRIGGER_FULL = "畫一張：" # 全形冒號
-TEXT_MODEL = "grok-3-mini-beta"
-VISION_MODEL = "grok-vision-beta" # 請確認這是你可用的視覺模型 ID
-IMAGE_GEN_MODEL = "grok-2-image-1212" # 請確認這是你可用的圖片生成模型 ID
-
-# --- 資料庫輔助函數 ---
-def get_db_connection():
-    """建立並返回一個 PostgreSQL 連接"""
-    try:
-        conn = psycopg2.connect(DATABASE_URL)
-        conn.set_client_encoding('UTF8')
-        return conn
-    except Exception as e:
-        app.logger.error(f"資料庫連接失敗: {e}")
-        return None
-
-def init_db():
-    """檢查並建立 conversation_history 資料表"""
-    sql = "CREATE TABLE IF NOT EXISTS conversation_history (user_id TEXT PRIMARY KEY, history JSONB);"
-    conn = get_db_connection()
-    if not conn:
-        app.logger.error("無法初始化資料庫 (無連接)。")
-        return
-    try:
-        # 確保縮排正確
-        with conn.cursor() as cur:
-            cur.execute(sql)
-            conn.commit()
-        app.logger.info("資料庫資料表 'conversation_history' 初始化完成。")
-    except Exception as e:
-        app.logger.error(f"無法初始化資料庫資料表: {e}")
-        if conn and not conn.closed:
-             try:
-                 conn.rollback()
-             except Exception as rb_err:
-                 app.logger.error(f"Rollback 失敗: {rb_err}")
-    finally:
-        if conn and not conn.closed:
-             conn.close()
+# --- 最近歷史快取 (write-through；設定 REDIS_URL 時多個 worker 共用，多個 worker 又沒有 Redis 時停用) ---
+history_cache = new_history_cache()
+
+# --- 搜尋結果快取 (依關鍵字類別的 TTL、背景更新、合併相同查詢；設定 SEARCH_CACHE_PATH 時重啟後仍保留) ---
+search_cache = new_search_cache()
+
+# --- 使用者圖片前處理 (縮圖 + 重新壓縮後才送給視覺模型；同一張圖依內容雜湊快取) ---
+IMAGE_DOWNLOAD_CHUNK_BYTES = 64 * 1024
+image_preprocessor = new_image_preprocessor()
+
+# --- 生成圖片儲存 (相同提示直接回傳；原圖與預覽圖由 /images 路由提供)；需要對外網址，未設定時直接使用供應商的暫時網址 ---
+image_store = new_image_store()
+if image_store is None:
+    app.logger.warning("未設定 PUBLIC_BASE_URL，生成圖片不快取，直接使用供應商的暫時網址。")
+
+
+def generate_image_bytes(user_id, prompt):
+    """呼叫圖片生成 API 並下載結果 (供 image_store 快取/重新託管)"""
+    response = ai_limiter.call(user_id, IMAGE_GEN_MODEL, lambda: ai_client.images.generate(model=IMAGE_GEN_MODEL, prompt=prompt, n=1))
+    item = response.data[0]
+    if getattr(item, "b64_json", None): return base64.b64decode(item.b64_json)
+    if not item.url: raise ValueError("圖片生成 API 未返回有效 URL")
+    with requests.get(item.url, stream=True, timeout=FETCH_TIMEOUT) as r:
+        r.raise_for_status()
+        return read_bounded(r.iter_content(chunk_size=IMAGE_DOWNLOAD_CHUNK_BYTES), GENERATED_IMAGE_MAX_BYTES)
 
 # --- 網頁內容/搜尋結果獲取函數 ---
 def fetch_and_extract_text(url):
-    """從指定 URL 獲取內容並使用 BeautifulSoup 提取文字摘要"""
+    """從指定 URL 串流下載內容並提取文字摘要 (摘要額度滿了或超過 MAX_FETCH_BYTES 即停止下載)"""
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Accept-Language': 'en-US,en;q=0.9,zh-TW;q=0.8,zh;q=0.7',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8',
-        }
         app.logger.info(f"開始獲取 URL 內容: {url}")
-        response = requests.get(url, headers=headers, timeout=15) # 15秒超時
-        response.raise_for_status() # 檢查 HTTP 錯誤狀態碼
-        content_type = response.headers.get('content-type', '').lower()
-
-        if 'html' in content_type:
-             soup = BeautifulSoup(response.content, 'html.parser') # 使用 response.content 避免編碼問題
-             for element in soup(["script", "style", "header", "footer", "nav", "aside", "form", "button", "input"]): # 移除更多不相關標籤
-                 element.decompose()
-             text = '\n'.join(filter(None, (line.strip() for line in soup.stripped_strings)))
-             summary = text[:2500] # 限制摘要長度
-             app.logger.info(f"成功獲取並解析 HTML: {url}, 摘要長度: {len(summary)}")
-             return summary if summary else "無法從 HTML 中提取有效文字摘要。"
-        elif 'text' in content_type:
-             content = response.text[:3000]
-             app.logger.info(f"成功獲取純文字: {url}, 長度: {len(content)}")
-             return content
-        else:
-             app.logger.warning(f"URL: {url} 的內容類型不支援 ({content_type})")
-             return f"獲取失敗：無法處理的內容類型 ({content_type})"
+        with stage("web_fetch"), requests.get(url, headers=FETCH_HEADERS, timeout=FETCH_TIMEOUT, stream=True) as response: # 15秒超時
+            response.raise_for_status() # 檢查 HTTP 錯誤狀態碼
+            content_type = response.headers.get('content-type', '').lower()
+
+            if 'html' in content_type:
+                 extractor = new_html_extractor(url, content_type); read_bytes = 0; parse_seconds = 0.0
+                 for chunk in response.iter_content(chunk_size=FETCH_CHUNK_BYTES):
+                     read_bytes += len(chunk); parse_start = time.perf_counter()
+                     done = extractor.feed(chunk); parse_seconds += time.perf_counter() - parse_start
+                     if done or read_bytes >= MAX_FETCH_BYTES: break
+                 parse_start = time.perf_counter(); summary = extractor.summary()
+                 STAGE_SECONDS.observe(parse_seconds + time.perf_counter() - parse_start, "html_parse") # 解析時間 (web_fetch 含下載與解析)
+                 app.logger.info(f"成功獲取並解析 HTML ({extractor.backend}): {url}, 讀取 {read_bytes} bytes, 摘要長度: {len(summary)}")
+                 return summary if summary else "無法從 HTML 中提取有效文字摘要。"
+            elif 'text' in content_type:
+                 raw = b""
+                 for chunk in response.iter_content(chunk_size=FETCH_CHUNK_BYTES):
+                     raw += chunk
+                     if len(raw) >= TEXT_SUMMARY_CHARS * 4: break # UTF-8 每字最多 4 bytes
+                 content = decode_text_prefix(raw, content_type)
+                 app.logger.info(f"成功獲取純文字: {url}, 長度: {len(content)}")
+                 return content
+            else:
+                 app.logger.warning(f"URL: {url} 的內容類型不支援 ({content_type})")
+                 return f"獲取失敗：無法處理的內容類型 ({content_type})"
 
     except requests.exceptions.Timeout: app.logger.error(f"獲取 URL 超時: {url}"); return "獲取失敗：請求超時"
     except requests.exceptions.RequestException as e: app.logger.error(f"獲取 URL 內容失敗: {url}, Error: {e}"); return f"獲取失敗：{str(e)}"
     except Exception as e: app.logger.error(f"處理 URL 獲取時未知錯誤: {url}, Error: {e}", exc_info=True); return f"處理 URL 獲取時發生錯誤：{str(e)}"
 
 
+# --- 呼叫 AI (一次取得完整回覆 / 串流) ---
+def complete_once(user_id, prompt_messages, target_model):
+    """等完整回覆再回傳；失敗時回傳對應的錯誤回覆"""
+    try:
+        grok_start = time.time()
+        with stage("ai_call"):
+            chat_completion = ai_limiter.call(user_id, target_model, lambda: ai_client.chat.completions.create(
+                messages=prompt_messages,
+                model=target_model,
+                temperature=0.7,
+                max_tokens=1500
+            ))
+        final_response = chat_completion.choices[0].message.content.strip()
+        app.logger.info(f"xAI Grok ({target_model}) 回應成功，用時 {time.time() - grok_start:.2f} 秒。")
+        return final_response
+    # (錯誤處理：例外對應的回覆見 bot_logic.ai_error_reply)
+    except Exception as e:
+        level, final_response = ai_error_reply(e)
+        app.logger.log(level, f"xAI Grok ({target_model}) 呼叫失敗: {type(e).__name__}: {e}", exc_info=not isinstance(e, (APIError, LocalRateLimitError)))
+        return final_response
+
+def push_texts(user_id, texts):
+    """推送一組文字訊息 (最多 5 則)，失敗只記錄不中斷"""
+    try:
+        with stage("line_push"): line_bot_api.push_message(user_id, messages=[TextSendMessage(text=t) for t in texts])
+    except LineBotApiError as e: app.logger.error(f"LINE API 錯誤: {e.status_code} {e.error.message}")
+    except Exception as e: app.logger.error(f"推送訊息錯誤: {e}", exc_info=True)
+
+def stream_and_push(user_id, prompt_messages, target_model):
+    """串流呼叫 AI，句子完整的段落先推送，結束後推送剩餘內容；回傳完整回覆 (存入歷史用)"""
+    chunker = StreamChunker(min_chars=STREAM_CHUNK_CHARS, max_wait=STREAM_CHUNK_SECONDS, max_early_chunks=STREAM_MAX_EARLY_PUSHES)
+    parts = []; error_reply = None; grok_start = time.time(); first_token_time = None
+    attempt_first_token = None # 這次呼叫送出到收到首個 token 的秒數 (給 AIMD 的壅塞訊號，不含生成與推送 LINE 的時間)
+
+    def _stream():  # 整段串流都在限流名額內進行；已經推送過內容就不重試
+        nonlocal first_token_time, attempt_first_token
+        attempt_start = time.time()
+        stream = ai_client.chat.completions.create(
+            messages=prompt_messages, model=target_model, temperature=0.7, max_tokens=1500, stream=True
+        )
+        for delta in stream_deltas(stream):
+            if first_token_time is None:
+                first_token_time = time.time() - grok_start; STAGE_SECONDS.observe(first_token_time, "ai_first_token")
+                attempt_first_token = time.time() - attempt_start
+                app.logger.info(f"xAI Grok ({target_model}) 首個 token 用時 {first_token_time:.2f} 秒。")
+            parts.append(delta)
+            for chunk in chunker.add(delta): push_texts(user_id, [chunk])
+
+    try:
+        with stage("ai_stream"): ai_limiter.call(
+            user_id, target_model, _stream, should_retry=lambda: not parts, latency_fn=lambda result, elapsed: attempt_first_token
+        )
+        app.logger.info(f"xAI Grok ({target_model}) 串流完成，用時 {time.time() - grok_start:.2f} 秒，提早推送 {chunker.early_chunks} 段。")
+        if not parts: error_reply = "抱歉，AI 沒有回應任何內容。"
+    except Exception as e:
+        level, error_reply = ai_error_reply(e)
+        app.logger.log(level, f"xAI Grok ({target_model}) 串流失敗: {type(e).__name__}: {e}", exc_info=not isinstance(e, (APIError, LocalRateLimitError)))
+    for group in chunker.finish(extra=error_reply): push_texts(user_id, group)
+    full_text = "".join(parts).strip()
+    if error_reply: return f"{full_text}\n{error_reply}" if full_text else error_reply
+    return full_text
+
+
 # --- 背景處理函數 (整合所有功能) ---
 def process_and_push(user_id, event):
     user_text_original = ""
-    image_data_b64 = None
+    image_data_b64 = None; image_mime = "image/jpeg"
     is_image_gen_request = False
     image_gen_prompt = ""
     final_response = "抱歉，系統發生錯誤或無法連接 AI 服務。"
     final_response_message = None
+    already_pushed = False # 串流模式在呼叫 AI 時就已推送完畢
 
     # 判斷訊息類型
     if isinstance(event.message, TextMessage):
         user_text_original = event.message.text
-        app.logger.info(f"收到文字訊息 (原始): {repr(user_text_original)}")
+        verbose = app.logger.isEnabledFor(logging.DEBUG) # 逐則訊息的詳細日誌：關閉時連字串都不組
+        if verbose: app.logger.debug(f"收到文字訊息 (原始): {repr(user_text_original)}")
 
-        # --- ▼▼▼ 詳細觸發詞檢查日誌 ▼▼▼ ---
+        # --- ▼▼▼ 詳細觸發詞檢查日誌 (DEBUG) ▼▼▼ ---
         cleaned_text = user_text_original.strip()
-        app.logger.info(f"DEBUG: 清理後文字: {repr(cleaned_text)}")
+        if verbose: app.logger.debug(f"清理後文字: {repr(cleaned_text)}")
 
         starts_with_half = cleaned_text.startswith(IMAGE_GEN_TRIGGER_HALF)
-        app.logger.info(f"DEBUG: cleaned_text.startswith('{IMAGE_GEN_TRIGGER_HALF}') -> {starts_with_half}")
+        if verbose: app.logger.debug(f"cleaned_text.startswith('{IMAGE_GEN_TRIGGER_HALF}') -> {starts_with_half}")
         if starts_with_half:
             is_image_gen_request = True
             image_gen_prompt = cleaned_text[len(IMAGE_GEN_TRIGGER_HALF):].strip()
@@ -201,201 +251,247 @@ def process_and_push(user_id, event):
 
         if not is_image_gen_request:
             starts_with_full = cleaned_text.startswith(IMAGE_GEN_TRIGGER_FULL)
-            app.logger.info(f"DEBUG: cleaned_text.startswith('{IMAGE_GEN_TRIGGER_FULL}') -> {starts_with_full}")
+            if verbose: app.logger.debug(f"cleaned_text.startswith('{IMAGE_GEN_TRIGGER_FULL}') -> {starts_with_full}")
             if starts_with_full:
                 is_image_gen_request = True
                 image_gen_prompt = cleaned_text[len(IMAGE_GEN_TRIGGER_FULL):].strip()
                 app.logger.info(f"偵測到圖片生成指令 (全形冒號): '{image_gen_prompt}'")
 
-        app.logger.info(f"DEBUG: 觸發詞檢查完成後, is_image_gen_request = {is_image_gen_request}")
+        if verbose: app.logger.debug(f"觸發詞檢查完成後, is_image_gen_request = {is_image_gen_request}")
         # --- ▲▲▲ 結束詳細日誌 ▲▲▲ ---
 
     elif isinstance(event.message, ImageMessage):
         message_id = event.message.id; app.logger.info(f"收到圖片訊息 (ID: {message_id})，嘗試下載...")
         try:
-            message_content = line_bot_api.get_message_content(message_id); image_bytes = message_content.content; image_data_b64 = base64.b64encode(image_bytes).decode('utf-8'); user_text_original = "[圖片描述請求]"; app.logger.info(f"成功下載圖片並轉換為 Base64")
+            with stage("image_download"):
+                message_content = line_bot_api.get_message_content(message_id)
+                image_bytes = image_preprocessor.read(message_content.iter_content(chunk_size=IMAGE_DOWNLOAD_CHUNK_BYTES))
+            with stage("image_preprocess"): prepared = image_preprocessor.process(image_bytes)
+            image_data_b64 = prepared.b64; image_mime = prepared.mime; user_text_original = "[圖片描述請求]"
+            app.logger.info(f"成功下載並壓縮圖片 ({prepared.original_size} -> {prepared.size} bytes, {prepared.width}x{prepared.height})")
+        except ImageTooLargeError as e: app.logger.warning(f"圖片訊息 {message_id} 過大: {e}"); user_text_original = "[圖片過大無法處理]"
+        except ImageProcessingError as e: app.logger.warning(f"圖片訊息 {message_id} 無法處理: {e}"); user_text_original = "[處理使用者圖片時出錯]"
         except Exception as e: app.logger.error(f"處理圖片訊息 {message_id} 時出錯: {e}", exc_info=True); user_text_original = "[處理使用者圖片時出錯]"
     else: app.logger.info(f"忽略非文字/圖片訊息。"); return
 
     # --- 處理圖片生成 ---
     if is_image_gen_request:
         app.logger.info(f"開始處理圖片生成請求...")
-        if ai_client is None: final_response_message = TextSendMessage(text="[AI Client 初始化失敗]")
-        else:
-            try:
-                app.logger.info(f"嘗試呼叫 '{IMAGE_GEN_MODEL}' 生成圖片，提示: '{image_gen_prompt}'")
+        try:
+            app.logger.info(f"嘗試呼叫 '{IMAGE_GEN_MODEL}' 生成圖片，提示: '{image_gen_prompt}'")
+            if image_store is not None:
+                with stage("image_generate"): image_name, cached = image_store.get_or_generate(image_gen_prompt, lambda: generate_image_bytes(user_id, image_gen_prompt))
+                original_url, preview_url = image_store.urls(image_name)
+                app.logger.info(f"圖片{'快取命中' if cached else '生成完成'}: {image_name}，圖片儲存: {image_store.stats()}")
+                final_response_message = ImageSendMessage(original_content_url=original_url, preview_image_url=preview_url)
+            else:
                 # --- 修正呼叫：移除 size ---
-                response = ai_client.images.generate(
-                    model=IMAGE_GEN_MODEL,
-                    prompt=image_gen_prompt,
-                    n=1
-                )
+                with stage("image_generate"):
+                    response = ai_limiter.call(user_id, IMAGE_GEN_MODEL, lambda: ai_client.images.generate(
+                        model=IMAGE_GEN_MODEL,
+                        prompt=image_gen_prompt,
+                        n=1
+                    ))
                 # --- 假設返回 URL ---
                 image_url = response.data[0].url
                 if image_url: final_response_message = ImageSendMessage(original_content_url=image_url, preview_image_url=image_url)
                 else: app.logger.error("圖片生成 API 未返回有效 URL。"); final_response_message = TextSendMessage(text="抱歉，圖片生成失敗 (未收到URL)。")
-            except AuthenticationError as e: app.logger.error(f"圖片生成認證錯誤: {e}"); final_response_message = TextSendMessage(text="圖片生成服務認證失敗。")
-            except Exception as e: app.logger.error(f"圖片生成時發生錯誤: {e}", exc_info=True); final_response_message = TextSendMessage(text=f"抱歉，圖片生成時發生錯誤: {type(e).__name__}")
+        except AuthenticationError as e: app.logger.error(f"圖片生成認證錯誤: {e}"); final_response_message = TextSendMessage(text="圖片生成服務認證失敗。")
+        except LocalRateLimitError as e: app.logger.warning(f"圖片生成被限流: {e}"); final_response_message = TextSendMessage(text=ai_error_reply(e)[1])
+        except Exception as e: app.logger.error(f"圖片生成時發生錯誤: {e}", exc_info=True); final_response_message = TextSendMessage(text=f"抱歉，圖片生成時發生錯誤: {type(e).__name__}")
         try:
-            if final_response_message: line_bot_api.push_message(user_id, messages=final_response_message); app.logger.info(f"圖片生成結果推送完成。")
-            else: line_bot_api.push_message(user_id, TextSendMessage(text="[圖片生成處理完成，但無有效結果]"))
+            with stage("line_push"):
+                if final_response_message: line_bot_api.push_message(user_id, messages=final_response_message); app.logger.info(f"圖片生成結果推送完成。")
+                else: line_bot_api.push_message(user_id, TextSendMessage(text="[圖片生成處理完成，但無有效結果]"))
         except Exception as e: app.logger.error(f"推送圖片生成結果時出錯: {e}")
         app.logger.info(f"圖片生成請求處理完畢，結束任務。")
         return # <--- 確保這裡有 return
 
     # --- 處理文字或圖片描述 ---
-    start_process_time = time.time(); conn = None; history = []
-    if ai_client is None: app.logger.error(f"AI Client 未初始化"); return
+    start_process_time = time.time(); history = []
 
     try:
-        # 1. 時間提示 + 固定繁中提示
-        now_utc = datetime.datetime.now(datetime.timezone.utc); now_taiwan = now_utc.astimezone(TAIWAN_TZ); current_time_str = now_taiwan.strftime("%Y年%m月%d日 %H:%M:%S")
-        system_prompt = {"role": "system", "content": f"指令：請永遠使用『繁體中文』回答。目前時間是 {current_time_str} (台灣 UTC+8)，回答時間問題請以此為準。"}
-
-        # 2. 讀取歷史紀錄 (確保縮排正確)
-        conn = get_db_connection()
-        if conn:
-            try: # <- try 開始
-                # with 和後面的內容縮排
-                with conn.cursor() as cur:
-                    cur.execute("SELECT history FROM conversation_history WHERE user_id = %s;", (user_id,))
-                    result = cur.fetchone()
-                    if result and result[0]:
-                        db_data = result[0]
-                        if isinstance(db_data, list): history = db_data
-                        elif isinstance(db_data, str): history = json.loads(db_data)
-                        else: history = []
-                        app.logger.info(f"成功載入歷史，長度: {len(history)}")
-                    else: app.logger.info(f"無歷史紀錄。")
-            except (Exception, psycopg2.DatabaseError) as db_err: # <- except 與 try 對齊
-                app.logger.error(f"讀取歷史錯誤: {db_err}", exc_info=True); history = []; conn.rollback()
-        else: app.logger.warning("無法連接資料庫，無歷史紀錄。")
+        # 1. 時間提示 (固定的繁中系統提示由 prompt_builder 放在最前面)
+        time_note = build_time_note()
 
-        # 3. 自動搜尋判斷
-        user_text_for_llm = user_text_original; web_info_for_llm = None; should_search_automatically = False
-        if isinstance(event.message, TextMessage) and not is_image_gen_request:
-             for keyword in SEARCH_KEYWORDS:
-                 if keyword in user_text_original: should_search_automatically = True; break
-        if should_search_automatically:
-             query = user_text_original; search_url = f"https://html.duckduckgo.com/html/?q={quote_plus(query)}"; search_result_summary = fetch_and_extract_text(search_url)
-             if search_result_summary and not search_result_summary.startswith("獲取失敗"): web_info_for_llm = f"為了回答 '{query}'，進行了網路搜尋，摘要如下:\n```\n{search_result_summary}\n```\n\n"
-             else: web_info_for_llm = f"嘗試自動搜尋 '{query}' 失敗:{search_result_summary}。"
-
-        # 4. 組合提示
-        prompt_messages = [system_prompt] + history
-        if web_info_for_llm: prompt_messages.append({"role": "system", "content": web_info_for_llm})
-        current_user_message_content = []
-        if image_data_b64: # 加入圖片提示
-             current_user_message_content.append({"type": "text", "text": "請描述這張圖片的內容。"})
-             if len(image_data_b64) < 1500000: current_user_message_content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_data_b64}"}})
-             else: current_user_message_content = [{"type": "text", "text": "[圖片過大無法處理]"}]
-        else: current_user_message_content.append({"type": "text", "text": user_text_for_llm})
-        prompt_messages.append({"role": "user", "content": current_user_message_content})
-        # (歷史裁剪)
-        if len(prompt_messages) > (MAX_HISTORY_TURNS * 2 + 3):
-            num_history_to_keep = MAX_HISTORY_TURNS * 2; head_prompt = prompt_messages[0]; tail_prompts = prompt_messages[-1:]; middle_history = prompt_messages[1:-1]; trimmed_middle_history = middle_history[-num_history_to_keep:]
-            prompt_messages = [head_prompt] + trimmed_middle_history + tail_prompts
-
-        # 5. 呼叫 AI API (修正語法錯誤)
+        # 2. 讀取歷史紀錄 (先查快取；miss 時只取最近 MAX_HISTORY_TURNS 輪，由索引倒序讀取)
         try:
-            grok_start = time.time()
-            target_model = VISION_MODEL if image_data_b64 else TEXT_MODEL
-            app.logger.info(f"準備呼叫 xAI Grok ({target_model})...")
-            app.logger.debug(f"傳送給 AI 的 messages: {prompt_messages}") # Debug log
-            # --- ▼▼▼ 確保參數正確 ▼▼▼ ---
-            chat_completion = ai_client.chat.completions.create(
-                messages=prompt_messages,
-                model=target_model,
-                temperature=0.7,
-                max_tokens=1500
+            history = history_cache.get(user_id)
+            if history is not None: app.logger.info(f"歷史快取命中，長度: {len(history)}")
+            else:
+                with stage("history_load"): history = history_repo.load(user_id, MAX_HISTORY_TURNS * 2)
+                history_cache.put(user_id, history)
+                if history: app.logger.info(f"成功載入歷史，長度: {len(history)}")
+                else: app.logger.info(f"無歷史紀錄。")
+        except Exception as db_err:
+            app.logger.error(f"讀取歷史錯誤: {db_err}", exc_info=True); history = []
+
+        # 3. 自動搜尋判斷
+        web_info_for_llm = None
+        if isinstance(event.message, TextMessage) and not is_image_gen_request and needs_auto_search(user_text_original):
+             query = user_text_original
+             with stage("search"): search_result_summary = search_cache.get_or_fetch(query, lambda: fetch_and_extract_text(build_search_url(query)))
+             web_info_for_llm = format_web_info(query, search_result_summary)
+
+        # 4. 組合提示 (依模型的 token 預算裁剪歷史)
+        target_model = pick_model(image_data_b64)
+        with stage("prompt_build"):
+            prompt_messages, prompt_info = prompt_builder.build(
+                target_model, history, build_user_content(user_text_original, image_data_b64, image_mime),
+                context_notes=[time_note], web_info=web_info_for_llm
             )
-            # --- ▲▲▲ 結束修正 ▲▲▲ ---
-            final_response = chat_completion.choices[0].message.content.strip()
-            app.logger.info(f"xAI Grok ({target_model}) 回應成功，用時 {time.time() - grok_start:.2f} 秒。")
-        # (錯誤處理)
-        except AuthenticationError as e: app.logger.error(f"xAI Grok API 認證錯誤: {e}", exc_info=False); final_response = "抱歉，AI 服務鑰匙錯誤。"
-        except RateLimitError as e: app.logger.warning(f"xAI Grok API 速率限制: {e}"); final_response = "抱歉，大腦過熱。"
-        except APIConnectionError as e: app.logger.error(f"xAI Grok API 連接錯誤: {e}"); final_response = "抱歉，AI 無法連線。"
-        except APITimeoutError as e: app.logger.warning(f"xAI Grok API 呼叫超時: {e}"); final_response = "抱歉，思考超時。"
-        except APIStatusError as e: app.logger.error(f"xAI Grok API 狀態錯誤: status={e.status_code}, response={e.response}"); final_response = "抱歉，AI 服務異常。"
-        except Exception as e: app.logger.error(f"xAI Grok 未知錯誤: {e}", exc_info=True); final_response = "抱歉，系統發生錯誤。"
-
-
-        # 6. 準備儲存歷史
-        history_to_save = history
-        history_to_save.append({"role": "user", "content": user_text_original})
-        history_to_save.append({"role": "assistant", "content": final_response})
-        if len(history_to_save) > MAX_HISTORY_TURNS * 2: history_to_save = history_to_save[-(MAX_HISTORY_TURNS * 2):]
-
-        # 7. 存回資料庫 (含日誌和 NULL fix)
-        if conn:
-            try:
-                if conn.closed: conn = get_db_connection()
-                with conn.cursor() as cur:
-                    history_json_string = json.dumps(history_to_save, ensure_ascii=False)
-                    cleaned_history_json_string = history_json_string.replace('\x00', '') # NULL byte fix
-                    # Debug Log (保持)
-                    app.logger.info(f"準備儲存歷史 for user_id: {user_id}")
-                    log_string = cleaned_history_json_string[:200] + "..." + cleaned_history_json_string[-200:] if len(cleaned_history_json_string) > 400 else cleaned_history_json_string
-                    app.logger.info(f"History JSON string (cleaned, partial): {log_string}")
-                    # 執行 SQL
-                    cur.execute("""
-                        INSERT INTO conversation_history (user_id, history)
-                        VALUES (%s, %s)
-                        ON CONFLICT (user_id) DO UPDATE SET history = EXCLUDED.history;
-                    """, (user_id, cleaned_history_json_string))
-                    conn.commit()
-                app.logger.info(f"歷史儲存成功 (長度: {len(history_to_save)})。")
-            except (Exception, psycopg2.DatabaseError) as db_err:
-                app.logger.error(f"儲存歷史錯誤 for user {user_id}: {type(db_err).__name__} - {db_err}", exc_info=True)
-                if conn and not conn.closed: conn.rollback()
+        app.logger.info(f"提示估計 {prompt_info['estimated_tokens']}/{prompt_info['budget']} tokens，捨棄 {prompt_info['dropped_messages']} 則較早的歷史" + (f"，截斷: {prompt_info['truncated']}" if prompt_info['truncated'] else ""))
+
+        # 5. 呼叫 AI API (串流模式：邊收邊推送)
+        app.logger.info(f"準備呼叫 xAI Grok ({target_model})...")
+        if app.logger.isEnabledFor(logging.DEBUG): app.logger.debug(f"傳送給 AI 的 messages: {prompt_messages}") # Debug log
+        if STREAM_RESPONSES:
+            final_response = stream_and_push(user_id, prompt_messages, target_model); already_pushed = True
         else:
-             app.logger.warning("無法連接資料庫，歷史紀錄未儲存。")
+            final_response = complete_once(user_id, prompt_messages, target_model)
+
+        # 6. 存回資料庫 (只新增本輪的兩則訊息；開啟 write-behind 時由背景批次寫入)
+        try:
+            new_messages = new_history_messages(user_text_original, final_response)
+            with stage("history_save"): history_repo.append(user_id, new_messages)
+            history_cache.append(user_id, new_messages) # write-through
+            app.logger.info(f"歷史儲存成功 (新增 {len(new_messages)} 則)。")
+        except Exception as db_err:
+            app.logger.error(f"儲存歷史錯誤 for user {user_id}: {type(db_err).__name__} - {db_err}", exc_info=True)
+            history_cache.invalidate(user_id)
 
-        # 8. 準備最終回覆訊息 (只有文字)
-        final_response_message = TextSendMessage(text=final_response)
+        # 7. 準備最終回覆訊息 (只有文字；串流模式已推送過)
+        if not already_pushed: final_response_message = TextSendMessage(text=final_response)
 
     except Exception as e:
+        record_error("process", e)
         app.logger.error(f"處理 user {user_id} 時錯誤: {type(e).__name__}: {e}", exc_info=True)
         final_response_message = TextSendMessage(text="抱歉，處理您的請求時發生了嚴重錯誤。")
-    finally:
-        if conn and not conn.closed:
-            conn.close()
 
     # 推送最終回應
     if final_response_message:
          app.logger.info(f"準備推送回應給 user {user_id}...")
          try:
-             line_bot_api.push_message(user_id, messages=final_response_message)
+             with stage("line_push"): line_bot_api.push_message(user_id, messages=final_response_message)
              app.logger.info(f"訊息推送完成。")
          except LineBotApiError as e: app.logger.error(f"LINE API 錯誤: {e.status_code} {e.error.message}")
          except Exception as e: app.logger.error(f"推送訊息錯誤: {e}", exc_info=True)
-    else:
+    elif not already_pushed:
          app.logger.error(f"沒有準備好任何回應訊息可以推送給 user {user_id}")
 
+    STAGE_SECONDS.observe(time.time() - start_process_time, "process_total")
     app.logger.info(f"任務完成，用時 {time.time() - start_process_time:.2f} 秒。")
+    if app.logger.isEnabledFor(logging.DEBUG): app.logger.debug(f"DB 連線池: {history_repo.stats()}，歷史快取: {history_cache.stats()}，搜尋快取: {search_cache.stats()}，AI 限流: {ai_limiter.stats()}") # 詳細統計見 /metrics
+
 
+# --- 生成圖片 (原圖與預覽圖；內容定址，可永久快取) ---
+@app.route(f"{IMAGE_ROUTE_PREFIX}/<name>", methods=['GET'])
+def serve_generated_image(name):
+    if image_store is None: abort(404)
+    if request.headers.get("If-None-Match") == f'"{name}"': return Response(status=304, headers={"ETag": f'"{name}"', "Cache-Control": IMMUTABLE_CACHE_CONTROL})
+    data, content_type = image_store.read(name)
+    if data is None: abort(404)
+    return Response(data, mimetype=content_type, headers={"ETag": f'"{name}"', "Cache-Control": IMMUTABLE_CACHE_CONTROL})
 
-# --- LINE Webhook 與事件處理器 (保持不變) ---
+
+# --- LINE Webhook 與事件處理器 ---
 @app.route("/callback", methods=['POST'])
 def callback():
-    signature = request.headers['X-Line-Signature']; body = request.get_data(as_text=True)
-    app.logger.info(f"收到請求: {body[:100]}")
-    try: handler.handle(body, signature)
-    except InvalidSignatureError: app.logger.error("簽名錯誤。"); abort(400)
-    except LineBotApiError as e: app.logger.error(f"LINE API 錯誤: {e.status_code} {e.error.message}"); abort(500)
-    except Exception as e: app.logger.error(f"Webhook 錯誤: {e}", exc_info=True); abort(500)
+    """驗證簽名後只把事件寫入持久化佇列就回 200 (實際處理由 event_consumer 在背景進行)"""
+    with STAGE_SECONDS.time("callback"):
+        signature = request.headers.get('X-Line-Signature', ''); body = request.get_data(as_text=True)
+        if not signature_validator.validate(body, signature): record_error("callback", InvalidSignatureError()); app.logger.error("簽名錯誤。"); abort(400)
+        try:
+            rows = webhook_event_rows(body)
+            if rows:
+                with stage("callback_enqueue"): inserted = event_queue_gate.enqueue_many(rows)
+                event_consumer.notify()
+                if inserted < len(rows): app.logger.info(f"略過 {len(rows) - inserted} 個重送的事件。")
+        except QueueFullError as e: record_error("callback", e); app.logger.warning(f"{e}，回 503 讓 LINE 稍後重送。"); abort(503)
+        except Exception as e: record_error("callback", e); app.logger.error(f"Webhook 錯誤: {e}", exc_info=True); abort(500)
     return 'OK'
 
-@handler.add(MessageEvent, message=(TextMessage, ImageMessage))
-def handle_message(event):
-    user_id = event.source.user_id
-    Thread(target=process_and_push, args=(user_id, event)).start()
 
-# --- 主程式進入點 (保持不變) ---
+def handle_queued_event(user_id, payload):
+    process_and_push(user_id, MessageEvent.new_from_json_dict(payload))
+
+# 事件先寫入持久化佇列 (重啟不遺失、重送去重)；consumer 取出後交給固定數量的 worker，同一個 user_id 依序處理
+event_queue = new_event_queue()
+event_queue_gate = new_event_queue_gate(event_queue) # 未處理事件達到 EVENT_QUEUE_MAX_PENDING 時 /callback 回 503
+event_consumer = EventQueueConsumer(event_queue, handle_queued_event, workers=DISPATCH_WORKERS, max_pending=DISPATCH_QUEUE_SIZE, name="line-consumer")
+
+# --- 量測 (/metrics：Prometheus 文字格式；PROFILER_ENABLED=1 時另有 /debug/profile) ---
+register_cache_stats("history", history_cache.stats)
+register_cache_stats("search", search_cache.stats, ("hits", "stale_hits", "misses", "coalesced"))
+register_cache_stats("image_preprocess", image_preprocessor.stats)
+if image_store is not None: register_cache_stats("generated_image", image_store.stats, ("hits", "misses", "coalesced"))
+REGISTRY.gauge_callback("linebot_event_queue_events", "事件佇列中各狀態的事件數", lambda: {k: v for k, v in event_queue.stats().items() if k != "backend"}, ["status"])
+REGISTRY.gauge_callback("linebot_event_queue_depth", "事件佇列中待處理 + 處理中的事件數", event_queue_gate.refresh)
+REGISTRY.counter_callback("linebot_event_queue_rejected_total", "佇列已滿而回 503 的 webhook 數", lambda: event_queue_gate.rejected)
+REGISTRY.gauge_callback("linebot_dispatcher_events", "worker 的待處理/處理中事件數", lambda: {k: v for k, v in event_consumer.dispatcher.stats().items() if k in ("pending", "active")}, ["state"])
+REGISTRY.gauge_callback("linebot_db_pool_connections", "DB 連線池借出中的連線數", lambda: history_repo.stats()["checked_out"])
+REGISTRY.gauge_callback("linebot_db_pool_open_connections", "DB 連線池目前開啟的連線數", lambda: history_repo.stats()["open"])
+REGISTRY.counter_callback("linebot_db_pool_timeouts_total", "等不到 DB 連線的次數", lambda: history_repo.stats()["timeouts"])
+REGISTRY.gauge_callback("linebot_ai_concurrency", "xAI 呼叫的同時數/上限/排隊數", lambda: {k: v for k, v in ai_limiter.stats().items() if k in ("inflight", "limit", "waiting")}, ["state"])
+REGISTRY.counter_callback("linebot_ai_limiter_events_total", "xAI 限流事件數", lambda: {k: v for k, v in ai_limiter.stats().items() if k in ("calls", "throttled", "retries", "rejected")}, ["event"])
+
+def require_metrics_access():
+    """METRICS_TOKEN 不符 (或未設定時非本機連線) 回 404，不透露端點存在"""
+    if not access_allowed(METRICS_TOKEN, request.headers.get("Authorization"), request.remote_addr): abort(404)
+
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    require_metrics_access()
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+profiler = new_profiler()
+if profiler is not None:
+
+    @app.route("/debug/profile", methods=['GET'])
+    def debug_profile():
+        """取樣 profiler 累計的 folded stacks (?reset=1 讀取後清空)；PROFILER_ENABLED 未開啟時沒有這個路由 (404)"""
+        require_metrics_access()
+        return Response(profiler.folded(top=int(request.args.get("top", "200")), reset=request.args.get("reset") == "1"), content_type="text/plain; charset=utf-8")
+
+# --- 健康檢查 (背景探測並快取結果；/healthz 不做網路呼叫) ---
+health_probes = HealthProbes(interval=HEALTH_PROBE_INTERVAL)
+
+def probe_xai():
+    """取代原本匯入時的模型列表測試 (xAI 變慢不再卡住啟動；失敗只標記 degraded)"""
+    try: models = ai_client.with_options(timeout=HEALTH_PROBE_TIMEOUT).models.list()
+    except AuthenticationError: app.logger.error(f"!!! xAI API Key 測試 (模型列表) 失敗: 認證錯誤 (401)! 請確認 API Key 對 {XAI_API_BASE_URL} 有效。"); raise
+    return f"{len(models.data)} 個模型: {[m.id for m in models.data[:5]]}"
+
+def probe_event_queue():
+    stats = event_queue.stats()
+    return f"{stats['backend']} pending={stats.get('pending', 0)} processing={stats.get('processing', 0)}"
+
+health_probes.add("database", history_repo.ping)
+health_probes.add("event_queue", probe_event_queue)
+health_probes.add("xai", probe_xai, critical=False)
+
+@app.route("/healthz", methods=['GET'])
+def healthz():
+    status_code, body = health_probes.snapshot()
+    return body, status_code
+
+# --- 每個 worker 各自啟動的背景元件 (gunicorn.conf.py 的 post_worker_init；沒有使用該設定時由第一個請求啟動) ---
+WORKER_LIFECYCLE.on_start(event_consumer.start) # 重啟前未處理完的事件也會被取出處理
+WORKER_LIFECYCLE.on_start(health_probes.start)
+WORKER_LIFECYCLE.on_stop(lambda: event_consumer.stop(timeout=10))
+WORKER_LIFECYCLE.on_stop(health_probes.stop)
+if profiler is not None:
+    WORKER_LIFECYCLE.on_start(profiler.start)
+    WORKER_LIFECYCLE.on_stop(profiler.stop)
+
+@app.before_request
+def ensure_worker_started():
+    WORKER_LIFECYCLE.ensure_started()
+
+# --- 主程式進入點 (正式環境使用 gunicorn -c gunicorn.conf.py app:app) ---
 if __name__ == "__main__":
-    init_db()
-    port = int(os.environ.get("PORT", 5000))
-    app.run(host="0.0.0.0", port=port)
-else:
-     init_db() # 確保 Gunicorn 啟動時也初始化 DB
+    if MIGRATE_ON_START:
+        try: run_migrations()
+        except Exception as e: app.logger.error(f"無法初始化資料庫資料表: {e}")
+    WORKER_LIFECYCLE.ensure_started()
+    app.run(host="0.0.0.0", port=PORT)
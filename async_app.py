@@ -0,0 +1,463 @@
+"""
+非同步模式進入點：Starlette + uvicorn、AsyncOpenAI、共用的 httpx.AsyncClient (搜尋抓取與 LINE API) 與 asyncpg。
+事件處理流程與 app.py 相同 (共用 bot_logic.py)，但整條熱路徑都不佔用 OS 執行緒，單一程序即可同時處理大量對話。
+啟動方式: uvicorn async_app:app --host 0.0.0.0 --port $PORT
+資料庫遷移：MIGRATE_ON_START (預設開啟) 時在 lifespan 啟動時執行 (gunicorn master 已執行過則略過)；設為 0 時須先執行 python migrate.py。
+"""
+import time
+import base64
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+import httpx
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+from linebot import SignatureValidator
+from linebot.exceptions import InvalidSignatureError
+from linebot.models import MessageEvent, TextMessage, TextSendMessage, ImageMessage, ImageSendMessage
+from openai import AsyncOpenAI, APIError, AuthenticationError
+
+from bot_logic import (
+    MAX_HISTORY_TURNS, IMAGE_GEN_MODEL, FETCH_HEADERS, FETCH_TIMEOUT, TEXT_SUMMARY_CHARS, MAX_FETCH_BYTES, FETCH_CHUNK_BYTES,
+    webhook_event_rows, parse_image_gen_prompt, needs_auto_search, build_search_url, new_html_extractor, decode_text_prefix, format_web_info,
+    build_time_note, build_user_content, pick_model,
+    ai_error_reply, new_history_messages,
+    new_event_queue, new_event_queue_gate, new_ai_limiter, new_prompt_builder, new_history_cache, new_search_cache, new_image_preprocessor, new_image_store, new_profiler
+)
+from settings import (
+    LINE_CHANNEL_ACCESS_TOKEN, LINE_CHANNEL_SECRET, GROK_API_KEY, DATABASE_URL, XAI_API_BASE_URL, LINE_API_ENDPOINT, LINE_DATA_ENDPOINT,
+    ASYNC_MAX_INFLIGHT, ASYNC_QUEUE_SIZE, ASYNC_HTTP_MAX_CONNECTIONS, AI_MAX_CONCURRENCY_ASYNC,
+    STREAM_RESPONSES, STREAM_CHUNK_CHARS, STREAM_CHUNK_SECONDS, STREAM_MAX_EARLY_PUSHES,
+    DB_POOL_MIN, DB_POOL_MAX_ASYNC, HISTORY_RETAIN_MESSAGES, HISTORY_PRUNE_EVERY, GENERATED_IMAGE_MAX_BYTES,
+    HEALTH_PROBE_INTERVAL, HEALTH_PROBE_TIMEOUT, METRICS_TOKEN, PORT
+)
+from event_queue import AsyncEventQueueConsumer, QueueFullError
+from ai_limiter import AsyncAiLimiter, LocalRateLimitError
+from metrics import REGISTRY, CONTENT_TYPE, STAGE_SECONDS, stage, record_error, register_cache_stats, access_allowed
+from image_pipeline import ImageTooLargeError, ImageProcessingError
+from generated_images import IMAGE_ROUTE_PREFIX, IMMUTABLE_CACHE_CONTROL
+from streaming import StreamChunker, astream_deltas
+from async_history_store import create_async_history_repository
+from lifecycle import AsyncHealthProbes
+from migrate import run_migrations, migrations_pending
+
+# --- 基本設定 (環境變數集中在 settings.py，與 app.py 共用) ---
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger("async_app")
+
+channel_access_token = LINE_CHANNEL_ACCESS_TOKEN
+channel_secret = LINE_CHANNEL_SECRET
+grok_api_key = (GROK_API_KEY or "").strip()
+
+if not all([channel_access_token, channel_secret, grok_api_key]):
+    logger.error("錯誤：必要的環境變數 (LINE Token, Grok/xAI API Key) 未完整設定！")
+    raise SystemExit(1)
+if not DATABASE_URL:
+    logger.error("錯誤：DATABASE_URL 未設定！")
+    raise SystemExit(1)
+
+signature_validator = SignatureValidator(channel_secret)
+image_preprocessor = new_image_preprocessor()
+# 不受執行緒限制，同時呼叫數從上限的 1/4 開始依延遲往上調整
+ai_limiter = new_ai_limiter(AsyncAiLimiter, AI_MAX_CONCURRENCY_ASYNC, max(1, AI_MAX_CONCURRENCY_ASYNC // 4))
+image_store = new_image_store() # 未設定 PUBLIC_BASE_URL 時直接使用供應商網址
+prompt_builder = new_prompt_builder()
+LINE_HEADERS = {"Authorization": f"Bearer {channel_access_token}"}
+
+
+class _State:
+    """lifespan 期間建立的共用資源"""
+    http = None        # httpx.AsyncClient：搜尋抓取 + LINE API
+    ai_client = None   # AsyncOpenAI
+    history_repo = None
+    history_cache = None
+    search_cache = None
+    event_consumer = None
+    event_queue_stats = {}  # /metrics 抓取時在 worker thread 更新 (Postgres 查詢不佔用 event loop)
+
+
+state = _State()
+
+
+# --- LINE Messaging API (直接以 httpx 呼叫，不經過同步 SDK) ---
+async def line_push(user_id, messages):
+    with stage("line_push"):
+        response = await state.http.post(
+            f"{LINE_API_ENDPOINT}/v2/bot/message/push", headers=LINE_HEADERS,
+            json={"to": user_id, "messages": [m.as_json_dict() for m in messages]}
+        )
+        response.raise_for_status()
+
+
+async def line_get_content(message_id, max_bytes):
+    """串流下載使用者傳送的內容，超過 max_bytes 即中斷 (拋出 ImageTooLargeError)"""
+    async with state.http.stream("GET", f"{LINE_DATA_ENDPOINT}/v2/bot/message/{message_id}/content", headers=LINE_HEADERS) as response:
+        response.raise_for_status()
+        buf = bytearray()
+        async for chunk in response.aiter_bytes():
+            if len(buf) + len(chunk) > max_bytes:
+                raise ImageTooLargeError(f"圖片超過 {max_bytes} bytes")
+            buf += chunk
+    return bytes(buf)
+
+
+async def generate_image_bytes(user_id, prompt):
+    """呼叫圖片生成 API 並下載結果 (供 image_store 快取/重新託管)"""
+    response = await ai_limiter.call(user_id, IMAGE_GEN_MODEL, lambda: state.ai_client.images.generate(model=IMAGE_GEN_MODEL, prompt=prompt, n=1))
+    item = response.data[0]
+    if getattr(item, "b64_json", None): return base64.b64decode(item.b64_json)
+    if not item.url: raise ValueError("圖片生成 API 未返回有效 URL")
+    async with state.http.stream("GET", item.url, timeout=FETCH_TIMEOUT, follow_redirects=True) as response:
+        response.raise_for_status()
+        buf = bytearray()
+        async for chunk in response.aiter_bytes():
+            if len(buf) + len(chunk) > GENERATED_IMAGE_MAX_BYTES:
+                raise ImageTooLargeError(f"生成圖片超過 {GENERATED_IMAGE_MAX_BYTES} bytes")
+            buf += chunk
+    return bytes(buf)
+
+
+# --- 網頁內容/搜尋結果獲取函數 ---
+async def fetch_and_extract_text(url):
+    """非同步版 fetch_and_extract_text：串流下載，摘要額度滿了或超過 MAX_FETCH_BYTES 即停止"""
+    try:
+        logger.info(f"開始獲取 URL 內容: {url}")
+        with stage("web_fetch"):
+            async with state.http.stream("GET", url, headers=FETCH_HEADERS, timeout=FETCH_TIMEOUT, follow_redirects=True) as response:
+                response.raise_for_status()
+                content_type = response.headers.get('content-type', '').lower()
+                if 'html' in content_type:
+                    extractor = new_html_extractor(url, content_type); read_bytes = 0; parse_seconds = 0.0
+                    async for chunk in response.aiter_bytes(FETCH_CHUNK_BYTES):
+                        read_bytes += len(chunk); parse_start = time.perf_counter()
+                        done = extractor.feed(chunk); parse_seconds += time.perf_counter() - parse_start
+                        if done or read_bytes >= MAX_FETCH_BYTES: break
+                    parse_start = time.perf_counter(); summary = extractor.summary()
+                    STAGE_SECONDS.observe(parse_seconds + time.perf_counter() - parse_start, "html_parse") # 解析時間 (web_fetch 含下載與解析)
+                    logger.info(f"成功獲取並解析 HTML ({extractor.backend}): {url}, 讀取 {read_bytes} bytes, 摘要長度: {len(summary)}")
+                    return summary if summary else "無法從 HTML 中提取有效文字摘要。"
+                elif 'text' in content_type:
+                    raw = b""
+                    async for chunk in response.aiter_bytes(FETCH_CHUNK_BYTES):
+                        raw += chunk
+                        if len(raw) >= TEXT_SUMMARY_CHARS * 4: break # UTF-8 每字最多 4 bytes
+                    content = decode_text_prefix(raw, content_type)
+                    logger.info(f"成功獲取純文字: {url}, 長度: {len(content)}")
+                    return content
+                logger.warning(f"URL: {url} 的內容類型不支援 ({content_type})")
+                return f"獲取失敗：無法處理的內容類型 ({content_type})"
+    except httpx.TimeoutException: logger.error(f"獲取 URL 超時: {url}"); return "獲取失敗：請求超時"
+    except httpx.HTTPError as e: logger.error(f"獲取 URL 內容失敗: {url}, Error: {e}"); return f"獲取失敗：{str(e)}"
+    except Exception as e: logger.error(f"處理 URL 獲取時未知錯誤: {url}, Error: {e}", exc_info=True); return f"處理 URL 獲取時發生錯誤：{str(e)}"
+
+
+# --- 呼叫 AI (一次取得完整回覆 / 串流) ---
+async def complete_once(user_id, prompt_messages, target_model):
+    try:
+        grok_start = time.time()
+        with stage("ai_call"):
+            chat_completion = await ai_limiter.call(user_id, target_model, lambda: state.ai_client.chat.completions.create(
+                messages=prompt_messages, model=target_model, temperature=0.7, max_tokens=1500
+            ))
+        final_response = chat_completion.choices[0].message.content.strip()
+        logger.info(f"xAI Grok ({target_model}) 回應成功，用時 {time.time() - grok_start:.2f} 秒。")
+        return final_response
+    except Exception as e:
+        level, final_response = ai_error_reply(e)
+        logger.log(level, f"xAI Grok ({target_model}) 呼叫失敗: {type(e).__name__}: {e}", exc_info=not isinstance(e, (APIError, LocalRateLimitError)))
+        return final_response
+
+
+async def push_texts(user_id, texts):
+    try:
+        await line_push(user_id, [TextSendMessage(text=t) for t in texts])
+    except Exception as e:
+        logger.error(f"推送訊息錯誤: {e}")
+
+
+async def stream_and_push(user_id, prompt_messages, target_model):
+    """串流呼叫 AI，句子完整的段落先推送，結束後推送剩餘內容；回傳完整回覆 (存入歷史用)"""
+    chunker = StreamChunker(min_chars=STREAM_CHUNK_CHARS, max_wait=STREAM_CHUNK_SECONDS, max_early_chunks=STREAM_MAX_EARLY_PUSHES)
+    parts = []; error_reply = None; grok_start = time.time(); first_token_time = None
+    attempt_first_token = None # 這次呼叫送出到收到首個 token 的秒數 (給 AIMD 的壅塞訊號，不含生成與推送 LINE 的時間)
+
+    async def _stream():  # 整段串流都在限流名額內進行；已經推送過內容就不重試
+        nonlocal first_token_time, attempt_first_token
+        attempt_start = time.time()
+        stream = await state.ai_client.chat.completions.create(
+            messages=prompt_messages, model=target_model, temperature=0.7, max_tokens=1500, stream=True
+        )
+        async for delta in astream_deltas(stream):
+            if first_token_time is None:
+                first_token_time = time.time() - grok_start; STAGE_SECONDS.observe(first_token_time, "ai_first_token")
+                attempt_first_token = time.time() - attempt_start
+                logger.info(f"xAI Grok ({target_model}) 首個 token 用時 {first_token_time:.2f} 秒。")
+            parts.append(delta)
+            for chunk in chunker.add(delta): await push_texts(user_id, [chunk])
+
+    try:
+        with stage("ai_stream"): await ai_limiter.call(
+            user_id, target_model, _stream, should_retry=lambda: not parts, latency_fn=lambda result, elapsed: attempt_first_token
+        )
+        logger.info(f"xAI Grok ({target_model}) 串流完成，用時 {time.time() - grok_start:.2f} 秒，提早推送 {chunker.early_chunks} 段。")
+        if not parts: error_reply = "抱歉，AI 沒有回應任何內容。"
+    except Exception as e:
+        level, error_reply = ai_error_reply(e)
+        logger.log(level, f"xAI Grok ({target_model}) 串流失敗: {type(e).__name__}: {e}", exc_info=not isinstance(e, (APIError, LocalRateLimitError)))
+    for group in chunker.finish(extra=error_reply): await push_texts(user_id, group)
+    full_text = "".join(parts).strip()
+    if error_reply: return f"{full_text}\n{error_reply}" if full_text else error_reply
+    return full_text
+
+
+# --- 事件處理 (對應 app.py 的 process_and_push) ---
+async def process_event(user_id, event):
+    start_process_time = time.time()
+    image_data_b64 = None; image_mime = "image/jpeg"
+    image_gen_prompt = None
+
+    if isinstance(event.message, TextMessage):
+        user_text_original = event.message.text
+        image_gen_prompt = parse_image_gen_prompt(user_text_original)
+    elif isinstance(event.message, ImageMessage):
+        try:
+            with stage("image_download"): image_bytes = await line_get_content(event.message.id, image_preprocessor.max_input_bytes)
+            with stage("image_preprocess"): prepared = await asyncio.to_thread(image_preprocessor.process, image_bytes) # 解碼/編碼吃 CPU，不佔用 event loop
+            image_data_b64 = prepared.b64; image_mime = prepared.mime; user_text_original = "[圖片描述請求]"
+        except ImageTooLargeError as e:
+            logger.warning(f"圖片訊息 {event.message.id} 過大: {e}"); user_text_original = "[圖片過大無法處理]"
+        except ImageProcessingError as e:
+            logger.warning(f"圖片訊息 {event.message.id} 無法處理: {e}"); user_text_original = "[處理使用者圖片時出錯]"
+        except Exception as e:
+            logger.error(f"處理圖片訊息 {event.message.id} 時出錯: {e}", exc_info=True); user_text_original = "[處理使用者圖片時出錯]"
+    else:
+        return
+
+    # --- 處理圖片生成 ---
+    if image_gen_prompt is not None:
+        try:
+            if image_store is not None:
+                with stage("image_generate"): image_name, cached = await image_store.aget_or_generate(image_gen_prompt, lambda: generate_image_bytes(user_id, image_gen_prompt))
+                original_url, preview_url = image_store.urls(image_name)
+                reply = ImageSendMessage(original_content_url=original_url, preview_image_url=preview_url)
+            else:
+                with stage("image_generate"): response = await ai_limiter.call(user_id, IMAGE_GEN_MODEL, lambda: state.ai_client.images.generate(model=IMAGE_GEN_MODEL, prompt=image_gen_prompt, n=1))
+                image_url = response.data[0].url
+                if image_url: reply = ImageSendMessage(original_content_url=image_url, preview_image_url=image_url)
+                else: logger.error("圖片生成 API 未返回有效 URL。"); reply = TextSendMessage(text="抱歉，圖片生成失敗 (未收到URL)。")
+        except AuthenticationError as e: logger.error(f"圖片生成認證錯誤: {e}"); reply = TextSendMessage(text="圖片生成服務認證失敗。")
+        except LocalRateLimitError as e: logger.warning(f"圖片生成被限流: {e}"); reply = TextSendMessage(text=ai_error_reply(e)[1])
+        except Exception as e: logger.error(f"圖片生成時發生錯誤: {e}", exc_info=True); reply = TextSendMessage(text=f"抱歉，圖片生成時發生錯誤: {type(e).__name__}")
+        try: await line_push(user_id, [reply])
+        except Exception as e: logger.error(f"推送圖片生成結果時出錯: {e}")
+        return
+
+    # --- 處理文字或圖片描述 ---
+    try:
+        history = state.history_cache.get(user_id)
+        if history is None:
+            with stage("history_load"): history = await state.history_repo.load(user_id, MAX_HISTORY_TURNS * 2)
+            state.history_cache.put(user_id, history)
+    except Exception as db_err:
+        logger.error(f"讀取歷史錯誤: {db_err}", exc_info=True); history = []
+
+    web_info_for_llm = None
+    if image_data_b64 is None and needs_auto_search(user_text_original):
+        with stage("search"): search_result_summary = await state.search_cache.aget_or_fetch(user_text_original, lambda: fetch_and_extract_text(build_search_url(user_text_original)))
+        web_info_for_llm = format_web_info(user_text_original, search_result_summary)
+
+    target_model = pick_model(image_data_b64)
+    with stage("prompt_build"):
+        prompt_messages, prompt_info = prompt_builder.build(
+            target_model, history, build_user_content(user_text_original, image_data_b64, image_mime),
+            context_notes=[build_time_note()], web_info=web_info_for_llm
+        )
+    if prompt_info["dropped_messages"] or prompt_info["truncated"]:
+        logger.info(f"提示估計 {prompt_info['estimated_tokens']}/{prompt_info['budget']} tokens，捨棄 {prompt_info['dropped_messages']} 則較早的歷史，截斷: {prompt_info['truncated']}")
+    if STREAM_RESPONSES:
+        final_response = await stream_and_push(user_id, prompt_messages, target_model)
+    else:
+        final_response = await complete_once(user_id, prompt_messages, target_model)
+
+    try:
+        new_messages = new_history_messages(user_text_original, final_response)
+        with stage("history_save"): await state.history_repo.append(user_id, new_messages)
+        state.history_cache.append(user_id, new_messages)
+    except Exception as db_err:
+        logger.error(f"儲存歷史錯誤 for user {user_id}: {type(db_err).__name__} - {db_err}", exc_info=True)
+        state.history_cache.invalidate(user_id)
+
+    if not STREAM_RESPONSES: # 串流模式已推送過
+        await push_texts(user_id, [final_response])
+    STAGE_SECONDS.observe(time.time() - start_process_time, "process_total")
+    logger.info(f"任務完成，用時 {time.time() - start_process_time:.2f} 秒。")
+
+
+async def handle_queued_event(user_id, payload):
+    try:
+        await process_event(user_id, MessageEvent.new_from_json_dict(payload))
+    except Exception as e:
+        record_error("process", e)
+        raise
+
+
+# 事件先寫入持久化佇列 (重啟不遺失、重送去重)，由 lifespan 啟動的 consumer 取出處理
+event_queue = new_event_queue()
+event_queue_gate = new_event_queue_gate(event_queue) # 未處理事件達到 EVENT_QUEUE_MAX_PENDING 時 /callback 回 503
+
+
+# --- LINE Webhook ---
+async def callback(request):
+    """驗證簽名後只把事件寫入持久化佇列就回 200"""
+    with stage("callback"):
+        signature = request.headers.get('X-Line-Signature', '')
+        body = (await request.body()).decode('utf-8')
+        if not signature_validator.validate(body, signature):
+            record_error("callback", InvalidSignatureError())
+            logger.error("簽名錯誤。")
+            return PlainTextResponse("Invalid signature", status_code=400)
+        rows = webhook_event_rows(body)
+        if rows:
+            try:
+                with stage("callback_enqueue"): inserted = await asyncio.to_thread(event_queue_gate.enqueue_many, rows)
+            except QueueFullError as e:
+                record_error("callback", e)
+                logger.warning(f"{e}，回 503 讓 LINE 稍後重送。")
+                return PlainTextResponse("Busy", status_code=503)
+            state.event_consumer.notify()
+            if inserted < len(rows): logger.info(f"略過 {len(rows) - inserted} 個重送的事件。")
+    return PlainTextResponse('OK')
+
+
+async def serve_generated_image(request):
+    """生成圖片 (原圖與預覽圖；內容定址，可永久快取)"""
+    name = request.path_params["name"]
+    headers = {"ETag": f'"{name}"', "Cache-Control": IMMUTABLE_CACHE_CONTROL}
+    if image_store is None:
+        return PlainTextResponse("Not Found", status_code=404)
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    data, content_type = await asyncio.to_thread(image_store.read, name)
+    if data is None:
+        return PlainTextResponse("Not Found", status_code=404)
+    return Response(data, media_type=content_type, headers=headers)
+
+
+# --- 量測 (/metrics：Prometheus 文字格式；PROFILER_ENABLED=1 時另有 /debug/profile) ---
+def _pool_checked_out():
+    stats = state.history_repo.stats()
+    return stats["size"] - stats["idle"]
+
+
+register_cache_stats("history", lambda: state.history_cache.stats())
+register_cache_stats("search", lambda: state.search_cache.stats(), ("hits", "stale_hits", "misses", "coalesced"))
+register_cache_stats("image_preprocess", image_preprocessor.stats)
+if image_store is not None: register_cache_stats("generated_image", image_store.stats, ("hits", "misses", "coalesced"))
+REGISTRY.gauge_callback("linebot_event_queue_events", "事件佇列中各狀態的事件數", lambda: {k: v for k, v in state.event_queue_stats.items() if k != "backend"}, ["status"])
+REGISTRY.gauge_callback("linebot_event_queue_depth", "事件佇列中待處理 + 處理中的事件數", lambda: event_queue_gate.depth)
+REGISTRY.counter_callback("linebot_event_queue_rejected_total", "佇列已滿而回 503 的 webhook 數", lambda: event_queue_gate.rejected)
+REGISTRY.gauge_callback("linebot_dispatcher_events", "worker 的待處理/處理中事件數", lambda: {k: v for k, v in state.event_consumer.dispatcher.stats().items() if k in ("pending", "active")}, ["state"])
+REGISTRY.gauge_callback("linebot_db_pool_connections", "DB 連線池借出中的連線數", _pool_checked_out)
+REGISTRY.gauge_callback("linebot_db_pool_open_connections", "DB 連線池目前開啟的連線數", lambda: state.history_repo.stats()["size"])
+REGISTRY.gauge_callback("linebot_ai_concurrency", "xAI 呼叫的同時數/上限/排隊數", lambda: {k: v for k, v in ai_limiter.stats().items() if k in ("inflight", "limit", "waiting")}, ["state"])
+REGISTRY.counter_callback("linebot_ai_limiter_events_total", "xAI 限流事件數", lambda: {k: v for k, v in ai_limiter.stats().items() if k in ("calls", "throttled", "retries", "rejected")}, ["event"])
+REGISTRY.gauge_callback("linebot_asyncio_tasks", "event loop 上的 task 數", lambda: len(asyncio.all_tasks()))
+
+profiler = new_profiler()
+
+
+def metrics_access_allowed(request):
+    """METRICS_TOKEN 不符 (或未設定時非本機連線) 時呼叫端回 404，不透露端點存在"""
+    return access_allowed(METRICS_TOKEN, request.headers.get("authorization"), request.client.host if request.client else None)
+
+
+async def metrics(request):
+    if not metrics_access_allowed(request):
+        return PlainTextResponse("Not Found", status_code=404)
+    try: state.event_queue_stats = await asyncio.to_thread(event_queue.stats); await asyncio.to_thread(event_queue_gate.refresh)
+    except Exception as e: logger.warning(f"讀取事件佇列統計失敗: {e}")
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+
+async def debug_profile(request):
+    """取樣 profiler 累計的 folded stacks (?reset=1 讀取後清空)；asyncio 模式下主要看 event loop 執行緒被什麼佔住"""
+    if profiler is None or not metrics_access_allowed(request):
+        return PlainTextResponse("Not Found", status_code=404)
+    return PlainTextResponse(profiler.folded(top=int(request.query_params.get("top", "200")), reset=request.query_params.get("reset") == "1"))
+
+
+# --- 健康檢查 (背景探測並快取結果；/healthz 不做網路呼叫) ---
+health_probes = AsyncHealthProbes(interval=HEALTH_PROBE_INTERVAL, timeout=HEALTH_PROBE_TIMEOUT)
+
+
+async def probe_database():
+    await state.history_repo.ping()
+
+
+async def probe_event_queue():
+    stats = await asyncio.to_thread(event_queue.stats)
+    state.event_queue_stats = stats
+    return f"{stats['backend']} pending={stats.get('pending', 0)} processing={stats.get('processing', 0)}"
+
+
+async def probe_xai():
+    """取代啟動時的模型列表測試 (xAI 變慢不再卡住啟動；失敗只標記 degraded)"""
+    try: models = await state.ai_client.with_options(timeout=health_probes.timeout).models.list()
+    except AuthenticationError: logger.error(f"!!! xAI API Key 測試 (模型列表) 失敗: 認證錯誤 (401)! 請確認 API Key 對 {XAI_API_BASE_URL} 有效。"); raise
+    return f"{len(models.data)} 個模型: {[m.id for m in models.data[:5]]}"
+
+
+health_probes.add("database", probe_database)
+health_probes.add("event_queue", probe_event_queue)
+health_probes.add("xai", probe_xai, critical=False)
+
+
+async def healthz(request):
+    status_code, body = health_probes.snapshot()
+    return JSONResponse(body, status_code=status_code)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    limits = httpx.Limits(max_connections=ASYNC_HTTP_MAX_CONNECTIONS, max_keepalive_connections=ASYNC_HTTP_MAX_CONNECTIONS // 4)
+    state.http = httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(30.0, connect=10.0))
+    state.ai_client = AsyncOpenAI(api_key=grok_api_key, base_url=XAI_API_BASE_URL, timeout=httpx.Timeout(60.0, connect=10.0), max_retries=0)
+    state.history_repo = create_async_history_repository(DATABASE_URL, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX_ASYNC, retain_messages=HISTORY_RETAIN_MESSAGES, prune_every=HISTORY_PRUNE_EVERY)
+    state.history_cache = new_history_cache(use_redis=False) # 不使用 Redis (同步 client 會卡住 event loop)
+    state.search_cache = new_search_cache()
+    if migrations_pending(): # 直接以 uvicorn 啟動時沒有 gunicorn 的 on_starting，在這裡建立資料表
+        try: await asyncio.to_thread(run_migrations)
+        except Exception as e: logger.error(f"無法初始化資料庫資料表: {type(e).__name__}: {e}")
+    await state.history_repo.open()
+    state.event_consumer = AsyncEventQueueConsumer(
+        event_queue, handle_queued_event, concurrency=ASYNC_MAX_INFLIGHT, max_pending=ASYNC_QUEUE_SIZE, name="line-async"
+    )
+    state.event_consumer.start()
+    health_probes.start()
+    if profiler is not None: profiler.start()
+    logger.info("非同步模式啟動完成。")
+    try:
+        yield
+    finally:
+        if profiler is not None: profiler.stop()
+        await health_probes.stop()
+        await state.event_consumer.stop()
+        await state.ai_client.close()
+        await state.http.aclose()
+        await state.history_repo.close()
+
+
+app = Starlette(routes=[
+    Route("/callback", callback, methods=["POST"]),
+    Route(IMAGE_ROUTE_PREFIX + "/{name}", serve_generated_image, methods=["GET"]),
+    Route("/metrics", metrics, methods=["GET"]),
+    Route("/healthz", healthz, methods=["GET"]),
+    Route("/debug/profile", debug_profile, methods=["GET"]),
+], lifespan=lifespan)
+
+# 正式環境: GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker gunicorn -c gunicorn.conf.py async_app:app
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=PORT)
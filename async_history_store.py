@@ -0,0 +1,120 @@
+"""對話歷史存取層 (asyncpg 版，給 async_app.py 使用)：SQL 與 history_store.py 共用"""
+import asyncio
+import logging
+
+import asyncpg
+
+from history_store import (
+    SCHEMA_SQL, MIGRATE_LEGACY_SQL, PRUNE_SQL_TEMPLATE, SELECT_RECENT_SQL, SQLITE_URL_PREFIX, PRUNE_EVERY,
+    PruneSchedule, SqliteHistoryRepository, clean_content
+)
+
+logger = logging.getLogger(__name__)
+
+# asyncpg 不支援 execute_values，改用 unnest 一次插入多列 (依陣列順序產生 seq)
+INSERT_MESSAGES_UNNEST_SQL = (
+    "INSERT INTO conversation_messages (user_id, role, content, tokens) "
+    "SELECT * FROM unnest($1::text[], $2::text[], $3::text[], $4::int[])"
+)
+PRUNE_SQL = PRUNE_SQL_TEMPLATE.format(users="$1::text[]", keep="$2")
+
+
+class AsyncHistoryRepository:
+    """conversation_messages 的非同步存取介面；asyncpg 會自動為每條連線快取 prepared statement"""
+
+    def __init__(self, dsn, minconn=1, maxconn=10, retain_messages=200, prune_every=PRUNE_EVERY):
+        self.dsn = dsn
+        self.minconn = max(0, int(minconn))
+        self.maxconn = max(1, int(maxconn))
+        self.retain_messages = int(retain_messages)
+        self.prune_schedule = PruneSchedule(prune_every)
+        self._pool = None
+
+    async def open(self):
+        self._pool = await asyncpg.create_pool(self.dsn, min_size=self.minconn, max_size=self.maxconn)
+        logger.info(f"asyncpg 連線池建立完成 (min={self.minconn}, max={self.maxconn})。")
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    async def init_schema(self):
+        """檢查並建立 conversation_messages 資料表，並搬移舊版 conversation_history 資料"""
+        async with self._pool.acquire() as conn:
+            await conn.execute(SCHEMA_SQL)
+            if await conn.fetchval("SELECT to_regclass('conversation_history');") is not None:
+                status = await conn.execute(MIGRATE_LEGACY_SQL)
+                moved = int(status.split()[-1])
+                if moved:
+                    logger.info(f"已從 conversation_history 搬移 {moved} 則歷史訊息到 conversation_messages。")
+        logger.info("資料庫資料表 'conversation_messages' 初始化完成。")
+
+    async def load(self, user_id, limit):
+        """讀取使用者最近 limit 則訊息 (由舊到新)"""
+        async with self._pool.acquire() as conn:
+            rows = await conn.fetch(SELECT_RECENT_SQL, user_id, int(limit))
+        return [{"role": r["role"], "content": r["content"], "tokens": r["tokens"]} for r in rows]
+
+    async def append(self, user_id, messages):
+        """新增訊息 (一次 INSERT 多列)；每 prune_every 次寫入順便清掉超過保留數量的舊訊息"""
+        roles = [m["role"] for m in messages]
+        contents = [clean_content(m["content"]) for m in messages]
+        tokens = [m.get("tokens") for m in messages]
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(INSERT_MESSAGES_UNNEST_SQL, [user_id] * len(messages), roles, contents, tokens)
+                if self.retain_messages > 0 and self.prune_schedule.due([user_id]):
+                    await conn.execute(PRUNE_SQL, [user_id], self.retain_messages)
+
+    async def ping(self):
+        async with self._pool.acquire() as conn:
+            await conn.fetchval("SELECT 1")
+
+    def stats(self):
+        if self._pool is None:
+            return {"minconn": self.minconn, "maxconn": self.maxconn, "size": 0, "idle": 0}
+        return {
+            "minconn": self.minconn,
+            "maxconn": self.maxconn,
+            "size": self._pool.get_size(),
+            "idle": self._pool.get_idle_size(),
+        }
+
+
+class AsyncSqliteHistoryRepository:
+    """SqliteHistoryRepository 的非同步包裝 (在 worker thread 執行)：本機開發與 benchmark.py 使用"""
+
+    def __init__(self, path, minconn=1, maxconn=10, retain_messages=200, prune_every=PRUNE_EVERY):
+        self.minconn = max(0, int(minconn))
+        self.maxconn = max(1, int(maxconn))
+        self._repo = SqliteHistoryRepository(path, minconn=minconn, maxconn=maxconn, retain_messages=retain_messages, prune_every=prune_every)
+
+    async def open(self):
+        pass  # 第一次使用時才連線
+
+    async def close(self):
+        await asyncio.to_thread(self._repo.close)
+
+    async def init_schema(self):
+        await asyncio.to_thread(self._repo.init_schema)
+
+    async def load(self, user_id, limit):
+        return await asyncio.to_thread(self._repo.load, user_id, limit)
+
+    async def append(self, user_id, messages):
+        await asyncio.to_thread(self._repo.append, user_id, messages)
+
+    async def ping(self):
+        await asyncio.to_thread(self._repo.ping)
+
+    def stats(self):
+        stats = self._repo.stats()
+        return {"minconn": self.minconn, "maxconn": self.maxconn, "size": stats["open"], "idle": stats["open"] - stats["checked_out"]}
+
+
+def create_async_history_repository(dsn, **kwargs):
+    """DATABASE_URL 為 sqlite:///路徑 時使用 SQLite，否則使用 asyncpg 連線池"""
+    if dsn.startswith(SQLITE_URL_PREFIX):
+        return AsyncSqliteHistoryRepository(dsn[len(SQLITE_URL_PREFIX):], **kwargs)
+    return AsyncHistoryRepository(dsn, **kwargs)
@@ -0,0 +1,452 @@
+"""
+離線壓力測試：啟動 fake_services.py 的替代服務與待測的 app (子程序)，以固定速率重播帶簽名的 webhook 到 /callback，
+回報 webhook 回應延遲、端到端延遲 (送出 webhook 到最後一次 push) 的 p50/p99、吞吐量，
+以及 app 程序 (含子程序) 的峰值執行緒數、峰值 RSS 與 DB 連線數 (/metrics)。
+預設使用拋棄式的 SQLite 歷史資料庫 (DATABASE_URL=sqlite:///...)，--database-url 可改用本機 PostgreSQL。
+結果可存成 JSON，之後以 --baseline 比較每次效能調整的差異。
+
+    python benchmark.py --rate 20 --duration 30 --json before.json
+    python benchmark.py --rate 20 --duration 30 --baseline before.json --env DISPATCH_WORKERS=16
+    python benchmark.py --app-cmd "uvicorn async_app:app --port {port}" --stream
+
+替代服務沒有額度限制，因此預設把 AI_MODEL_RPM / IMAGE_GEN_MODEL_RPM 調高 (可用 --env 覆寫)。
+"""
+import os
+import sys
+import hmac
+import json
+import math
+import time
+import base64
+import shlex
+import socket
+import hashlib
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from fake_services import REPLY_FILLER, REPLY_END_MARKER, add_service_arguments, create_from_args
+
+logger = logging.getLogger("benchmark")
+
+CHAT_TEXTS = ("幫我想一個週末的行程", "用三句話解釋相對論", "推薦幾本適合入門的程式書")
+SEARCH_TEXTS = ("今天的新聞", "最新的股價", "台北今天天氣")  # 包含自動搜尋關鍵字
+FILLER_CHARS = frozenset(REPLY_FILLER)
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(sorted_values, p):
+    """nearest-rank 百分位數"""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, math.ceil(p * len(sorted_values) / 100) - 1))
+    return sorted_values[index]
+
+
+def sign(body, secret):
+    return base64.b64encode(hmac.new(secret.encode("utf-8"), body, hashlib.sha256).digest()).decode("ascii")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def build_webhook(seq, run_id, user_id, kind, search_queries):
+    """單一訊息事件的 webhook 內容；訊息 id 含 run_id，重複執行時不會被事件佇列當成重送"""
+    message_id = f"{run_id}{seq:08d}"
+    if kind == "image":
+        message = {"id": message_id, "type": "image", "contentProvider": {"type": "line"}}
+    elif kind == "search":
+        query = seq % search_queries
+        message = {"id": message_id, "type": "text", "text": f"{SEARCH_TEXTS[query % len(SEARCH_TEXTS)]} {query}"}
+    else:
+        message = {"id": message_id, "type": "text", "text": f"{CHAT_TEXTS[seq % len(CHAT_TEXTS)]} #{seq}"}
+    event = {
+        "type": "message", "mode": "active", "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": user_id}, "webhookEventId": f"BENCH{message_id}",
+        "deliveryContext": {"isRedelivery": False}, "replyToken": f"bench-{message_id}", "message": message,
+    }
+    return json.dumps({"destination": "Ubench", "events": [event]}, ensure_ascii=False).encode("utf-8")
+
+
+class CompletionTracker:
+    """
+    把 push 對應回事件：同一位使用者的事件依序處理 (KeyedDispatcher)，所以每位使用者的待完成事件是 FIFO。
+    含 REPLY_END_MARKER 的 push 表示 AI 回覆完成；全部由模擬回覆文字組成的 push 是串流中途的段落，不算完成；
+    其他 push (錯誤訊息，或串流中斷後剩餘內容 + 錯誤訊息) 也算完成但記為失敗。
+    """
+
+    def __init__(self):
+        self._lock = threading.Condition()
+        self._pending = {}   # user_id -> deque[[seq, sent_at]]
+        self.outstanding = 0
+        self.latencies = []
+        self.ok = 0
+        self.failed = 0
+        self.unmatched_pushes = 0
+        self.last_completion = None
+
+    def sent(self, seq, user_id, sent_at):
+        with self._lock:
+            self._pending.setdefault(user_id, deque()).append([seq, sent_at])
+            self.outstanding += 1
+
+    def cancel(self, seq, user_id):
+        """webhook 沒有被接受 (非 200)，不會有 push"""
+        with self._lock:
+            pending = self._pending.get(user_id, ())
+            for entry in pending:
+                if entry[0] == seq:
+                    pending.remove(entry)
+                    self.outstanding -= 1
+                    self._lock.notify_all()
+                    return
+
+    def on_push(self, user_id, messages, received_at):
+        texts = [m.get("text", "") for m in messages if m.get("type") == "text"]
+        finished = any(REPLY_END_MARKER in t for t in texts)
+        if not finished and texts and all(set(t.strip()) <= FILLER_CHARS for t in texts):
+            return  # 串流中途的段落
+        with self._lock:
+            pending = self._pending.get(user_id)
+            if not pending:
+                self.unmatched_pushes += 1
+                return
+            _, sent_at = pending.popleft()
+            self.latencies.append(received_at - sent_at)
+            if finished or any(m.get("type") == "image" for m in messages):
+                self.ok += 1
+            else:
+                self.failed += 1
+            self.outstanding -= 1
+            self.last_completion = received_at
+            self._lock.notify_all()
+
+    def wait_all(self, timeout):
+        with self._lock:
+            return self._lock.wait_for(lambda: self.outstanding <= 0, timeout)
+
+
+class ResourceSampler:
+    """定期讀取 /proc 取得 app 程序樹的執行緒數與 RSS，並抓 /metrics 的 DB 連線數"""
+
+    def __init__(self, pid, metrics_url, interval=0.25, pg_dsn=None, headers=None):
+        self.pid = pid
+        self.metrics_url = metrics_url
+        self.headers = headers or {}
+        self.interval = interval
+        self.pg_dsn = pg_dsn
+        self.peak = {"threads": 0, "rss_mb": 0.0, "db_open_connections": 0, "db_checked_out": 0, "pg_connections": 0}
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="resource-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+
+    def _process_tree(self):
+        children = {}
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                try:
+                    with open(f"/proc/{entry}/stat") as f:
+                        ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+                    children.setdefault(ppid, []).append(int(entry))
+                except (OSError, IndexError, ValueError):
+                    continue
+        tree, stack = [], [self.pid]
+        while stack:
+            pid = stack.pop()
+            tree.append(pid)
+            stack.extend(children.get(pid, ()))
+        return tree
+
+    def _sample_proc(self):
+        threads, rss_kb = 0, 0
+        for pid in self._process_tree():
+            try:
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith("Threads:"):
+                            threads += int(line.split()[1])
+                        elif line.startswith("VmRSS:"):
+                            rss_kb += int(line.split()[1])
+            except OSError:
+                continue
+        self._update("threads", threads)
+        self._update("rss_mb", round(rss_kb / 1024, 1))
+
+    def _sample_metrics(self):
+        try:
+            values = parse_metrics(requests.get(self.metrics_url, headers=self.headers, timeout=2).text)
+        except requests.RequestException:
+            return
+        self._update("db_open_connections", int(values.get("linebot_db_pool_open_connections", 0)))
+        self._update("db_checked_out", int(values.get("linebot_db_pool_connections", 0)))
+
+    def _sample_postgres(self):
+        import psycopg2
+        conn = psycopg2.connect(self.pg_dsn)
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT count(*) - 1 FROM pg_stat_activity WHERE datname = current_database()")  # 不含這條查詢連線
+                self._update("pg_connections", cur.fetchone()[0])
+        finally:
+            conn.close()
+
+    def _update(self, key, value):
+        self.peak[key] = max(self.peak[key], value)
+
+    def _loop(self):
+        has_proc = os.path.isdir("/proc")
+        ticks = 0
+        while not self._stopping.wait(self.interval):
+            if has_proc:
+                self._sample_proc()
+            if ticks % 4 == 0:
+                self._sample_metrics()
+                if self.pg_dsn:
+                    try:
+                        self._sample_postgres()
+                    except Exception as e:
+                        logger.warning(f"讀取 pg_stat_activity 失敗: {e}")
+                        self.pg_dsn = None
+            ticks += 1
+
+
+def parse_metrics(text):
+    """Prometheus 文字格式 -> {name{labels}: value} (只取數值行)"""
+    values = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            key, _, value = line.rpartition(" ")
+            try:
+                values[key] = float(value)
+            except ValueError:
+                continue
+    return values
+
+
+def stage_summary(metrics_values):
+    """linebot_stage_seconds 各階段的次數與平均秒數"""
+    stages = {}
+    for key, value in metrics_values.items():
+        for suffix in ("_sum", "_count"):
+            prefix = f"linebot_stage_seconds{suffix}{{stage=\""
+            if key.startswith(prefix):
+                stages.setdefault(key[len(prefix):-2], {})[suffix[1:]] = value
+    return {
+        name: {"count": int(v.get("count", 0)), "mean_ms": round(v["sum"] / v["count"] * 1000, 1) if v.get("count") else None}
+        for name, v in sorted(stages.items())
+    }
+
+
+def start_app(args, fake_url, workdir, port):
+    env = dict(os.environ)
+    for key in ("RENDER_EXTERNAL_URL", "PUBLIC_BASE_URL", "REDIS_URL", "SEARCH_CACHE_PATH"):
+        env.pop(key, None)  # 不寫入真實的共用服務
+    env.update({
+        "PORT": str(port), "LINE_CHANNEL_ACCESS_TOKEN": "bench-token", "LINE_CHANNEL_SECRET": args.channel_secret,
+        "GROK_API_KEY": "bench-key", "XAI_API_BASE_URL": f"{fake_url}/v1",
+        "LINE_API_ENDPOINT": fake_url, "LINE_DATA_ENDPOINT": fake_url, "SEARCH_URL_TEMPLATE": f"{fake_url}/html/?q={{query}}",
+        "DATABASE_URL": args.database_url or f"sqlite:///{os.path.join(workdir, 'history.db')}",
+        "EVENT_QUEUE_PATH": os.path.join(workdir, "event_queue.db"), "GENERATED_IMAGE_DIR": os.path.join(workdir, "generated_images"),
+        "STREAM_RESPONSES": "1" if args.stream else "0", "AI_MODEL_RPM": "1000000", "IMAGE_GEN_MODEL_RPM": "1000000",
+    })
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    command = shlex.split(args.app_cmd.format(port=port, python=shlex.quote(sys.executable)))
+    log = open(os.path.join(workdir, "app.log"), "wb")
+    logger.info(f"啟動 app: {' '.join(command)} (log: {log.name})")
+    return subprocess.Popen(command, cwd=APP_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def metrics_headers(args):
+    """app 設定了 METRICS_TOKEN (環境變數或 --env) 時 /metrics 需要帶 token；本機啟動的 app 沒設定時不需要"""
+    token = dict(item.partition("=")[::2] for item in args.env).get("METRICS_TOKEN", os.environ.get("METRICS_TOKEN"))
+    return {"Authorization": f"Bearer {token}"} if token else {}
+
+
+def wait_ready(url, process, timeout, headers=None):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"app 在啟動時結束 (exit code {process.returncode})")
+        try:
+            if requests.get(url, headers=headers, timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"app 在 {timeout} 秒內沒有就緒: {url}")
+
+
+def replay(args, target, tracker, run_id):
+    """開放迴路 (open loop)：依排程送出，不等前一個回應；回傳 (webhook 回應延遲, 非 200 次數, 實際送出秒數)"""
+    total = args.events or int(args.rate * args.duration)
+    users = args.users or total
+    local = threading.local()
+    ack_latencies, rejected = [], [0]
+    lock = threading.Lock()
+
+    def kind_of(seq):
+        r = (seq * 7919 % 1000) / 1000  # 固定的分布，每次執行相同
+        if r < args.image_ratio:
+            return "image"
+        return "search" if r < args.image_ratio + args.search_ratio else "chat"
+
+    def send(seq):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()  # 每個送出執行緒一個 keep-alive 連線
+        session = local.session
+        user_id = f"Ubench{seq % users:08d}"
+        body = build_webhook(seq, run_id, user_id, kind_of(seq), args.search_queries)
+        headers = {"Content-Type": "application/json", "X-Line-Signature": sign(body, args.channel_secret)}
+        sent_at = time.time()
+        tracker.sent(seq, user_id, sent_at)
+        try:
+            status = session.post(f"{target}/callback", data=body, headers=headers, timeout=30).status_code
+        except requests.RequestException:
+            status = None
+        with lock:
+            ack_latencies.append(time.time() - sent_at)
+            if status != 200:
+                rejected[0] += 1
+        if status != 200:
+            tracker.cancel(seq, user_id)
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=args.senders, thread_name_prefix="sender") as pool:
+        for seq in range(total):
+            delay = start + seq / args.rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(send, seq)
+    return ack_latencies, rejected[0], time.time() - start, start
+
+
+def summarize(values):
+    values = sorted(values)
+    ms = lambda v: round(v * 1000, 1) if v is not None else None
+    return {"p50_ms": ms(percentile(values, 50)), "p99_ms": ms(percentile(values, 99)), "max_ms": ms(values[-1] if values else None)}
+
+
+def print_report(report, baseline=None):
+    def flatten(data, prefix=""):
+        for key, value in data.items():
+            if isinstance(value, dict):
+                yield from flatten(value, f"{prefix}{key}.")
+            else:
+                yield f"{prefix}{key}", value
+
+    base = dict(flatten(baseline)) if baseline else {}
+    for key, value in flatten(report):
+        line = f"{key:<45} {value}"
+        old = base.get(key)
+        if isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+            line += f"   (baseline {old}, {(value - old) / old * 100:+.1f}%)"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="以本機替代服務對 LINE bot 做離線壓力測試")
+    parser.add_argument("--rate", type=float, default=10, help="每秒送出的 webhook 數")
+    parser.add_argument("--duration", type=float, default=30, help="送出的秒數 (與 --events 擇一)")
+    parser.add_argument("--events", type=int, default=0, help="總事件數 (預設 rate * duration)")
+    parser.add_argument("--users", type=int, default=0, help="不同使用者數 (預設每個事件一位使用者)")
+    parser.add_argument("--image-ratio", type=float, default=0.1, help="圖片訊息比例 (vision)")
+    parser.add_argument("--search-ratio", type=float, default=0.2, help="觸發自動搜尋的文字訊息比例")
+    parser.add_argument("--search-queries", type=int, default=20, help="不同搜尋字串的數量 (影響搜尋快取命中率)")
+    parser.add_argument("--stream", action="store_true", help="app 使用串流回覆 (STREAM_RESPONSES=1)")
+    parser.add_argument("--senders", type=int, default=64, help="送出 webhook 的執行緒數")
+    parser.add_argument("--app-cmd", default="{python} app.py", help="啟動 app 的指令 ({port}/{python} 會被替換)")
+    parser.add_argument("--target", help="改對已在執行的 app 送出 (不啟動子程序；該 app 需指向 --fake-port 的替代服務)")
+    parser.add_argument("--fake-port", type=int, default=0, help="替代服務的 port (預設自動選擇)")
+    parser.add_argument("--database-url", help="歷史資料庫 (預設拋棄式 SQLite；PostgreSQL 時另外回報 pg_stat_activity 連線數)")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="額外傳給 app 的環境變數 (可重複)")
+    parser.add_argument("--channel-secret", default="bench-secret")
+    parser.add_argument("--startup-timeout", type=float, default=60)
+    parser.add_argument("--drain-timeout", type=float, default=120, help="送完後等待處理完成的秒數")
+    parser.add_argument("--json", help="把結果存成 JSON")
+    parser.add_argument("--baseline", help="與先前存下的 JSON 結果比較")
+    add_service_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    tracker = CompletionTracker()
+    fake = create_from_args(args, port=args.fake_port, on_push=tracker.on_push).start()
+    logger.info(f"替代服務: {fake.base_url}")
+    workdir = tempfile.mkdtemp(prefix="linebot-bench-")
+    process = None
+    if args.target:
+        target = args.target.rstrip("/")
+    else:
+        port = free_port()
+        target = f"http://127.0.0.1:{port}"
+        process = start_app(args, fake.base_url, workdir, port)
+    sampler = None
+    headers = metrics_headers(args)
+    try:
+        wait_ready(f"{target}/metrics", process, args.startup_timeout, headers=headers)
+        pg_dsn = args.database_url if args.database_url and args.database_url.startswith("postgres") else None
+        if process is not None:
+            sampler = ResourceSampler(process.pid, f"{target}/metrics", pg_dsn=pg_dsn, headers=headers).start()
+        run_id = str(int(time.time()))
+        logger.info(f"開始送出 webhook: {target}/callback")
+        ack_latencies, rejected, send_seconds, started = replay(args, target, tracker, run_id)
+        drained = tracker.wait_all(args.drain_timeout)
+        if not drained:
+            logger.warning(f"等待 {args.drain_timeout} 秒後仍有 {tracker.outstanding} 個事件未完成。")
+        final_metrics = parse_metrics(requests.get(f"{target}/metrics", headers=headers, timeout=5).text)
+    finally:
+        if sampler is not None:
+            sampler.stop()
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        fake.stop()
+
+    completed = tracker.ok + tracker.failed
+    elapsed = (tracker.last_completion or time.time()) - started
+    report = {
+        "config": {
+            "rate": args.rate, "events": len(ack_latencies), "stream": args.stream, "app_cmd": args.app_cmd if not args.target else args.target,
+            "xai_latency": args.xai_latency, "xai_error_rate": args.xai_error_rate, "line_error_rate": args.line_error_rate,
+        },
+        "webhook": {"rejected": rejected, **summarize(ack_latencies)},
+        "end_to_end": {"completed": completed, "ok": tracker.ok, "error_replies": tracker.failed, "incomplete": tracker.outstanding, **summarize(tracker.latencies)},
+        "throughput_per_s": round(completed / elapsed, 2) if elapsed > 0 else None,
+        "send_seconds": round(send_seconds, 2),
+        "resources": dict(sampler.peak) if sampler is not None else {},
+        "stages": stage_summary(final_metrics),
+        "fake_services": fake.stats(),
+    }
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    logger.info(f"app log 與拋棄式資料庫: {workdir}")
+
+
+if __name__ == "__main__":
+    main()
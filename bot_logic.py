@@ -0,0 +1,219 @@
+"""同步 (app.py / Flask) 與非同步 (async_app.py) 兩種進入點共用的事件處理邏輯：設定、觸發判斷、提示組合、錯誤回覆、依設定建立共用元件"""
+import json
+import logging
+import datetime
+from urllib.parse import quote_plus
+
+import settings
+from settings import SEARCH_URL_TEMPLATE
+from html_extract import HtmlSummaryExtractor, charset_from_content_type, is_search_results_url
+from prompt_builder import PromptBuilder, with_token_estimate
+from event_queue import create_event_queue, QueueDepthGate
+from history_cache import create_history_cache
+from search_cache import SearchCache
+from image_pipeline import ImagePreprocessor
+from generated_images import GeneratedImageStore, create_image_backend
+from metrics import SamplingProfiler
+
+from openai import RateLimitError, APIConnectionError, AuthenticationError, APITimeoutError, APIStatusError
+from ai_limiter import LocalRateLimitError
+
+# --- 共用設定 ---
+TAIWAN_TZ = datetime.timezone(datetime.timedelta(hours=8)) # 設定時區為台灣時間 (UTC+8)
+MAX_HISTORY_TURNS = 20 # 最多讀取的歷史輪數；實際送出多少由 token 預算決定 (見 prompt_builder.py)
+SEARCH_KEYWORDS = ["天氣", "新聞", "股價", "今日", "今天", "最新", "誰是", "什麼是", "介紹", "查詢", "搜尋"] # 自動搜尋關鍵字 (可擴充)
+IMAGE_GEN_TRIGGER_HALF = "畫一張:" # 半形冒號
+IMAGE_GEN_TRIGGER_FULL = "畫一張：" # 全形冒號
+TEXT_MODEL = "grok-3-mini-beta"
+VISION_MODEL = "grok-vision-beta" # 請確認這是你可用的視覺模型 ID
+IMAGE_GEN_MODEL = "grok-2-image-1212" # 請確認這是你可用的圖片生成模型 ID
+FETCH_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept-Language': 'en-US,en;q=0.9,zh-TW;q=0.8,zh;q=0.7',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8',
+}
+FETCH_TIMEOUT = 15 # 秒
+HTML_SUMMARY_CHARS = 2500
+TEXT_SUMMARY_CHARS = 3000
+MAX_FETCH_BYTES = 1024 * 1024 # 單一網頁最多下載的位元組數 (摘要額度通常在這之前就滿了)
+FETCH_CHUNK_BYTES = 16 * 1024
+
+
+# --- Webhook 事件 ---
+HANDLED_MESSAGE_TYPES = ("text", "image")
+
+
+def webhook_event_rows(body):
+    """
+    從 webhook 內容取出要處理的事件 (文字/圖片訊息)，回傳 [(dedupe_key, user_id, event_json), ...] 寫入事件佇列。
+    dedupe_key 以訊息 id 為主 (LINE 重送時相同)，沒有時用 webhookEventId。
+    """
+    rows = []
+    for event in json.loads(body).get("events", []):
+        message = event.get("message") or {}
+        user_id = (event.get("source") or {}).get("userId")
+        if event.get("type") != "message" or message.get("type") not in HANDLED_MESSAGE_TYPES or not user_id:
+            continue
+        dedupe_key = f"message:{message['id']}" if message.get("id") else f"event:{event.get('webhookEventId')}"
+        rows.append((dedupe_key, user_id, json.dumps(event, ensure_ascii=False)))
+    return rows
+
+
+# --- 觸發判斷 ---
+def parse_image_gen_prompt(text):
+    """若為「畫一張:」(半形或全形冒號) 指令，回傳提示文字；否則回傳 None"""
+    cleaned_text = text.strip()
+    for trigger in (IMAGE_GEN_TRIGGER_HALF, IMAGE_GEN_TRIGGER_FULL):
+        if cleaned_text.startswith(trigger):
+            return cleaned_text[len(trigger):].strip()
+    return None
+
+
+def needs_auto_search(text):
+    """是否包含自動搜尋關鍵字"""
+    return any(keyword in text for keyword in SEARCH_KEYWORDS)
+
+
+def build_search_url(query):
+    return SEARCH_URL_TEMPLATE.format(query=quote_plus(query))
+
+
+# --- 網頁內容 ---
+def new_html_extractor(url, content_type):
+    """建立串流 HTML 摘要器；DuckDuckGo 結果頁解析成結構化的 (標題, 網址, 摘要)"""
+    structured = is_search_results_url(url) or url.startswith(SEARCH_URL_TEMPLATE.split("{query}", 1)[0])
+    return HtmlSummaryExtractor(HTML_SUMMARY_CHARS, charset=charset_from_content_type(content_type), structured=structured)
+
+
+def decode_text_prefix(raw, content_type):
+    """純文字內容：依 charset 解碼並截到 TEXT_SUMMARY_CHARS 字"""
+    charset = charset_from_content_type(content_type) or "utf-8"
+    try:
+        return raw.decode(charset, errors="replace")[:TEXT_SUMMARY_CHARS]
+    except LookupError:
+        return raw.decode("utf-8", errors="replace")[:TEXT_SUMMARY_CHARS]
+
+
+def is_fetch_failure(summary):
+    """fetch_and_extract_text 回傳的是否為失敗訊息 (失敗結果不寫入搜尋快取)"""
+    return not summary or summary.startswith(("獲取失敗", "處理 URL 獲取時發生錯誤"))
+
+
+def format_web_info(query, search_result_summary):
+    """把搜尋結果 (或失敗訊息) 包成給 AI 的系統提示"""
+    if search_result_summary and not search_result_summary.startswith("獲取失敗"):
+        return f"為了回答 '{query}'，進行了網路搜尋，摘要如下:\n```\n{search_result_summary}\n```\n\n"
+    return f"嘗試自動搜尋 '{query}' 失敗:{search_result_summary}。"
+
+
+# --- 提示組合 ---
+def build_time_note(now_utc=None):
+    """目前時間提示 (每次都不同，放在固定系統提示與歷史之後，不影響 prompt cache)"""
+    now_utc = now_utc or datetime.datetime.now(datetime.timezone.utc)
+    current_time_str = now_utc.astimezone(TAIWAN_TZ).strftime("%Y年%m月%d日 %H:%M:%S")
+    return f"目前時間是 {current_time_str} (台灣 UTC+8)。"
+
+
+def build_user_content(user_text, image_data_b64=None, image_mime="image/jpeg"):
+    """目前這則使用者訊息的 content (文字或圖片描述請求；圖片已由 image_pipeline 縮圖壓縮)"""
+    if image_data_b64:
+        return [
+            {"type": "text", "text": "請描述這張圖片的內容。"},
+            {"type": "image_url", "image_url": {"url": f"data:{image_mime};base64,{image_data_b64}"}},
+        ]
+    return [{"type": "text", "text": user_text}]
+
+
+def pick_model(image_data_b64):
+    return VISION_MODEL if image_data_b64 else TEXT_MODEL
+
+
+# --- 錯誤回覆 ---
+def ai_error_reply(e):
+    """把 AI API 例外轉成 (log 等級, 給使用者的回覆)"""
+    if isinstance(e, AuthenticationError): return logging.ERROR, "抱歉，AI 服務鑰匙錯誤。"
+    if isinstance(e, RateLimitError): return logging.WARNING, "抱歉，大腦過熱。"
+    if isinstance(e, LocalRateLimitError): return logging.WARNING, "目前使用的人太多了，請稍後再試一次。"
+    if isinstance(e, APITimeoutError): return logging.WARNING, "抱歉，思考超時。" # APITimeoutError 是 APIConnectionError 的子類別，需先判斷
+    if isinstance(e, APIConnectionError): return logging.ERROR, "抱歉，AI 無法連線。"
+    if isinstance(e, APIStatusError): return logging.ERROR, "抱歉，AI 服務異常。"
+    return logging.ERROR, "抱歉，系統發生錯誤。"
+
+
+def new_history_messages(user_text, final_response):
+    """本輪要存入歷史的兩則訊息 (附上估算的 token 數，存入資料庫後組合提示時不必重算)"""
+    return [with_token_estimate({"role": "user", "content": user_text}), with_token_estimate({"role": "assistant", "content": final_response})]
+
+
+# --- 依設定 (settings.py) 建立共用元件：兩個進入點共用，不在這裡建立連線或執行緒 ---
+def new_event_queue():
+    return create_event_queue(
+        settings.EVENT_QUEUE_BACKEND, path=settings.EVENT_QUEUE_PATH, dsn=settings.DATABASE_URL, lease_seconds=settings.EVENT_QUEUE_LEASE_SECONDS,
+        max_attempts=settings.EVENT_QUEUE_MAX_ATTEMPTS, retention=settings.EVENT_QUEUE_RETENTION,
+        maxconn=settings.EVENT_QUEUE_POOL_MAX, checkout_timeout=settings.EVENT_QUEUE_POOL_TIMEOUT
+    )
+
+
+def new_event_queue_gate(queue):
+    return QueueDepthGate(queue, settings.EVENT_QUEUE_MAX_PENDING)
+
+
+def new_ai_limiter(limiter_cls, max_concurrency, initial_concurrency):
+    """limiter_cls 為 AiLimiter 或 AsyncAiLimiter"""
+    return limiter_cls(
+        user_rpm=settings.AI_USER_RPM, user_burst=settings.AI_USER_BURST, default_model_rpm=settings.AI_MODEL_RPM,
+        model_rpm={IMAGE_GEN_MODEL: settings.IMAGE_GEN_MODEL_RPM},
+        max_concurrency=max_concurrency, initial_concurrency=initial_concurrency, target_latency=settings.AI_TARGET_LATENCY,
+        max_wait=settings.AI_MAX_WAIT, max_retries=settings.AI_MAX_RETRIES
+    )
+
+
+def new_prompt_builder():
+    return PromptBuilder(
+        {TEXT_MODEL: settings.TEXT_MODEL_PROMPT_TOKENS, VISION_MODEL: settings.VISION_MODEL_PROMPT_TOKENS}, default_budget=settings.TEXT_MODEL_PROMPT_TOKENS
+    )
+
+
+def new_history_cache(use_redis=True):
+    """use_redis=False：非同步模式 (同步的 Redis client 會卡住 event loop)"""
+    return create_history_cache(
+        MAX_HISTORY_TURNS * 2, redis_url=settings.REDIS_URL if use_redis else None,
+        max_entries=settings.HISTORY_CACHE_MAX_ENTRIES, max_bytes=settings.HISTORY_CACHE_MAX_BYTES, ttl=settings.HISTORY_CACHE_TTL,
+        processes=settings.WEB_CONCURRENCY
+    )
+
+
+def new_search_cache():
+    return SearchCache(
+        max_bytes=settings.SEARCH_CACHE_MAX_BYTES, disk_path=settings.SEARCH_CACHE_PATH,
+        is_cacheable=lambda summary: not is_fetch_failure(summary)
+    )
+
+
+def new_image_preprocessor():
+    return ImagePreprocessor(
+        max_edge=settings.IMAGE_MAX_EDGE, target_bytes=settings.IMAGE_TARGET_BYTES, output_format=settings.IMAGE_OUTPUT_FORMAT,
+        max_input_bytes=settings.IMAGE_MAX_INPUT_BYTES, cache_entries=settings.IMAGE_CACHE_ENTRIES
+    )
+
+
+def new_image_store():
+    """沒有對外網址 (PUBLIC_BASE_URL / RENDER_EXTERNAL_URL) 時回傳 None"""
+    if not settings.PUBLIC_BASE_URL:
+        return None
+    return GeneratedImageStore(
+        create_image_backend(
+            settings.GENERATED_IMAGE_DIR, s3_bucket=settings.IMAGE_S3_BUCKET, s3_prefix=settings.IMAGE_S3_PREFIX,
+            s3_endpoint_url=settings.IMAGE_S3_ENDPOINT_URL, s3_region=settings.IMAGE_S3_REGION
+        ),
+        settings.PUBLIC_BASE_URL, preview_edge=settings.IMAGE_PREVIEW_EDGE, cache_ttl=settings.GENERATED_IMAGE_CACHE_TTL,
+        cache_max_entries=settings.GENERATED_IMAGE_CACHE_MAX_ENTRIES, cache_max_bytes=settings.GENERATED_IMAGE_CACHE_MAX_BYTES,
+        max_storage_bytes=settings.GENERATED_IMAGE_STORE_MAX_BYTES, max_age=settings.GENERATED_IMAGE_MAX_AGE
+    )
+
+
+def new_profiler():
+    """PROFILER_ENABLED=1 時回傳 SamplingProfiler，否則 None"""
+    if not settings.PROFILER_ENABLED:
+        return None
+    return SamplingProfiler(interval=settings.PROFILER_INTERVAL)
@@ -0,0 +1,176 @@
+"""事件分派器：固定數量的工作執行緒 + 有上限的待處理佇列，同一個 key (user_id) 的事件依序處理"""
+import asyncio
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class KeyedDispatcher:
+    """
+    以固定數量的 worker 執行 handler_fn(key, *args)。
+    - 佇列總長度上限為 max_pending，滿了 submit() 直接回傳 False (由呼叫端決定如何降載)
+    - 同一個 key 同時最多只有一個 worker 在處理，其餘依送入順序排隊
+    - 不同 key 之間輪流取用，避免單一使用者洗版時餓死其他人
+    """
+
+    def __init__(self, handler_fn, workers=8, max_pending=200, name="dispatcher"):
+        self.handler_fn = handler_fn
+        self.workers = max(1, int(workers))
+        self.max_pending = max(1, int(max_pending))
+        self.name = name
+        self._cond = threading.Condition()
+        self._per_key = {}          # key -> deque[args]，只記錄有待處理事件或正在處理的 key
+        self._ready = deque()       # 有待處理事件、且目前沒有 worker 在處理的 key
+        self._active = set()        # 正在處理中的 key
+        self._pending = 0
+        self._threads = []
+        self._started = False
+        self._stopping = False
+
+    # --- 對外介面 ---
+    def submit(self, key, *args):
+        """送入一個事件；佇列已滿時回傳 False"""
+        with self._cond:
+            if self._stopping:
+                return False
+            if self._pending >= self.max_pending:
+                return False
+            if not self._started:
+                self._start_locked()
+            items = self._per_key.get(key)
+            if items is None:
+                items = self._per_key[key] = deque()
+            items.append(args)
+            self._pending += 1
+            if key not in self._active and len(items) == 1:
+                self._ready.append(key)
+            self._cond.notify()
+            return True
+
+    def stats(self):
+        """回傳目前狀態 (待處理數、處理中數、worker 數)"""
+        with self._cond:
+            return {
+                "pending": self._pending,
+                "active": len(self._active),
+                "workers": self.workers,
+                "max_pending": self.max_pending,
+            }
+
+    def stop(self, timeout=None):
+        """停止接收新事件，處理完已排隊的事件後結束所有 worker"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            threads = list(self._threads)
+        for t in threads:
+            t.join(timeout)
+
+    # --- 內部實作 ---
+    def _start_locked(self):
+        # 延遲到第一次 submit 才啟動執行緒，避免 gunicorn fork 前就建立執行緒
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker_loop, name=f"{self.name}-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        self._started = True
+
+    def _next_locked(self):
+        while not self._ready:
+            if self._stopping and self._pending == 0:
+                return None
+            self._cond.wait()
+        key = self._ready.popleft()
+        args = self._per_key[key].popleft()
+        self._active.add(key)
+        return key, args
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                job = self._next_locked()
+                if job is None:
+                    self._cond.notify_all()
+                    return
+            key, args = job
+            try:
+                self.handler_fn(key, *args)
+            except Exception as e:
+                logger.error(f"{self.name} 處理 key={key} 時發生未捕捉錯誤: {type(e).__name__}: {e}", exc_info=True)
+            finally:
+                with self._cond:
+                    self._active.discard(key)
+                    self._pending -= 1
+                    if self._per_key[key]:
+                        self._ready.append(key)  # 同 key 還有事件，排到隊尾讓其他 key 先跑
+                        self._cond.notify()
+                    else:
+                        del self._per_key[key]
+                    if self._stopping and self._pending == 0:
+                        self._cond.notify_all()
+
+
+class AsyncKeyedDispatcher:
+    """
+    KeyedDispatcher 的 asyncio 版本 (給 async_app.py 使用)：
+    每個有待處理事件的 key 對應一個 task 依序處理；全域同時處理數由 semaphore 限制，待處理總數上限為 max_pending。
+    """
+
+    def __init__(self, handler_fn, concurrency=1000, max_pending=5000, name="async-dispatcher"):
+        self.handler_fn = handler_fn  # async def handler_fn(key, *args)
+        self.concurrency = max(1, int(concurrency))
+        self.max_pending = max(1, int(max_pending))
+        self.name = name
+        self._sem = asyncio.Semaphore(self.concurrency)
+        self._per_key = {}  # key -> deque[args]，第一個元素是正在處理 (或等待 semaphore) 的事件
+        self._tasks = set()
+        self._pending = 0
+        self._active = 0
+
+    def submit(self, key, *args):
+        """送入一個事件 (必須在 event loop 中呼叫)；佇列已滿時回傳 False"""
+        if self._pending >= self.max_pending:
+            return False
+        items = self._per_key.get(key)
+        self._pending += 1
+        if items is not None:
+            items.append(args)
+            return True
+        self._per_key[key] = deque([args])
+        task = asyncio.get_running_loop().create_task(self._drain(key), name=f"{self.name}-{key}")
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    def stats(self):
+        return {
+            "pending": self._pending,
+            "active": self._active,
+            "workers": self.concurrency,
+            "max_pending": self.max_pending,
+        }
+
+    async def stop(self):
+        """等待所有已排隊的事件處理完畢"""
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    async def _drain(self, key):
+        items = self._per_key[key]
+        try:
+            while items:
+                args = items[0]
+                async with self._sem:
+                    self._active += 1
+                    try:
+                        await self.handler_fn(key, *args)
+                    except Exception as e:
+                        logger.error(f"{self.name} 處理 key={key} 時發生未捕捉錯誤: {type(e).__name__}: {e}", exc_info=True)
+                    finally:
+                        self._active -= 1
+                items.popleft()
+                self._pending -= 1
+        finally:
+            del self._per_key[key]
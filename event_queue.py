@@ -0,0 +1,558 @@
+"""
+Webhook 事件的持久化佇列：/callback 驗證簽名後只把原始事件寫入佇列就回 200，由背景 consumer 取出交給 dispatcher 處理。
+- 程序重啟/重新部署時，尚未處理完的事件仍在佇列中 (處理中的事件在租約到期後會被重新取出)
+- 以 dedupe_key (訊息 id / webhookEventId) 去重：LINE 重送的同一個事件只處理一次
+- 後端：SQLite (WAL) 檔案 或 Postgres 資料表 (多台機器/重新部署後檔案不保留時使用)
+- 待處理的事件超過上限時 /callback 回 503 (QueueDepthGate)，佇列不會在 xAI 或資料庫變慢時無限增長
+"""
+import json
+import time
+import asyncio
+import logging
+import sqlite3
+import threading
+from collections import namedtuple
+
+from dispatcher import KeyedDispatcher, AsyncKeyedDispatcher
+
+logger = logging.getLogger(__name__)
+
+QueuedEvent = namedtuple("QueuedEvent", ["id", "user_id", "payload", "attempts"])
+
+SETTLE_ATTEMPTS = 3  # ack/fail 寫入失敗時的嘗試次數 (都失敗時事件要等租約過期才會重新取出)
+SETTLE_RETRY_DELAY = 0.5
+
+
+class QueueTimeoutError(Exception):
+    """等待佇列的資料庫連線超時"""
+
+
+class QueueFullError(Exception):
+    """待處理 + 處理中的事件數已達上限"""
+
+SQLITE_SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS webhook_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    dedupe_key TEXT NOT NULL UNIQUE,
+    user_id TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    locked_until REAL,
+    last_error TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS webhook_events_status_idx ON webhook_events (status, id);
+CREATE INDEX IF NOT EXISTS webhook_events_user_idx ON webhook_events (user_id, id);
+"""
+
+POSTGRES_SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS webhook_events (
+    id BIGSERIAL PRIMARY KEY,
+    dedupe_key TEXT NOT NULL UNIQUE,
+    user_id TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at DOUBLE PRECISION NOT NULL,
+    locked_until DOUBLE PRECISION,
+    last_error TEXT,
+    created_at DOUBLE PRECISION NOT NULL
+);
+CREATE INDEX IF NOT EXISTS webhook_events_status_idx ON webhook_events (status, id);
+CREATE INDEX IF NOT EXISTS webhook_events_user_idx ON webhook_events (user_id, id);
+"""
+
+# 可取出的事件：待處理且已到重試時間，或處理中但租約已過期 (處理它的程序已經不在)。
+# 只取每位使用者最早一筆未完成的事件：前一筆處理中或等待重試時，後面的事件都不會被取出 (也不會被另一個程序取出)，
+# 維持每位使用者依序處理；一次取出也不會拿到同一位使用者的兩筆事件，不會有事件帶著租約在本機排隊。
+_CLAIMABLE_WHERE = (
+    "((w.status = 'pending' AND w.available_at <= {now}) OR (w.status = 'processing' AND w.locked_until < {now})) "
+    "AND NOT EXISTS (SELECT 1 FROM webhook_events o WHERE o.user_id = w.user_id AND o.id < w.id AND o.status IN ('pending', 'processing'))"
+)
+
+
+class SqliteEventQueue:
+    """SQLite WAL 檔案佇列 (同一台機器上的多個 gunicorn worker 可共用同一個檔案)"""
+
+    backend = "sqlite"
+
+    def __init__(self, path, lease_seconds=300, max_attempts=3, retry_delay=10, retention=86400):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.retention = retention  # 處理完的事件保留多久 (這段時間內的重送都能去重)
+        self._lock = threading.Lock()
+        self._connection = None  # 第一次使用時才開啟 (gunicorn preload 時不會把連線帶過 fork)
+
+    @property
+    def _conn(self):
+        if self._connection is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL") # WAL 下仍可在程序當掉時保留已提交的資料
+            conn.executescript(SQLITE_SCHEMA_SQL) # 本機檔案，每個程序開啟時確認即可
+            self._connection = conn
+        return self._connection
+
+    def init_schema(self):
+        """建立資料表 (migrate.py 呼叫)"""
+        with self._lock:
+            self._conn  # 開啟連線時即建立資料表
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def enqueue_many(self, rows):
+        """寫入 [(dedupe_key, user_id, payload_json), ...]，回傳實際新增數 (重複的 dedupe_key 會被略過)"""
+        now = time.time()
+        with self._lock:
+            cur = self._conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                before = self._conn.total_changes
+                cur.executemany(
+                    "INSERT OR IGNORE INTO webhook_events (dedupe_key, user_id, payload, available_at, created_at) VALUES (?, ?, ?, ?, ?)",
+                    [(key, user_id, payload, now, now) for key, user_id, payload in rows],
+                )
+                inserted = self._conn.total_changes - before
+                cur.execute("COMMIT")
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+        return inserted
+
+    def claim(self, limit):
+        """取出最多 limit 筆可處理的事件並標記為處理中 (租約 lease_seconds 秒)"""
+        now = time.time()
+        with self._lock:
+            cur = self._conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")  # 取得寫入鎖，避免其他程序取到同一批
+            try:
+                rows = cur.execute(
+                    f"SELECT w.id, w.user_id, w.payload, w.attempts FROM webhook_events w WHERE {_CLAIMABLE_WHERE.format(now='?')} ORDER BY w.id LIMIT ?",
+                    (now, now, int(limit)),
+                ).fetchall()
+                if rows:
+                    cur.executemany(
+                        "UPDATE webhook_events SET status = 'processing', locked_until = ?, attempts = attempts + 1 WHERE id = ?",
+                        [(now + self.lease_seconds, row[0]) for row in rows],
+                    )
+                cur.execute("COMMIT")
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+        return [QueuedEvent(id_, user_id, json.loads(payload), attempts + 1) for id_, user_id, payload, attempts in rows]
+
+    def renew(self, event_id, attempts):
+        """
+        worker 開始處理時重新起算租約。attempts 是取出時的嘗試次數 (每次取出都會加一)，用來確認事件沒有在租約過期後被重新取出；
+        回傳 False 表示事件已不屬於這次取出 (已被其他程序取走或處理完)，不應再處理。
+        """
+        with self._lock:
+            return self._conn.execute(
+                "UPDATE webhook_events SET locked_until = ? WHERE id = ? AND status = 'processing' AND attempts = ?",
+                (time.time() + self.lease_seconds, event_id, attempts),
+            ).rowcount == 1
+
+    def ack(self, event_id):
+        """處理完成 (保留一列供去重，清掉 payload)"""
+        with self._lock:
+            self._conn.execute("UPDATE webhook_events SET status = 'done', payload = '', locked_until = NULL WHERE id = ?", (event_id,))
+
+    def fail(self, event_id, attempts, error):
+        """處理失敗：未達 max_attempts 時延後重試，否則標記為 failed"""
+        status, available_at = self._retry_plan(attempts)
+        with self._lock:
+            self._conn.execute(
+                "UPDATE webhook_events SET status = ?, available_at = ?, locked_until = NULL, last_error = ? WHERE id = ?",
+                (status, available_at, str(error)[:500], event_id),
+            )
+
+    def release(self, event_id):
+        """取出後沒能交給 dispatcher：放回佇列 (不算一次嘗試)"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE webhook_events SET status = 'pending', locked_until = NULL, attempts = attempts - 1 WHERE id = ?", (event_id,)
+            )
+
+    def purge(self):
+        """刪除超過保留時間的已完成/失敗事件"""
+        with self._lock:
+            return self._conn.execute(
+                "DELETE FROM webhook_events WHERE status IN ('done', 'failed') AND created_at < ?", (time.time() - self.retention,)
+            ).rowcount
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._conn.execute("SELECT status, COUNT(*) FROM webhook_events GROUP BY status").fetchall())
+        return {"backend": self.backend, **counts}
+
+    def _retry_plan(self, attempts):
+        if attempts >= self.max_attempts:
+            return "failed", time.time()
+        return "pending", time.time() + self.retry_delay * attempts
+
+
+class PostgresEventQueue(SqliteEventQueue):
+    """
+    Postgres 資料表佇列 (多台機器共用；以 FOR UPDATE SKIP LOCKED 取出事件)。
+    連線池由 /callback 的請求執行緒、dispatcher worker、consumer 與健康檢查共用；
+    ThreadedConnectionPool 借不到連線時會直接丟錯，這裡和 history_store 一樣用 semaphore 排隊，最多等 checkout_timeout 秒。
+    """
+
+    backend = "postgres"
+
+    def __init__(self, dsn, maxconn=2, checkout_timeout=10.0, lease_seconds=300, max_attempts=3, retry_delay=10, retention=86400):
+        self.dsn = dsn
+        self.maxconn = max(1, int(maxconn))
+        self.checkout_timeout = checkout_timeout
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.maxconn)
+        self._pool = None  # 第一次使用時才建立連線池
+
+    def _get_pool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    from psycopg2.pool import ThreadedConnectionPool
+                    self._pool = ThreadedConnectionPool(1, self.maxconn, self.dsn)
+        return self._pool
+
+    def _run(self, fn):
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            raise QueueTimeoutError(f"等待事件佇列的資料庫連線超過 {self.checkout_timeout} 秒")
+        try:
+            import psycopg2
+            pool = self._get_pool()
+            conn = pool.getconn()
+            broken = False
+            try:
+                with conn:  # 成功時 commit，例外時 rollback
+                    with conn.cursor() as cur:
+                        return fn(cur)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                broken = True  # 連線本身壞掉，不放回池中
+                raise
+            finally:
+                pool.putconn(conn, close=broken or conn.closed)
+        finally:
+            self._slots.release()
+
+    def init_schema(self):
+        """建立資料表 (migrate.py 呼叫)"""
+        self._run(lambda cur: cur.execute(POSTGRES_SCHEMA_SQL))
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+
+    def enqueue_many(self, rows):
+        now = time.time()
+
+        def _insert(cur):
+            inserted = 0
+            for key, user_id, payload in rows:
+                cur.execute(
+                    "INSERT INTO webhook_events (dedupe_key, user_id, payload, available_at, created_at) VALUES (%s, %s, %s, %s, %s) "
+                    "ON CONFLICT (dedupe_key) DO NOTHING",
+                    (key, user_id, payload, now, now),
+                )
+                inserted += cur.rowcount
+            return inserted
+        return self._run(_insert)
+
+    def claim(self, limit):
+        now = time.time()
+
+        def _claim(cur):
+            cur.execute(
+                "WITH picked AS ("
+                f"SELECT w.id FROM webhook_events w WHERE {_CLAIMABLE_WHERE.format(now='%(now)s')} "
+                "ORDER BY w.id LIMIT %(limit)s FOR UPDATE OF w SKIP LOCKED) "
+                "UPDATE webhook_events e SET status = 'processing', locked_until = %(until)s, attempts = e.attempts + 1 "
+                "FROM picked WHERE e.id = picked.id RETURNING e.id, e.user_id, e.payload, e.attempts",
+                {"now": now, "limit": int(limit), "until": now + self.lease_seconds},
+            )
+            return cur.fetchall()
+        rows = sorted(self._run(_claim))  # RETURNING 不保證順序
+        return [QueuedEvent(id_, user_id, json.loads(payload), attempts) for id_, user_id, payload, attempts in rows]
+
+    def renew(self, event_id, attempts):
+        def _renew(cur):
+            cur.execute(
+                "UPDATE webhook_events SET locked_until = %s WHERE id = %s AND status = 'processing' AND attempts = %s",
+                (time.time() + self.lease_seconds, event_id, attempts),
+            )
+            return cur.rowcount == 1
+        return self._run(_renew)
+
+    def ack(self, event_id):
+        self._run(lambda cur: cur.execute(
+            "UPDATE webhook_events SET status = 'done', payload = '', locked_until = NULL WHERE id = %s", (event_id,)
+        ))
+
+    def fail(self, event_id, attempts, error):
+        status, available_at = self._retry_plan(attempts)
+        self._run(lambda cur: cur.execute(
+            "UPDATE webhook_events SET status = %s, available_at = %s, locked_until = NULL, last_error = %s WHERE id = %s",
+            (status, available_at, str(error)[:500], event_id),
+        ))
+
+    def release(self, event_id):
+        self._run(lambda cur: cur.execute(
+            "UPDATE webhook_events SET status = 'pending', locked_until = NULL, attempts = attempts - 1 WHERE id = %s", (event_id,)
+        ))
+
+    def purge(self):
+        def _purge(cur):
+            cur.execute("DELETE FROM webhook_events WHERE status IN ('done', 'failed') AND created_at < %s", (time.time() - self.retention,))
+            return cur.rowcount
+        return self._run(_purge)
+
+    def stats(self):
+        def _stats(cur):
+            cur.execute("SELECT status, COUNT(*) FROM webhook_events GROUP BY status")
+            return dict(cur.fetchall())
+        return {"backend": self.backend, **self._run(_stats)}
+
+
+def create_event_queue(backend=None, path="event_queue.db", dsn=None, maxconn=2, checkout_timeout=10.0, **kwargs):
+    """
+    backend 為 postgres 時使用 dsn 指向的資料庫 (連線池上限 maxconn)，否則使用 SQLite 檔案。
+    未指定時依 dsn 決定：DATABASE_URL 是 Postgres 就用 Postgres (Render 等平台重新部署會清掉本機檔案，佇列中的事件會遺失)。
+    """
+    if backend is None:
+        backend = "postgres" if dsn and dsn.startswith(("postgres://", "postgresql://")) else "sqlite"
+    if backend == "postgres":
+        return PostgresEventQueue(dsn, maxconn=maxconn, checkout_timeout=checkout_timeout, **kwargs)
+    return SqliteEventQueue(path, **kwargs)
+
+
+def _settle(fn, *args):
+    """寫回處理結果 (ack/fail)；暫時失敗時稍後重試，都失敗只記錄 log，不讓例外離開 worker"""
+    for attempt in range(1, SETTLE_ATTEMPTS + 1):
+        try:
+            fn(*args)
+            return True
+        except Exception as e:
+            logger.error(f"寫回佇列事件 {args[0]} 的處理結果失敗 (第 {attempt} 次): {type(e).__name__}: {e}")
+            if attempt < SETTLE_ATTEMPTS:
+                time.sleep(SETTLE_RETRY_DELAY * attempt)
+    return False
+
+
+class QueueDepthGate:
+    """
+    寫入前檢查佇列深度 (pending + processing)：達到 max_pending 時丟 QueueFullError，由 /callback 回 503 讓 LINE 稍後重送。
+    stats() 是整張表的 GROUP BY 計數，每 refresh_interval 秒最多查一次，其他請求使用上次的結果；depth 也給 /metrics 使用。
+    max_pending <= 0 時不限制 (也不查詢)。
+    """
+
+    def __init__(self, queue, max_pending, refresh_interval=1.0, clock=time.monotonic):
+        self.queue = queue
+        self.max_pending = int(max_pending)
+        self.refresh_interval = refresh_interval
+        self.clock = clock
+        self.depth = 0
+        self.rejected = 0
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """距上次查詢超過 refresh_interval 時重新查詢 (同時間只有一個執行緒查詢)，回傳目前的深度"""
+        now = self.clock()
+        if self._checked_at is not None and now - self._checked_at < self.refresh_interval:
+            return self.depth
+        if not self._lock.acquire(blocking=self._checked_at is None):
+            return self.depth  # 其他執行緒查詢中，先用上次的結果
+        try:
+            stats = self.queue.stats()
+            self.depth = stats.get("pending", 0) + stats.get("processing", 0)
+            self._checked_at = self.clock()
+        finally:
+            self._lock.release()
+        return self.depth
+
+    def enqueue_many(self, rows):
+        """檢查深度後寫入，回傳實際新增的事件數；佇列已滿時丟 QueueFullError"""
+        if self.max_pending > 0 and self.refresh() >= self.max_pending:
+            self.rejected += 1
+            raise QueueFullError(f"事件佇列已有 {self.depth} 個未處理事件 (上限 {self.max_pending})")
+        inserted = self.queue.enqueue_many(rows)
+        self.depth += inserted  # 下次查詢前先估算，突發流量不會在 refresh_interval 內衝過上限太多
+        return inserted
+
+
+class EventQueueConsumer:
+    """
+    背景執行緒：從佇列取出事件交給 KeyedDispatcher (同一位使用者依序處理)，處理完 ack，拋出例外則 fail (延後重試)。
+    只取閒置 worker 數量的事件 (租約從取出時起算，不讓事件在本機排隊等到租約過期)，其餘留在佇列中；
+    worker 開始處理時再 renew 一次租約，確認事件仍屬於這次取出。
+    """
+
+    def __init__(self, queue, handler_fn, workers=8, max_pending=200, poll_interval=1.0, purge_interval=600, name="event-consumer"):
+        self.queue = queue
+        self.handler_fn = handler_fn  # handler_fn(user_id, payload_dict)
+        self.poll_interval = poll_interval
+        self.purge_interval = purge_interval
+        self.name = name
+        self.dispatcher = KeyedDispatcher(self._handle, workers=workers, max_pending=max_pending, name=f"{name}-worker")
+        self._held = {}  # 已交給 dispatcher 還沒處理完的事件 id -> 最近一次取出的 attempts
+        self._held_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+            self._thread.start()
+
+    def notify(self):
+        """有新事件寫入：立即檢查佇列，不等下一次輪詢"""
+        self._wake.set()
+
+    def stop(self, timeout=None):
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.dispatcher.stop(timeout)
+
+    def stats(self):
+        return {"dispatcher": self.dispatcher.stats(), "queue": self.queue.stats()}
+
+    def _handle(self, user_id, event):
+        try:
+            with self._held_lock: attempts = self._held.get(event.id, event.attempts)
+            if not self.queue.renew(event.id, attempts):
+                logger.warning(f"佇列事件 {event.id} 的租約已被重新取出，略過本次處理。")
+                return
+            try:
+                self.handler_fn(user_id, event.payload)
+            except Exception as e:
+                logger.error(f"處理佇列事件 {event.id} (第 {attempts} 次) 失敗: {type(e).__name__}: {e}", exc_info=True)
+                _settle(self.queue.fail, event.id, attempts, e)
+            else:
+                _settle(self.queue.ack, event.id)
+        finally:
+            with self._held_lock: self._held.pop(event.id, None)
+
+    def _submit_claimed(self, events):
+        """交給 dispatcher；本程序已持有的事件 (租約過期後又被自己取出) 只更新 attempts，不重複送入。回傳要放回佇列的事件"""
+        rejected = []
+        for event in events:
+            with self._held_lock:
+                if event.id in self._held:
+                    self._held[event.id] = event.attempts
+                    continue
+                self._held[event.id] = event.attempts
+            if not self.dispatcher.submit(event.user_id, event):
+                with self._held_lock: self._held.pop(event.id, None)
+                rejected.append(event)
+        return rejected
+
+    def _idle_capacity(self):
+        stats = self.dispatcher.stats()
+        return min(stats["workers"], stats["max_pending"]) - stats["pending"]
+
+    def _loop(self):
+        last_purge = 0.0
+        while not self._stopping:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            try:
+                capacity = self._idle_capacity()
+                if capacity > 0:
+                    for event in self._submit_claimed(self.queue.claim(capacity)):
+                        self.queue.release(event.id)
+                if time.monotonic() - last_purge > self.purge_interval:
+                    last_purge = time.monotonic()
+                    purged = self.queue.purge()
+                    if purged: logger.info(f"已清除 {purged} 筆過期的佇列事件。")
+            except Exception as e:
+                logger.error(f"{self.name} 讀取佇列失敗: {type(e).__name__}: {e}", exc_info=True)
+                time.sleep(self.poll_interval)
+
+
+class AsyncEventQueueConsumer(EventQueueConsumer):
+    """EventQueueConsumer 的 asyncio 版本 (佇列存取在 worker thread 執行；同時處理數上限 concurrency 即為閒置 worker 數)"""
+
+    def __init__(self, queue, handler_fn, concurrency=1000, max_pending=5000, poll_interval=1.0, purge_interval=600, name="async-event-consumer"):
+        self.queue = queue
+        self.handler_fn = handler_fn  # async def handler_fn(user_id, payload_dict)
+        self.poll_interval = poll_interval
+        self.purge_interval = purge_interval
+        self.name = name
+        self.dispatcher = AsyncKeyedDispatcher(self._handle, concurrency=concurrency, max_pending=max_pending, name=f"{name}-worker")
+        self._held = {}
+        self._held_lock = threading.Lock()
+        self._wake = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    def notify(self):
+        self._wake.set()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self.dispatcher.stop()
+
+    def stats(self):
+        return {"dispatcher": self.dispatcher.stats()}
+
+    async def _handle(self, user_id, event):
+        try:
+            attempts = self._held.get(event.id, event.attempts)
+            if not await asyncio.to_thread(self.queue.renew, event.id, attempts):
+                logger.warning(f"佇列事件 {event.id} 的租約已被重新取出，略過本次處理。")
+                return
+            try:
+                await self.handler_fn(user_id, event.payload)
+            except Exception as e:
+                logger.error(f"處理佇列事件 {event.id} (第 {attempts} 次) 失敗: {type(e).__name__}: {e}", exc_info=True)
+                await asyncio.to_thread(_settle, self.queue.fail, event.id, attempts, e)
+            else:
+                await asyncio.to_thread(_settle, self.queue.ack, event.id)
+        finally:
+            self._held.pop(event.id, None)
+
+    async def _loop(self):
+        last_purge = 0.0
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                capacity = self._idle_capacity()
+                if capacity > 0:
+                    for event in self._submit_claimed(await asyncio.to_thread(self.queue.claim, capacity)):
+                        await asyncio.to_thread(self.queue.release, event.id)
+                if time.monotonic() - last_purge > self.purge_interval:
+                    last_purge = time.monotonic()
+                    await asyncio.to_thread(self.queue.purge)
+            except Exception as e:
+                logger.error(f"{self.name} 讀取佇列失敗: {type(e).__name__}: {e}", exc_info=True)
+                await asyncio.sleep(self.poll_interval)
@@ -0,0 +1,292 @@
+"""
+壓力測試用的本機替代服務 (標準庫 HTTP server + Pillow)，不必呼叫付費、有額度限制的外部服務：
+- LINE Messaging API：push (內容交給 on_push 回呼) 與使用者圖片下載
+- xAI 的 OpenAI 相容端點：chat (含串流與 vision)、images、models
+- 搜尋結果頁 (DuckDuckGo HTML 結構)
+每個服務可設定延遲 (平均 + 抖動) 與錯誤注入 (比例 + 狀態碼；429/503 帶 Retry-After)。
+AI 回覆以 REPLY_END_MARKER 結尾，benchmark.py 依此判斷一則事件處理完成。
+
+單獨執行: python fake_services.py --port 9100 --xai-latency 1.5
+"""
+import io
+import json
+import html
+import time
+import random
+import base64
+import logging
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, quote
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+REPLY_FILLER = "這是壓力測試的模擬回覆。"
+REPLY_END_MARKER = "(模擬回覆結束)"
+FAKE_MODELS = ("grok-3-mini-beta", "grok-vision-beta", "grok-2-image-1212")
+
+
+class ServiceProfile:
+    """單一服務的延遲與錯誤注入設定"""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, error_status=500, retry_after=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+
+    def delay(self):
+        return max(0.0, random.gauss(self.latency, self.jitter)) if self.jitter else self.latency
+
+    def should_fail(self):
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+
+def _noise_image(size, fmt, quality=92):
+    """有雜訊的測試圖片 (壓縮率接近真實照片)"""
+    noise = Image.effect_noise(size, 48)
+    gradient = Image.linear_gradient("L").resize(size)
+    img = Image.merge("RGB", (noise, gradient, Image.blend(noise, gradient, 0.5)))
+    out = io.BytesIO()
+    img.save(out, format=fmt, quality=quality) if fmt == "JPEG" else img.save(out, format=fmt)
+    return out.getvalue()
+
+
+def _search_page(query, results=10, padding_bytes=24 * 1024):
+    """DuckDuckGo HTML 結果頁的結構 (result__a / result__snippet)，前面塞入 script/style 模擬真實頁面大小"""
+    filler = "var x = 1;\n" * (padding_bytes // 11)
+    target_query, query = query, html.escape(query)
+    items = []
+    for i in range(results):
+        target = quote(f"https://example.com/{i}?q={target_query}", safe="")
+        items.append(
+            f'<div class="result results_links"><h2 class="result__title">'
+            f'<a class="result__a" href="//duckduckgo.com/l/?uddg={target}">{query} 的搜尋結果 {i}</a></h2>'
+            f'<a class="result__snippet" href="#">關於 {query} 的模擬摘要第 {i} 則，內容僅供壓力測試使用。</a></div>'
+        )
+    return (
+        f'<html><head><title>{query}</title><script>{filler}</script><style>.result {{ margin: 0 }}</style></head>'
+        f'<body><div id="links">{"".join(items)}</div></body></html>'
+    ).encode("utf-8")
+
+
+class _QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        pass  # 客戶端關閉 keep-alive 連線 (ConnectionResetError 等) 不印 traceback
+
+
+class FakeServices:
+    """
+    單一 port 上的所有替代服務。on_push(user_id, messages, received_at) 在每次 push 時呼叫。
+    chat 回覆約 reply_tokens 個片段；串流時首個片段延遲 xai.delay()，之後每 token_interval 秒一段。
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, line=None, xai=None, search=None, vision_extra_latency=0.0,
+                 reply_tokens=60, token_interval=0.01, image_size=(1600, 1200), on_push=None):
+        self.line = line or ServiceProfile(latency=0.05)
+        self.xai = xai or ServiceProfile(latency=1.0)
+        self.search = search or ServiceProfile(latency=0.3)
+        self.vision_extra_latency = vision_extra_latency
+        self.reply_tokens = reply_tokens
+        self.token_interval = token_interval
+        self.on_push = on_push
+        self.user_image = _noise_image(image_size, "JPEG")
+        self.generated_image = _noise_image((1024, 768), "PNG")
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._server = _QuietServer((host, port), _make_handler(self))
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-services", daemon=True)
+        self._thread.start()
+        logger.info(f"替代服務啟動: {self.base_url}")
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def count(self, name):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + 1
+
+    def stats(self):
+        """各路由的呼叫次數與注入的錯誤數 ("<路由>" / "<路由>:error")"""
+        with self._lock:
+            return dict(self._counts)
+
+    def reply_pieces(self, model):
+        pieces = [REPLY_FILLER[i % len(REPLY_FILLER)] for i in range(self.reply_tokens)]
+        pieces.append(f"\n{model} {REPLY_END_MARKER}")
+        return pieces
+
+
+def _make_handler(services):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive，和真實服務一樣重用連線
+
+        def log_message(self, format, *args):
+            pass
+
+        # --- 共用 ---
+        def _read_json(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            return json.loads(self.rfile.read(length) or b"{}")
+
+        def _send(self, status, body, content_type="application/json", headers=None):
+            if isinstance(body, (dict, list)):
+                body = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _maybe_fail(self, route, profile):
+            """依設定延遲；需要注入錯誤時送出錯誤回應並回傳 True"""
+            services.count(route)
+            time.sleep(profile.delay())
+            if not profile.should_fail():
+                return False
+            services.count(f"{route}:error")
+            headers = {"Retry-After": str(profile.retry_after)} if profile.error_status in (429, 503) else None
+            self._send(profile.error_status, {"error": {"message": "injected failure", "type": "fake_services"}, "message": "injected failure"}, headers=headers)
+            return True
+
+        def _write_chunk(self, data):
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+
+        # --- 路由 ---
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == "/v1/models":
+                services.count("xai_models")
+                self._send(200, {"object": "list", "data": [{"id": m, "object": "model", "created": 0, "owned_by": "fake"} for m in FAKE_MODELS]})
+            elif url.path.startswith("/v2/bot/message/") and url.path.endswith("/content"):
+                if not self._maybe_fail("line_content", services.line):
+                    self._send(200, services.user_image, "image/jpeg")
+            elif url.path.startswith("/generated/"):
+                services.count("generated_download")
+                self._send(200, services.generated_image, "image/png")
+            elif url.path.startswith("/html"):
+                if not self._maybe_fail("search", services.search):
+                    query = parse_qs(url.query).get("q", [""])[0]
+                    self._send(200, _search_page(query), "text/html; charset=utf-8")
+            else:
+                self._send(404, {"message": "not found"})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            payload = self._read_json()
+            if url.path == "/v2/bot/message/push":
+                if not self._maybe_fail("line_push", services.line):
+                    if services.on_push is not None:
+                        services.on_push(payload.get("to"), payload.get("messages", []), time.time())
+                    self._send(200, {}, headers={"X-Line-Request-Id": "fake"})
+            elif url.path == "/v1/chat/completions":
+                self._chat(payload)
+            elif url.path == "/v1/images/generations":
+                if not self._maybe_fail("xai_images", services.xai):
+                    item = {"b64_json": base64.b64encode(services.generated_image).decode("ascii")} if payload.get("response_format") == "b64_json" \
+                        else {"url": f"{services.base_url}/generated/{random.getrandbits(64):016x}.png"}
+                    self._send(200, {"created": int(time.time()), "data": [item]})
+            else:
+                self._send(404, {"message": "not found"})
+
+        def _chat(self, payload):
+            model = payload.get("model", FAKE_MODELS[0])
+            vision = any(
+                isinstance(part, dict) and part.get("type") == "image_url"
+                for m in payload.get("messages", []) if isinstance(m.get("content"), list) for part in m["content"]
+            )
+            if vision:
+                time.sleep(services.vision_extra_latency)
+            if self._maybe_fail("xai_vision" if vision else "xai_chat", services.xai):
+                return
+            pieces = services.reply_pieces(model)
+            created = int(time.time())
+            if not payload.get("stream"):
+                text = "".join(pieces)
+                self._send(200, {
+                    "id": "chatcmpl-fake", "object": "chat.completion", "created": created, "model": model,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": 0, "completion_tokens": len(pieces), "total_tokens": len(pieces)},
+                })
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i, piece in enumerate(pieces + [None]):
+                delta = {"content": piece} if piece is not None else {}
+                chunk = {
+                    "id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": None if piece is not None else "stop"}],
+                }
+                self._write_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                if i and piece is not None:
+                    time.sleep(services.token_interval)
+            self._write_chunk(b"data: [DONE]\n\n")
+            self._write_chunk(b"")
+
+    return Handler
+
+
+def profile_from_args(args, prefix):
+    return ServiceProfile(
+        latency=getattr(args, f"{prefix}_latency"), jitter=getattr(args, f"{prefix}_jitter"),
+        error_rate=getattr(args, f"{prefix}_error_rate"), error_status=getattr(args, f"{prefix}_error_status")
+    )
+
+
+def add_service_arguments(parser):
+    """各服務的延遲/錯誤注入參數 (benchmark.py 共用)"""
+    for prefix, latency in (("line", 0.05), ("xai", 1.0), ("search", 0.3)):
+        parser.add_argument(f"--{prefix}-latency", type=float, default=latency, help=f"{prefix} 平均延遲 (秒)")
+        parser.add_argument(f"--{prefix}-jitter", type=float, default=latency / 4, help=f"{prefix} 延遲標準差 (秒)")
+        parser.add_argument(f"--{prefix}-error-rate", type=float, default=0.0, help=f"{prefix} 錯誤注入比例 (0~1)")
+        parser.add_argument(f"--{prefix}-error-status", type=int, default=500, help=f"{prefix} 注入錯誤的 HTTP 狀態碼 (429/503 會帶 Retry-After)")
+    parser.add_argument("--vision-extra-latency", type=float, default=1.0, help="vision 請求額外延遲 (秒)")
+    parser.add_argument("--reply-tokens", type=int, default=60, help="每則 AI 回覆的片段數")
+    parser.add_argument("--token-interval", type=float, default=0.01, help="串流時片段之間的間隔 (秒)")
+
+
+def create_from_args(args, host="127.0.0.1", port=0, on_push=None):
+    return FakeServices(
+        host=host, port=port, line=profile_from_args(args, "line"), xai=profile_from_args(args, "xai"),
+        search=profile_from_args(args, "search"), vision_extra_latency=args.vision_extra_latency,
+        reply_tokens=args.reply_tokens, token_interval=args.token_interval, on_push=on_push
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="LINE / xAI / 搜尋的本機替代服務")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    add_service_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    services = create_from_args(args, host=args.host, port=args.port).start()
+    print(f"LINE_API_ENDPOINT={services.base_url} LINE_DATA_ENDPOINT={services.base_url} "
+          f"XAI_API_BASE_URL={services.base_url}/v1 SEARCH_URL_TEMPLATE='{services.base_url}/html/?q={{query}}'")
+    try:
+        while True:
+            time.sleep(60)
+            logger.info(f"呼叫統計: {services.stats()}")
+    except KeyboardInterrupt:
+        services.stop()
@@ -0,0 +1,360 @@
+"""
+「畫一張:」生成圖片的快取與重新託管：
+- 圖片依內容 SHA-256 定址存放 (本機磁碟或 S3 相容儲存)，同時產生小尺寸預覽圖，LINE 顯示縮圖時不必下載原圖
+- 正規化後的提示 -> 圖片 key 的快取 (TTL + 筆數/位元組上限)，相同提示直接回傳已生成的圖片；同時間的相同提示只生成一次
+- 圖片由 Flask/Starlette 路由 /images/<name> 提供，回應帶長效快取標頭 (內容定址，永不改變)
+- 儲存空間依總位元組數與存放時間定期清理 (sweep)：索引只在各程序記憶體中，重啟後留下的舊圖片也會被清掉
+"""
+import io
+import os
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+from search_cache import normalize_query
+
+logger = logging.getLogger(__name__)
+
+IMAGE_ROUTE_PREFIX = "/images"
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+LINE_ORIGINAL_FORMATS = {"JPEG": ("jpg", "image/jpeg"), "PNG": ("png", "image/png")} # LINE 圖片訊息只接受 JPEG/PNG
+CONTENT_TYPES = {"jpg": "image/jpeg", "png": "image/png"}
+PREVIEW_SUFFIX = "_preview.jpg"
+
+
+class LocalImageBackend:
+    """存放在本機目錄 (依 key 前兩碼分子目錄)"""
+
+    name = "local"
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.root, name[:2], name)
+
+    def exists(self, name):
+        return os.path.exists(self._path(name))
+
+    def put(self, name, data, content_type):
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)  # 原子性寫入，讀取端不會看到寫一半的檔案
+
+    def get(self, name):
+        try:
+            with open(self._path(name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def list_objects(self):
+        """列出 (檔名, 位元組數, 修改時間)；寫入中的暫存檔不列出"""
+        for dirpath, _, files in os.walk(self.root):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                try:
+                    st = os.stat(os.path.join(dirpath, name))
+                except FileNotFoundError:
+                    continue  # 其他 worker 剛刪除
+                yield name, st.st_size, st.st_mtime
+
+    def delete(self, name):
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            pass
+
+
+class S3ImageBackend:
+    """S3 相容儲存 (AWS S3、R2、MinIO…；endpoint_url 可指向本機替代服務)，需要選用套件 boto3"""
+
+    name = "s3"
+
+    def __init__(self, bucket, prefix="generated/", endpoint_url=None, region_name=None):
+        import boto3  # 選用套件
+        from botocore.exceptions import ClientError
+        self._client_error = ClientError
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region_name)
+
+    def exists(self, name):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.prefix + name)
+            return True
+        except self._client_error:
+            return False
+
+    def put(self, name, data, content_type):
+        self.client.put_object(
+            Bucket=self.bucket, Key=self.prefix + name, Body=data,
+            ContentType=content_type, CacheControl=IMMUTABLE_CACHE_CONTROL
+        )
+
+    def get(self, name):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self.prefix + name)["Body"].read()
+        except self._client_error as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return None
+            raise
+
+    def list_objects(self):
+        for page in self.client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for obj in page.get("Contents", []):
+                yield obj["Key"][len(self.prefix):], obj["Size"], obj["LastModified"].timestamp()
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + name)
+
+
+def create_image_backend(local_dir, s3_bucket=None, s3_prefix="generated/", s3_endpoint_url=None, s3_region=None):
+    """有設定 s3_bucket 且已安裝 boto3 時使用 S3 相容儲存，否則使用本機目錄"""
+    if s3_bucket:
+        try:
+            backend = S3ImageBackend(s3_bucket, prefix=s3_prefix, endpoint_url=s3_endpoint_url, region_name=s3_region)
+            logger.info(f"生成圖片使用 S3 相容儲存 (bucket={s3_bucket}, endpoint={s3_endpoint_url or '預設'})。")
+            return backend
+        except ImportError:
+            logger.warning("已設定 IMAGE_S3_BUCKET 但未安裝 boto3 套件，生成圖片改存本機目錄。")
+    return LocalImageBackend(local_dir)
+
+
+class PromptResultCache:
+    """正規化提示 -> (圖片 key, 原圖大小)；LRU，依 TTL、筆數與圖片總位元組數淘汰"""
+
+    def __init__(self, ttl=86400, max_entries=1000, max_bytes=256 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries = OrderedDict()  # prompt_key -> (image_key, size, expires_at)
+        self._lock = threading.Lock()
+
+    def get(self, prompt_key):
+        with self._lock:
+            entry = self._entries.get(prompt_key)
+            if entry is None:
+                return None
+            if entry[2] <= time.time():
+                self._remove_locked(prompt_key)
+                return None
+            self._entries.move_to_end(prompt_key)
+            return entry[0]
+
+    def put(self, prompt_key, image_key, size):
+        with self._lock:
+            if prompt_key in self._entries:
+                self._remove_locked(prompt_key)
+            self._entries[prompt_key] = (image_key, size, time.time() + self.ttl)
+            self.total_bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes):
+                self._remove_locked(next(iter(self._entries)))
+
+    def discard(self, prompt_key):
+        with self._lock:
+            if prompt_key in self._entries:
+                self._remove_locked(prompt_key)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove_locked(self, prompt_key):
+        _, size, _ = self._entries.pop(prompt_key)
+        self.total_bytes -= size
+
+
+class GeneratedImageStore:
+    """
+    內容定址的生成圖片儲存 + 提示結果快取。
+    儲存空間：每次存入新圖片後，距上次清理超過 sweep_interval 秒就清理一次，
+    刪除超過 max_age 秒的圖片，總量仍超過 max_storage_bytes 時再從最舊的刪起 (原圖與預覽圖一起刪)。
+    """
+
+    def __init__(self, backend, public_base_url, preview_edge=240, cache_ttl=86400, cache_max_entries=1000, cache_max_bytes=256 * 1024 * 1024,
+                 max_storage_bytes=256 * 1024 * 1024, max_age=30 * 86400, sweep_interval=600):
+        self.backend = backend
+        self.public_base_url = public_base_url.rstrip("/")
+        self.preview_edge = preview_edge
+        self.prompt_cache = PromptResultCache(ttl=cache_ttl, max_entries=cache_max_entries, max_bytes=cache_max_bytes)
+        self.max_storage_bytes = max_storage_bytes
+        self.max_age = max_age
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        self._sweep_lock = threading.Lock()
+        self._last_sweep = 0.0
+        self._inflight = {}         # prompt_key -> threading.Event
+        self._async_inflight = {}   # prompt_key -> asyncio.Future
+        self._stats = {"hits": 0, "misses": 0, "coalesced": 0, "swept": 0}
+
+    # --- 儲存 ---
+    def save(self, data):
+        """存入原圖 (非 JPEG/PNG 時轉成 JPEG) 與預覽圖，回傳原圖檔名 (<sha256>.<副檔名>)"""
+        img = Image.open(io.BytesIO(data))
+        fmt = LINE_ORIGINAL_FORMATS.get(img.format)
+        if fmt is None:
+            out = io.BytesIO()
+            img.convert("RGB").save(out, format="JPEG", quality=90)
+            data, fmt = out.getvalue(), LINE_ORIGINAL_FORMATS["JPEG"]
+        ext, content_type = fmt
+        digest = hashlib.sha256(data).hexdigest()
+        name = f"{digest}.{ext}"
+        if not self.backend.exists(name):
+            self.backend.put(name, data, content_type)
+        preview_name = digest + PREVIEW_SUFFIX
+        if not self.backend.exists(preview_name):
+            self.backend.put(preview_name, self._make_preview(img), "image/jpeg")
+        self._maybe_sweep()
+        return name, len(data)
+
+    def _maybe_sweep(self):
+        if time.monotonic() - self._last_sweep < self.sweep_interval or not self._sweep_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_sweep = time.monotonic()
+            self.sweep()
+        except Exception as e:
+            logger.warning(f"清理生成圖片失敗: {type(e).__name__}: {e}")
+        finally:
+            self._sweep_lock.release()
+
+    def sweep(self, now=None):
+        """依存放時間與總位元組數刪除舊圖片，回傳刪除的圖片數 (原圖 + 預覽圖算一張)"""
+        now = time.time() if now is None else now
+        images = {}  # digest -> [總位元組數, 最新修改時間, 檔名...]
+        for name, size, mtime in self.backend.list_objects():
+            entry = images.setdefault(name[:64], [0, 0.0])
+            entry[0] += size
+            entry[1] = max(entry[1], mtime)
+            entry.append(name)
+        total = sum(entry[0] for entry in images.values())
+        doomed = []
+        for digest, entry in sorted(images.items(), key=lambda item: item[1][1]):  # 最舊的在前
+            age = now - entry[1]
+            # 剛存入 (sweep_interval 內) 的圖片不因容量刪除，剛回覆出去的網址不會馬上失效
+            if (self.max_age and age > self.max_age) or (self.max_storage_bytes and total > self.max_storage_bytes and age > self.sweep_interval):
+                doomed.append(digest)
+                total -= entry[0]
+        for digest in doomed:
+            for name in images[digest][2:]:
+                self.backend.delete(name)
+        if doomed:
+            self._count("swept", len(doomed))
+            logger.info(f"已清理 {len(doomed)} 張生成圖片，剩餘約 {total / 1024 / 1024:.1f} MB。")
+        return len(doomed)
+
+    def _make_preview(self, img):
+        preview = img.convert("RGB")
+        preview.thumbnail((self.preview_edge, self.preview_edge), Image.LANCZOS, reducing_gap=2.0)
+        out = io.BytesIO()
+        preview.save(out, format="JPEG", quality=80, optimize=True)
+        return out.getvalue()
+
+    def urls(self, name):
+        """回傳 (原圖網址, 預覽圖網址)，給 ImageSendMessage 使用"""
+        digest = name.split(".", 1)[0]
+        return f"{self.public_base_url}{IMAGE_ROUTE_PREFIX}/{name}", f"{self.public_base_url}{IMAGE_ROUTE_PREFIX}/{digest}{PREVIEW_SUFFIX}"
+
+    def read(self, name):
+        """路由用：回傳 (bytes, content_type)；檔名不合法或不存在時回傳 (None, None)"""
+        digest, _, ext = name.partition(".")
+        if name.endswith(PREVIEW_SUFFIX):
+            digest, ext = name[:-len(PREVIEW_SUFFIX)], "jpg"
+        if len(digest) != 64 or any(c not in "0123456789abcdef" for c in digest) or ext not in CONTENT_TYPES:
+            return None, None
+        data = self.backend.get(name)
+        return (data, CONTENT_TYPES[ext]) if data is not None else (None, None)
+
+    # --- 提示快取 ---
+    def _cached_name(self, prompt_key):
+        """快取中的圖片檔名；圖片已被清理 (本程序或其他 worker 的 sweep) 時移除該筆並回傳 None"""
+        name = self.prompt_cache.get(prompt_key)
+        if name is not None and not self.backend.exists(name):
+            self.prompt_cache.discard(prompt_key)
+            return None
+        return name
+
+    def get_or_generate(self, prompt, generate_fn):
+        """
+        回傳 (原圖檔名, 是否命中快取)。generate_fn() 回傳圖片 bytes。
+        相同 (正規化後) 提示同時間只生成一次，其他請求等待結果。
+        """
+        prompt_key = normalize_query(prompt)
+        name = self._cached_name(prompt_key)
+        if name is not None:
+            self._count("hits")
+            return name, True
+        with self._lock:
+            event = self._inflight.get(prompt_key)
+            leader = event is None
+            if leader:
+                event = self._inflight[prompt_key] = threading.Event()
+        if not leader:
+            self._count("coalesced")
+            event.wait()
+            name = self.prompt_cache.get(prompt_key)
+            if name is not None:
+                return name, True
+            # 帶頭的那次生成失敗，自己再試一次
+        self._count("misses")
+        try:
+            name, size = self.save(generate_fn())
+            self.prompt_cache.put(prompt_key, name, size)
+            return name, False
+        finally:
+            if leader:
+                with self._lock:
+                    self._inflight.pop(prompt_key, None)
+                event.set()
+
+    async def aget_or_generate(self, prompt, generate_coro_fn):
+        """get_or_generate 的 async 版本 (儲存在 worker thread 執行)"""
+        prompt_key = normalize_query(prompt)
+        name = await asyncio.to_thread(self._cached_name, prompt_key)
+        if name is not None:
+            self._count("hits")
+            return name, True
+        future = self._async_inflight.get(prompt_key)
+        if future is not None:
+            self._count("coalesced")
+            try:
+                return await asyncio.shield(future), True
+            except Exception:
+                pass  # 帶頭的那次生成失敗，自己再試一次
+        self._count("misses")
+        future = asyncio.get_running_loop().create_future()
+        self._async_inflight[prompt_key] = future
+        try:
+            data = await generate_coro_fn()
+            name, size = await asyncio.to_thread(self.save, data)
+            self.prompt_cache.put(prompt_key, name, size)
+            future.set_result(name)
+            return name, False
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # 沒有人等待時避免 "exception was never retrieved" 警告
+            raise
+        finally:
+            if self._async_inflight.get(prompt_key) is future:
+                del self._async_inflight[prompt_key]
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(backend=self.backend.name, cached_prompts=len(self.prompt_cache), cached_bytes=self.prompt_cache.total_bytes)
+        return stats
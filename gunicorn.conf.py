@@ -0,0 +1,54 @@
+"""
+正式環境的 gunicorn 設定：gunicorn -c gunicorn.conf.py app:app
+非同步模式：GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker gunicorn -c gunicorn.conf.py async_app:app
+
+- preload_app：master 只匯入一次 app (匯入時不做網路呼叫、不建立連線、不啟動執行緒)，fork 出的 worker 共用已載入的模組
+- on_starting：master 在 fork 之前執行一次資料庫遷移 (MIGRATE_ON_START=0 可關閉，改由部署步驟執行 python migrate.py)
+- post_worker_init：每個 worker 各自啟動背景元件 (事件佇列 consumer、健康檢查…)；SDK client 與連線池在第一次使用時建立
+
+worker 數：沒有設定 REDIS_URL 時預設 1 個 (每個 worker 以 gthread 執行緒 + 背景 dispatcher 處理，I/O 為主的負載一個程序即可)。
+多個 worker 時事件可能由任一個 worker 取出：
+- 歷史快取必須共用 (REDIS_URL)，否則停用 (history_cache.create_history_cache)
+- xAI 限流 (AI_USER_RPM、AI_MODEL_RPM、AI_MAX_CONCURRENCY) 是每個 worker 各自計算，實際上限為設定值 × worker 數
+"""
+import os
+import multiprocessing
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+preload_app = True
+
+# 有共用快取時才預設多個 worker (上限 4 個，避免小型機器記憶體不足)
+default_workers = min(multiprocessing.cpu_count() * 2 + 1, 4) if os.getenv("REDIS_URL") else 1
+workers = int(os.getenv("WEB_CONCURRENCY", str(default_workers)))
+os.environ["WEB_CONCURRENCY"] = str(workers)  # preload 的 app 依此決定歷史快取與限流的 log
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", "8"))  # gthread 時每個 worker 的請求執行緒數 (webhook 只寫入佇列就回應)
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "0"))  # >0 時 worker 處理這麼多請求後重啟 (緩解記憶體成長)
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", "50")) if max_requests else 0
+accesslog = os.getenv("GUNICORN_ACCESS_LOG") or None
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+
+
+def on_starting(server):
+    from settings import MIGRATE_ON_START
+    if not MIGRATE_ON_START:
+        return
+    from migrate import run_migrations  # 成功後設定 LINEBOT_MIGRATED，worker (含 async_app 的 lifespan) 不再重複執行
+    try:
+        run_migrations()
+    except Exception as e:
+        server.log.error(f"無法初始化資料庫資料表: {type(e).__name__}: {e}")
+
+
+def post_worker_init(worker):
+    # async_app 沒有登記 hook (背景元件由 lifespan 啟動)，這裡只會記錄一行 log
+    from lifecycle import WORKER_LIFECYCLE
+    WORKER_LIFECYCLE.ensure_started()
+
+
+def worker_exit(server, worker):
+    from lifecycle import WORKER_LIFECYCLE
+    WORKER_LIFECYCLE.stop()
@@ -0,0 +1,244 @@
+"""最近對話歷史的快取：程序內 LRU (有筆數/位元組/TTL 上限)，或以 Redis 相容服務作為多個 worker 共用的快取"""
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+ENTRY_OVERHEAD_BYTES = 64  # 每則訊息的 dict/字串物件額外開銷 (粗估)
+
+
+def estimate_bytes(history):
+    """粗估一份歷史在記憶體中的大小"""
+    total = 0
+    for m in history:
+        content = m.get("content", "")
+        total += ENTRY_OVERHEAD_BYTES + len(content.encode("utf-8") if isinstance(content, str) else str(content).encode("utf-8"))
+    return total
+
+
+class _CacheStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def hit(self):
+        with self._lock: self.hits += 1
+
+    def miss(self):
+        with self._lock: self.misses += 1
+
+    def evict(self, n=1):
+        with self._lock: self.evictions += n
+
+    def snapshot(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+class HistoryCache:
+    """
+    程序內 LRU 快取：user_id -> 已裁剪到 limit 則的最近歷史。
+    讀取時 miss 由呼叫端去資料庫載入再 put()；寫入資料庫後呼叫 append() 同步更新 (write-through)。
+    注意：多個 gunicorn worker 各自有一份，同一使用者落在不同 worker 時可能讀到舊資料，需要一致性請改用 RedisHistoryCache。
+    """
+
+    def __init__(self, limit, max_entries=10000, max_bytes=16 * 1024 * 1024, ttl=600):
+        self.limit = int(limit)
+        self.max_entries = max(1, int(max_entries))
+        self.max_bytes = max(1, int(max_bytes))
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = OrderedDict()  # user_id -> (expires_at, history, nbytes)
+        self._bytes = 0
+        self._stats = _CacheStats()
+
+    def get(self, user_id):
+        """取得快取的歷史 (list 複本)；沒有或已過期時回傳 None"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    self._remove_locked(user_id)
+                self._stats.miss()
+                return None
+            self._data.move_to_end(user_id)
+            self._stats.hit()
+            return list(entry[1])
+
+    def put(self, user_id, history):
+        """放入 (或覆蓋) 一位使用者的歷史"""
+        history = list(history[-self.limit:]) if self.limit > 0 else []
+        nbytes = estimate_bytes(history)
+        with self._lock:
+            if user_id in self._data:
+                self._remove_locked(user_id)
+            if nbytes > self.max_bytes:
+                return  # 單筆就超過上限，不快取
+            self._data[user_id] = (time.monotonic() + self.ttl, history, nbytes)
+            self._bytes += nbytes
+            self._evict_locked()
+
+    def append(self, user_id, messages):
+        """write-through：已快取的使用者直接附加新訊息並裁剪；未快取的不動 (下次 miss 會從資料庫載入完整資料)"""
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is None:
+                return
+            history = entry[1]
+        self.put(user_id, history + list(messages))
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._remove_locked(user_id)
+
+    def stats(self):
+        stats = self._stats.snapshot()
+        with self._lock:
+            stats.update({"backend": "memory", "entries": len(self._data), "bytes": self._bytes, "max_bytes": self.max_bytes})
+        return stats
+
+    def _remove_locked(self, user_id):
+        entry = self._data.pop(user_id, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def _evict_locked(self):
+        evicted = 0
+        while self._data and (self._bytes > self.max_bytes or len(self._data) > self.max_entries):
+            _, (_, _, nbytes) = self._data.popitem(last=False)
+            self._bytes -= nbytes
+            evicted += 1
+        if evicted:
+            self._stats.evict(evicted)
+
+
+# 在 Redis 端原子地附加並裁剪，避免多個 worker 同時 GET/SET 互相覆蓋；key 不存在時不建立 (維持 write-through 語意)
+_APPEND_SCRIPT = """
+local v = redis.call('GET', KEYS[1])
+if not v then return 0 end
+local h = cjson.decode(v)
+if type(h) ~= 'table' then h = {} end
+for _, m in ipairs(cjson.decode(ARGV[1])) do table.insert(h, m) end
+local limit = tonumber(ARGV[2])
+local out = {}
+for i = math.max(1, #h - limit + 1), #h do table.insert(out, h[i]) end
+if #out == 0 then
+    redis.call('SET', KEYS[1], '[]', 'EX', tonumber(ARGV[3]))
+else
+    redis.call('SET', KEYS[1], cjson.encode(out), 'EX', tonumber(ARGV[3]))
+end
+return 1
+"""
+
+
+class RedisHistoryCache:
+    """以 Redis (或任何相容服務) 為後端的共用快取，介面與 HistoryCache 相同；容量上限交給 Redis 的 maxmemory 設定"""
+
+    def __init__(self, client, limit, ttl=600, prefix="history:"):
+        self.client = client
+        self.limit = int(limit)
+        self.ttl = int(ttl)
+        self.prefix = prefix
+        self._append = client.register_script(_APPEND_SCRIPT)
+        self._stats = _CacheStats()
+
+    def _key(self, user_id):
+        return f"{self.prefix}{user_id}"
+
+    def get(self, user_id):
+        try:
+            raw = self.client.get(self._key(user_id))
+        except Exception as e:
+            logger.warning(f"讀取 Redis 歷史快取失敗: {e}")
+            raw = None
+        if raw is None:
+            self._stats.miss()
+            return None
+        self._stats.hit()
+        data = json.loads(raw)
+        return data if isinstance(data, list) else []  # cjson 會把空陣列編成 {}
+
+    def put(self, user_id, history):
+        history = list(history[-self.limit:]) if self.limit > 0 else []
+        try:
+            self.client.set(self._key(user_id), json.dumps(history, ensure_ascii=False), ex=self.ttl)
+        except Exception as e:
+            logger.warning(f"寫入 Redis 歷史快取失敗: {e}")
+
+    def append(self, user_id, messages):
+        try:
+            self._append(keys=[self._key(user_id)], args=[json.dumps(list(messages), ensure_ascii=False), self.limit, self.ttl])
+        except Exception as e:
+            logger.warning(f"更新 Redis 歷史快取失敗，改為刪除該筆: {e}")
+            self.invalidate(user_id)
+
+    def invalidate(self, user_id):
+        try:
+            self.client.delete(self._key(user_id))
+        except Exception as e:
+            logger.warning(f"刪除 Redis 歷史快取失敗: {e}")
+
+    def stats(self):
+        stats = self._stats.snapshot()
+        stats["backend"] = "redis"
+        return stats
+
+
+class NullHistoryCache:
+    """停用快取 (每次都從資料庫讀取)：多個 worker 程序又沒有共用後端時使用，介面與 HistoryCache 相同"""
+
+    def __init__(self):
+        self._stats = _CacheStats()
+
+    def get(self, user_id):
+        self._stats.miss()
+        return None
+
+    def put(self, user_id, history):
+        pass
+
+    def append(self, user_id, messages):
+        pass
+
+    def invalidate(self, user_id):
+        pass
+
+    def stats(self):
+        stats = self._stats.snapshot()
+        stats["backend"] = "disabled"
+        return stats
+
+
+def create_history_cache(limit, redis_url=None, max_entries=10000, max_bytes=16 * 1024 * 1024, ttl=600, processes=1):
+    """
+    有設定 redis_url 且已安裝 redis 套件時使用共用快取，否則使用程序內 LRU。
+    processes > 1 (多個 gunicorn worker) 時不使用程序內 LRU：事件可能由任一個 worker 處理，
+    各自的快取看不到其他 worker 寫入的對話，write-through 會一直附加在舊資料上；沒有 Redis 時停用快取。
+    """
+    if redis_url:
+        try:
+            import redis  # 選用套件
+            client = redis.Redis.from_url(redis_url, socket_timeout=1.0, socket_connect_timeout=1.0)
+            cache = RedisHistoryCache(client, limit, ttl=ttl)
+            logger.info("歷史快取使用 Redis 共用後端。")
+            return cache
+        except ImportError:
+            logger.warning("已設定 REDIS_URL 但未安裝 redis 套件，歷史快取改用程序內 LRU。")
+        except Exception as e:
+            logger.warning(f"無法連接 Redis ({e})，歷史快取改用程序內 LRU。")
+    if processes > 1:
+        logger.warning(f"有 {processes} 個 worker 程序但沒有共用的 Redis 快取，停用歷史快取 (每次從資料庫讀取)。")
+        return NullHistoryCache()
+    return HistoryCache(limit, max_entries=max_entries, max_bytes=max_bytes, ttl=ttl)
@@ -0,0 +1,559 @@
+"""
+對話歷史存取層：以連線池存取 PostgreSQL，只在 SELECT / INSERT 的當下借出連線。
+- 讀取與單一使用者的寫入 (每輪對話的一問一答) 都是每條連線 PREPARE 一次的語句，之後只送 EXECUTE
+- write-behind 的批次含多位使用者，列數每批不同，改用 execute_values 合併成一次多列 INSERT (無法事先 PREPARE 固定的列數)
+- 超過保留數量的舊訊息不是每次寫入都清：每位使用者每 prune_every 次寫入才清一次 (保留數量是軟上限，讀取只取最近 N 則不受影響)
+"""
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import Counter
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+
+logger = logging.getLogger(__name__)
+
+# 每則訊息一列，(user_id, seq) 為主鍵；讀取最近 N 則直接走主鍵索引倒序掃描。
+# tokens 為寫入時估算的 token 數 (組合提示時直接使用，不必每次重算)；舊資料為 NULL，讀取時再估算
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS conversation_messages (
+    user_id TEXT NOT NULL,
+    seq BIGSERIAL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    tokens INTEGER,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (user_id, seq)
+);
+ALTER TABLE conversation_messages ADD COLUMN IF NOT EXISTS tokens INTEGER;
+"""
+
+# 舊版 conversation_history (每位使用者一整份 JSONB) 搬到 conversation_messages。
+# 只搬 conversation_messages 裡還沒有資料的使用者，可重複執行。
+MIGRATE_LEGACY_SQL = """
+INSERT INTO conversation_messages (user_id, role, content)
+SELECT h.user_id, e.value->>'role', COALESCE(e.value->>'content', '')
+FROM conversation_history h
+CROSS JOIN LATERAL jsonb_array_elements(
+    CASE WHEN jsonb_typeof(h.history) = 'array' THEN h.history ELSE '[]'::jsonb END
+) WITH ORDINALITY AS e(value, ord)
+WHERE e.value->>'role' IS NOT NULL
+  AND NOT EXISTS (SELECT 1 FROM conversation_messages m WHERE m.user_id = h.user_id)
+ORDER BY h.user_id, e.ord;
+"""
+
+INSERT_MESSAGES_SQL = "INSERT INTO conversation_messages (user_id, role, content, tokens) VALUES %s"
+
+# 單一使用者的多則訊息 (依陣列順序產生 seq)：列數不同也是同一個語句，可以 PREPARE
+INSERT_USER_MESSAGES_SQL = (
+    "INSERT INTO conversation_messages (user_id, role, content, tokens) "
+    "SELECT $1, m.role, m.content, m.tokens FROM unnest($2::text[], $3::text[], $4::int[]) "
+    "WITH ORDINALITY AS m(role, content, tokens, ord) ORDER BY m.ord"
+)
+
+# 只保留每位使用者最新 keep 則，超過的舊訊息在寫入時順便清掉 ({users}/{keep} 依驅動程式填入參數符號)
+PRUNE_SQL_TEMPLATE = """
+DELETE FROM conversation_messages m
+USING (
+    SELECT user_id, seq FROM (
+        SELECT user_id, seq, row_number() OVER (PARTITION BY user_id ORDER BY seq DESC) AS rn
+        FROM conversation_messages WHERE user_id = ANY({users})
+    ) ranked WHERE rn > {keep}
+) old
+WHERE m.user_id = old.user_id AND m.seq = old.seq;
+"""
+PRUNE_SQL = PRUNE_SQL_TEMPLATE.format(users="%s", keep="%s")
+
+# 最近 $2 則訊息 (由舊到新)
+SELECT_RECENT_SQL = (
+    "SELECT role, content, tokens FROM ("
+    "SELECT seq, role, content, tokens FROM conversation_messages WHERE user_id = $1 ORDER BY seq DESC LIMIT $2"
+    ") recent ORDER BY seq"
+)
+
+# 每條連線第一次使用時 PREPARE，之後只送 EXECUTE (省去每次的 parse/plan)
+PREPARED_STATEMENTS = {
+    "history_select": f"PREPARE history_select (text, int) AS {SELECT_RECENT_SQL}",
+    "history_insert": f"PREPARE history_insert (text, text[], text[], int[]) AS {INSERT_USER_MESSAGES_SQL}",
+}
+
+PRUNE_EVERY = 20                # 每位使用者每幾次寫入清理一次舊訊息
+PRUNE_TRACKED_USERS = 100000    # 最多記錄幾位使用者的寫入次數；超過時未記錄的使用者每次寫入都清理 (記憶體有上限)
+
+
+class PoolTimeoutError(Exception):
+    """等待連線池可用連線超時"""
+
+
+class PruneSchedule:
+    """記錄每位使用者距上次清理的寫入次數，決定這次寫入要順便清理哪些使用者 (執行緒安全)"""
+
+    def __init__(self, every=PRUNE_EVERY, max_tracked=PRUNE_TRACKED_USERS):
+        self.every = max(1, int(every))
+        self.max_tracked = max_tracked
+        self._counts = {}  # user_id -> 距上次清理的寫入次數
+        self._lock = threading.Lock()
+
+    def due(self, users):
+        """這次寫入涉及 users；回傳需要清理的使用者 list"""
+        due = []
+        with self._lock:
+            for user_id in users:
+                count = self._counts.get(user_id, 0) + 1
+                if count >= self.every or (count == 1 and len(self._counts) >= self.max_tracked):
+                    self._counts.pop(user_id, None)
+                    due.append(user_id)
+                else:
+                    self._counts[user_id] = count
+        return due
+
+
+class PreparedConnection(psycopg2.extensions.connection):
+    """記錄本連線已 PREPARE 過哪些語句"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.set_client_encoding('UTF8')
+        self.prepared = set()
+
+
+def clean_content(content):
+    """訊息內容轉成可存入 TEXT 欄位的字串 (NULL byte fix)"""
+    if not isinstance(content, str):
+        content = json.dumps(content, ensure_ascii=False)
+    return content.replace('\x00', '')
+
+
+class HistoryRepository:
+    """
+    conversation_messages 的存取介面。
+    連線池在第一次使用時才建立 (避免 gunicorn fork 前就連線)；
+    ThreadedConnectionPool 借不到連線時會直接丟錯，這裡用 semaphore 讓呼叫端排隊等待並記錄等待時間。
+    write_behind=True 時 append() 只放進記憶體佇列，由背景執行緒把多位使用者的訊息合併成一次多列 INSERT。
+    """
+
+    def __init__(self, dsn, minconn=1, maxconn=5, checkout_timeout=10.0,
+                 retain_messages=200, prune_every=PRUNE_EVERY, write_behind=False, flush_interval=0.5, batch_size=500):
+        self.dsn = dsn
+        self.minconn = max(0, int(minconn))
+        self.maxconn = max(1, int(maxconn))
+        self.checkout_timeout = checkout_timeout
+        self.retain_messages = int(retain_messages)
+        self.prune_schedule = PruneSchedule(prune_every)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.maxconn)
+        self._stats_lock = threading.Lock()
+        self._checked_out = 0
+        self._checkouts = 0
+        self._timeouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self.writer = WriteBehindWriter(self, flush_interval=flush_interval, batch_size=batch_size) if write_behind else None
+
+    # --- 連線池 ---
+    def _get_pool(self):
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ThreadedConnectionPool(
+                        self.minconn, self.maxconn, self.dsn, connection_factory=PreparedConnection
+                    )
+                    logger.info(f"資料庫連線池建立完成 (min={self.minconn}, max={self.maxconn})。")
+        return self._pool
+
+    def _checkout(self):
+        wait_start = time.monotonic()
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            with self._stats_lock:
+                self._timeouts += 1
+            raise PoolTimeoutError(f"等待資料庫連線超過 {self.checkout_timeout} 秒")
+        try:
+            conn = self._get_pool().getconn()
+            if conn.closed:  # 連線已被伺服器端關閉，丟掉重拿
+                self._get_pool().putconn(conn, close=True)
+                conn = self._get_pool().getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        waited = time.monotonic() - wait_start
+        with self._stats_lock:
+            self._checked_out += 1
+            self._checkouts += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return conn
+
+    def _release(self, conn, broken=False):
+        try:
+            self._get_pool().putconn(conn, close=broken or conn.closed)
+        finally:
+            with self._stats_lock:
+                self._checked_out -= 1
+            self._slots.release()
+
+    def _run(self, fn):
+        """借出一條連線執行 fn(conn, cur)，成功 commit、失敗 rollback，結束後立即歸還"""
+        conn = self._checkout()
+        broken = False
+        try:
+            with conn.cursor() as cur:
+                result = fn(conn, cur)
+            conn.commit()
+            return result
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True  # 連線本身壞掉，不放回池中
+            raise
+        except Exception:
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except Exception as rb_err:
+                    logger.error(f"Rollback 失敗: {rb_err}")
+                    broken = True
+            raise
+        finally:
+            self._release(conn, broken=broken)
+
+    @staticmethod
+    def _ensure_prepared(conn, cur, name):
+        if name not in conn.prepared:
+            cur.execute(PREPARED_STATEMENTS[name])
+            conn.prepared.add(name)
+
+    # --- 對外介面 ---
+    def init_schema(self):
+        """檢查並建立 conversation_messages 資料表"""
+        self._run(lambda conn, cur: cur.execute(SCHEMA_SQL))
+        logger.info("資料庫資料表 'conversation_messages' 初始化完成。")
+
+    def migrate_legacy(self):
+        """把舊版 conversation_history 的 JSONB 歷史搬到 conversation_messages，回傳搬移的訊息數"""
+        def _migrate(conn, cur):
+            cur.execute("SELECT to_regclass('conversation_history');")
+            if cur.fetchone()[0] is None:
+                return 0
+            cur.execute(MIGRATE_LEGACY_SQL)
+            return cur.rowcount
+
+        moved = self._run(_migrate)
+        if moved:
+            logger.info(f"已從 conversation_history 搬移 {moved} 則歷史訊息到 conversation_messages。")
+        return moved
+
+    def load(self, user_id, limit):
+        """讀取使用者最近 limit 則訊息 (由舊到新)，沒有資料時回傳空 list"""
+        if self.writer is not None:
+            self.writer.wait_user(user_id)  # 確保這位使用者尚未寫入的訊息先落地
+
+        def _select(conn, cur):
+            self._ensure_prepared(conn, cur, "history_select")
+            cur.execute("EXECUTE history_select (%s, %s)", (user_id, int(limit)))
+            return cur.fetchall()
+
+        return [{"role": role, "content": content, "tokens": tokens} for role, content, tokens in self._run(_select)]
+
+    def append(self, user_id, messages):
+        """新增訊息 (只 INSERT 新的這幾則，不重寫整份歷史)"""
+        rows = [(user_id, m["role"], clean_content(m["content"]), m.get("tokens")) for m in messages]
+        if self.writer is not None:
+            self.writer.put(rows)
+        else:
+            self.insert_rows(rows)
+
+    def insert_rows(self, rows):
+        """
+        以一次 INSERT 寫入 [(user_id, role, content, tokens), ...]：只有一位使用者時 EXECUTE history_insert，
+        多位使用者 (write-behind 批次) 時用 execute_values；到了清理週期的使用者同時清掉超過保留數量的舊訊息
+        """
+        if not rows:
+            return
+        users = list(dict.fromkeys(r[0] for r in rows))
+        prune_users = self.prune_schedule.due(users) if self.retain_messages > 0 else []
+
+        def _insert(conn, cur):
+            if len(users) == 1:
+                self._ensure_prepared(conn, cur, "history_insert")
+                cur.execute(
+                    "EXECUTE history_insert (%s, %s::text[], %s::text[], %s::int[])",
+                    (users[0], [r[1] for r in rows], [r[2] for r in rows], [r[3] for r in rows])
+                )
+            else:
+                execute_values(cur, INSERT_MESSAGES_SQL, rows, page_size=len(rows))
+            if prune_users:
+                cur.execute(PRUNE_SQL, (prune_users, self.retain_messages))
+
+        self._run(_insert)
+
+    def ping(self):
+        """健康檢查：借一條連線執行 SELECT 1"""
+        self._run(lambda conn, cur: cur.execute("SELECT 1"))
+
+    def stats(self):
+        """連線池使用統計 (用來調整 min/max)"""
+        with self._stats_lock:
+            stats = {
+                "minconn": self.minconn,
+                "maxconn": self.maxconn,
+                "checked_out": self._checked_out,
+                "open": self._open_connections(),
+                "checkouts": self._checkouts,
+                "timeouts": self._timeouts,
+                "wait_avg_ms": round(self._wait_total / self._checkouts * 1000, 2) if self._checkouts else 0.0,
+                "wait_max_ms": round(self._wait_max * 1000, 2),
+            }
+        if self.writer is not None:
+            stats["write_behind_pending"] = self.writer.pending()
+        return stats
+
+    def _open_connections(self):
+        pool = self._pool
+        return len(pool._pool) + len(pool._used) if pool is not None else 0
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+
+
+# --- SQLite 版 (DATABASE_URL=sqlite:///路徑)：本機開發與 benchmark.py 使用，不需要 PostgreSQL 伺服器 ---
+SQLITE_URL_PREFIX = "sqlite:///"
+
+SQLITE_SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS conversation_messages (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    tokens INTEGER,
+    created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS conversation_messages_user_seq ON conversation_messages (user_id, seq);
+"""
+
+SQLITE_INSERT_SQL = "INSERT INTO conversation_messages (user_id, role, content, tokens) VALUES (?, ?, ?, ?)"
+SQLITE_SELECT_RECENT_SQL = (
+    "SELECT role, content, tokens FROM ("
+    "SELECT seq, role, content, tokens FROM conversation_messages WHERE user_id = ? ORDER BY seq DESC LIMIT ?"
+    ") ORDER BY seq"
+)
+SQLITE_PRUNE_SQL = (
+    "DELETE FROM conversation_messages WHERE user_id = ? AND seq < ("
+    "SELECT MIN(seq) FROM (SELECT seq FROM conversation_messages WHERE user_id = ? ORDER BY seq DESC LIMIT ?))"
+)
+
+
+class SqliteConnection(sqlite3.Connection):
+    """提供與 psycopg2 連線相同的 closed 屬性"""
+
+    closed = False
+
+    def close(self):
+        self.closed = True
+        super().close()
+
+
+class SqliteConnectionPool:
+    """ThreadedConnectionPool 的最小替代 (getconn/putconn/closeall)；借出數量由 HistoryRepository 的 semaphore 控制"""
+
+    def __init__(self, minconn, maxconn, path):
+        self.path = path
+        self.maxconn = maxconn
+        self._pool = []
+        self._used = set()
+        self._lock = threading.Lock()
+        for _ in range(minconn):
+            self._pool.append(self._connect())
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, factory=SqliteConnection)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def getconn(self):
+        with self._lock:
+            conn = self._pool.pop() if self._pool else None
+        if conn is None:
+            conn = self._connect()
+        with self._lock:
+            self._used.add(conn)
+        return conn
+
+    def putconn(self, conn, close=False):
+        with self._lock:
+            self._used.discard(conn)
+            if not close and len(self._pool) < self.maxconn:
+                self._pool.append(conn)
+                return
+        conn.close()
+
+    def closeall(self):
+        with self._lock:
+            conns, self._pool = self._pool + list(self._used), []
+            self._used.clear()
+        for conn in conns:
+            conn.close()
+
+
+class SqliteHistoryRepository(HistoryRepository):
+    """HistoryRepository 的 SQLite 版本：排隊等待、統計與 write-behind 沿用父類別，只替換連線與 SQL"""
+
+    def __init__(self, path, **kwargs):
+        super().__init__(path, **kwargs)
+        self.path = path
+
+    def _get_pool(self):
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = SqliteConnectionPool(self.minconn, self.maxconn, self.path)
+                    logger.info(f"SQLite 歷史資料庫: {self.path} (max={self.maxconn})。")
+        return self._pool
+
+    def _run(self, fn):
+        conn = self._checkout()
+        broken = False
+        cur = conn.cursor()
+        try:
+            result = fn(conn, cur)
+            conn.commit()
+            return result
+        except Exception:
+            try:
+                conn.rollback()
+            except sqlite3.Error as rb_err:
+                logger.error(f"Rollback 失敗: {rb_err}")
+                broken = True
+            raise
+        finally:
+            cur.close()
+            self._release(conn, broken=broken)
+
+    def init_schema(self):
+        self._run(lambda conn, cur: cur.executescript(SQLITE_SCHEMA_SQL))
+        logger.info("SQLite 資料表 'conversation_messages' 初始化完成。")
+
+    def migrate_legacy(self):
+        return 0  # SQLite 沒有舊版 conversation_history
+
+    def load(self, user_id, limit):
+        if self.writer is not None:
+            self.writer.wait_user(user_id)
+
+        def _select(conn, cur):
+            cur.execute(SQLITE_SELECT_RECENT_SQL, (user_id, int(limit)))
+            return cur.fetchall()
+
+        return [{"role": role, "content": content, "tokens": tokens} for role, content, tokens in self._run(_select)]
+
+    def insert_rows(self, rows):
+        """sqlite3 模組會自動快取已編譯的語句，不需要 PREPARE"""
+        if not rows:
+            return
+        prune_users = self.prune_schedule.due(dict.fromkeys(r[0] for r in rows)) if self.retain_messages > 0 else []
+
+        def _insert(conn, cur):
+            cur.executemany(SQLITE_INSERT_SQL, rows)
+            if prune_users:
+                cur.executemany(SQLITE_PRUNE_SQL, [(u, u, self.retain_messages) for u in prune_users])
+
+        self._run(_insert)
+
+
+def create_history_repository(dsn, **kwargs):
+    """DATABASE_URL 為 sqlite:///路徑 時使用 SQLite，否則使用 PostgreSQL 連線池"""
+    if dsn.startswith(SQLITE_URL_PREFIX):
+        return SqliteHistoryRepository(dsn[len(SQLITE_URL_PREFIX):], **kwargs)
+    return HistoryRepository(dsn, **kwargs)
+
+
+class WriteBehindWriter:
+    """
+    批次寫入佇列：累積各使用者的新訊息，每 flush_interval 秒 (或累積到 batch_size 則) 合併成一次多列 INSERT。
+    寫入失敗時整批放回佇列前端，下一輪重試；佇列超過 max_buffer 則丟棄最舊的訊息。
+    """
+
+    def __init__(self, repo, flush_interval=0.5, batch_size=500, max_buffer=20000):
+        self.repo = repo
+        self.flush_interval = flush_interval
+        self.batch_size = max(1, int(batch_size))
+        self.max_buffer = max(self.batch_size, int(max_buffer))
+        self._cond = threading.Condition()
+        self._buffer = []
+        self._unflushed = Counter()  # user_id -> 尚未 commit 的訊息數 (含寫入中的那一批)
+        self._flush_now = False
+        self._closed = False
+        self._thread = None
+
+    def put(self, rows):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="history-writer", daemon=True)
+                self._thread.start()
+            self._buffer.extend(rows)
+            self._unflushed.update(r[0] for r in rows)
+            overflow = len(self._buffer) - self.max_buffer
+            if overflow > 0:
+                dropped, self._buffer = self._buffer[:overflow], self._buffer[overflow:]
+                self._unflushed.subtract(r[0] for r in dropped)
+                self._unflushed += Counter()  # 移除 <= 0 的項目
+                logger.error(f"歷史寫入佇列已滿，丟棄最舊的 {overflow} 則訊息。")
+            if len(self._buffer) >= self.batch_size:
+                self._cond.notify_all()
+
+    def wait_user(self, user_id, timeout=5.0):
+        """等待該使用者的訊息全部寫入 (通常早已寫完，不需等待)"""
+        with self._cond:
+            if not self._unflushed.get(user_id):
+                return True
+            self._flush_now = True
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: not self._unflushed.get(user_id), timeout)
+
+    def pending(self):
+        with self._cond:
+            return len(self._buffer)
+
+    def close(self, timeout=10.0):
+        """寫完剩餘的訊息後結束背景執行緒"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                if not self._closed and not self._flush_now and len(self._buffer) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+                self._flush_now = False
+                if not self._buffer:
+                    if self._closed:
+                        return
+                    continue
+                batch, self._buffer = self._buffer[:self.batch_size], self._buffer[self.batch_size:]
+            try:
+                self.repo.insert_rows(batch)
+            except Exception as e:
+                logger.error(f"批次寫入歷史失敗 ({len(batch)} 則)，稍後重試: {type(e).__name__}: {e}")
+                with self._cond:
+                    self._buffer[:0] = batch
+                    if self._closed:
+                        return
+                    self._cond.wait(self.flush_interval)  # 避免資料庫故障時空轉
+                continue
+            with self._cond:
+                self._unflushed.subtract(r[0] for r in batch)
+                self._unflushed += Counter()
+                self._cond.notify_all()
@@ -0,0 +1,243 @@
+"""
+串流式 HTML 文字摘要：邊下載邊解析，不建立整棵 DOM 樹，摘要額度用完就停止。
+有安裝 lxml 時使用 lxml 的事件式 (target) 解析器，否則使用標準庫 html.parser (與原本 BeautifulSoup 'html.parser' 相同的 tokenizer)。
+DuckDuckGo 結果頁另外解析成 (標題, 網址, 摘要) 結構化紀錄。
+"""
+import codecs
+import logging
+from html.parser import HTMLParser
+from urllib.parse import urlparse, parse_qs, unquote
+
+_lxml_etree = None       # 選用：較快的 C 實作 tokenizer；第一次解析時才匯入 (匯入 app 時不載入)
+_lxml_checked = False
+
+logger = logging.getLogger(__name__)
+
+EXCLUDED_TAGS = frozenset(["script", "style", "header", "footer", "nav", "aside", "form", "button", "input"]) # 不取文字的標籤 (含其子孫)
+VOID_TAGS = frozenset(["area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr"]) # 沒有結束標籤
+SEARCH_RESULT_HOSTS = ("html.duckduckgo.com", "duckduckgo.com")
+MAX_SEARCH_RESULTS = 8
+
+
+def _load_lxml():
+    global _lxml_etree, _lxml_checked
+    if not _lxml_checked:
+        try:
+            from lxml import etree as _lxml_etree
+        except ImportError:
+            _lxml_etree = None
+        _lxml_checked = True
+    return _lxml_etree
+
+
+def is_search_results_url(url):
+    """是否為 DuckDuckGo HTML 結果頁 (改用結構化解析)"""
+    return urlparse(url).hostname in SEARCH_RESULT_HOSTS
+
+
+def _resolve_result_url(href):
+    """DuckDuckGo 的結果連結是 //duckduckgo.com/l/?uddg=<真正網址>，取出真正網址"""
+    if not href:
+        return ""
+    if href.startswith("//"):
+        href = "https:" + href
+    parsed = urlparse(href)
+    if parsed.hostname and parsed.hostname.endswith("duckduckgo.com") and parsed.path.startswith("/l/"):
+        target = parse_qs(parsed.query).get("uddg")
+        if target:
+            return unquote(target[0])
+    return href
+
+
+class _ExtractTarget:
+    """
+    解析事件的接收端 (lxml target 介面：start/end/data/close；標準庫 parser 也轉呼叫這幾個方法)。
+    - 一般頁面：收集排除標籤以外的文字節點，去頭尾空白後以換行串接，達到 budget 字數即標記 done
+    - 結果頁 (structured=True)：收集 result__a (標題/連結) 與 result__snippet (摘要)；純文字照樣收集，找不到結果時當備案
+    """
+
+    def __init__(self, budget, structured=False, max_results=MAX_SEARCH_RESULTS):
+        self.budget = budget
+        self.structured = structured
+        self.max_results = max_results
+        self.parts = []
+        self.length = 0
+        self.results = []
+        self.done = False
+        self._skip_depth = 0        # 目前位於幾層排除標籤之內
+        self._pending_text = []     # 目前文字節點 (可能被切成多段 data 事件)
+        self._capture = None        # 結構化模式：目前擷取中的欄位 ("title" / "snippet")
+        self._capture_tag = None
+        self._capture_depth = 0
+        self._capture_text = []
+
+    # --- 事件 ---
+    def start(self, tag, attrib):
+        if self.done:
+            return
+        tag = tag.lower()
+        self._flush_text()
+        if tag in EXCLUDED_TAGS and tag not in VOID_TAGS:
+            self._skip_depth += 1
+            return
+        if not self.structured:
+            return
+        if self._capture is not None:
+            if tag == self._capture_tag:
+                self._capture_depth += 1
+            return
+        classes = (attrib.get("class") or "").split()
+        if "result__a" in classes:
+            self.results.append({"title": "", "url": _resolve_result_url(attrib.get("href")), "snippet": ""})
+            self._begin_capture("title", tag)
+        elif "result__snippet" in classes and self.results:
+            self._begin_capture("snippet", tag)
+
+    def end(self, tag):
+        if self.done:
+            return
+        tag = tag.lower()
+        self._flush_text()
+        if tag in EXCLUDED_TAGS and tag not in VOID_TAGS:
+            self._skip_depth = max(0, self._skip_depth - 1)
+            return
+        if self._capture is not None and tag == self._capture_tag:
+            self._capture_depth -= 1
+            if self._capture_depth == 0:
+                self._end_capture()
+
+    def data(self, text):
+        if self.done or self._skip_depth:
+            return
+        if self._capture is not None:
+            self._capture_text.append(text)
+        else:
+            self._pending_text.append(text)
+
+    def close(self):
+        self._flush_text()
+        return self
+
+    # --- 內部 ---
+    def _flush_text(self):
+        if not self._pending_text:
+            return
+        text = "".join(self._pending_text).strip()
+        self._pending_text = []
+        if text and self.length < self.budget:
+            self.parts.append(text)
+            self.length += len(text) + 1
+            if self.length >= self.budget and not self.structured: # 結構化模式的純文字只是找不到結果時的備案
+                self.done = True
+
+    def _begin_capture(self, field, tag):
+        self._capture, self._capture_tag, self._capture_depth, self._capture_text = field, tag, 1, []
+
+    def _end_capture(self):
+        value = " ".join("".join(self._capture_text).split())
+        self.results[-1][self._capture] = value
+        if self._capture == "snippet" and len(self.results) >= self.max_results:
+            self.done = True
+        self._capture, self._capture_tag = None, None
+
+
+class _StdlibDriver(HTMLParser):
+    """標準庫 tokenizer，把事件轉給 _ExtractTarget"""
+
+    def __init__(self, target):
+        super().__init__(convert_charrefs=True)
+        self.target = target
+
+    def handle_starttag(self, tag, attrs):
+        self.target.start(tag, dict(attrs))
+        if tag in VOID_TAGS:
+            self.target.end(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.target.start(tag, dict(attrs))
+        self.target.end(tag)
+
+    def handle_endtag(self, tag):
+        if tag not in VOID_TAGS:
+            self.target.end(tag)
+
+    def handle_data(self, data):
+        self.target.data(data)
+
+
+class HtmlSummaryExtractor:
+    """
+    以 feed(bytes) 逐塊餵入 HTML，done 為 True 後呼叫端即可停止下載；summary() 取得結果。
+    同步 (requests iter_content) 與非同步 (httpx aiter_bytes) 流程共用。
+    """
+
+    def __init__(self, budget=2500, charset=None, structured=False, max_results=MAX_SEARCH_RESULTS):
+        self.target = _ExtractTarget(budget, structured=structured, max_results=max_results)
+        try:
+            self._decoder = codecs.getincrementaldecoder(charset or "utf-8")(errors="replace")
+        except LookupError:
+            self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        etree = _load_lxml()
+        if etree is not None:
+            self.backend = "lxml"
+            self._parser = etree.HTMLParser(target=self.target, recover=True)
+        else:
+            self.backend = "html.parser"
+            self._parser = _StdlibDriver(self.target)
+        self._closed = False
+
+    @property
+    def done(self):
+        return self.target.done
+
+    @property
+    def results(self):
+        """結構化模式下的搜尋結果 [{title, url, snippet}, ...]"""
+        return [r for r in self.target.results if r["title"] and "/y.js" not in r["url"]] # 略過廣告連結
+
+    def feed(self, chunk):
+        """餵入一塊 bytes，回傳是否已取得足夠內容"""
+        if self.target.done or not chunk:
+            return self.target.done
+        self._parser.feed(self._decoder.decode(chunk))
+        return self.target.done
+
+    def summary(self):
+        """結束解析並回傳摘要文字 (結構化模式為格式化後的搜尋結果)"""
+        if not self._closed:
+            self._closed = True
+            tail = self._decoder.decode(b"", final=True)
+            try:
+                if tail and not self.target.done:
+                    self._parser.feed(tail)
+                self._parser.close()
+            except Exception as e:  # 中途停止時 lxml 可能抱怨文件不完整，已取得的內容仍可用
+                logger.debug(f"HTML 解析器關閉時忽略錯誤: {e}")
+            self.target.close()
+        if self.target.structured and self.results:
+            return format_search_results(self.results)[:self.target.budget]
+        return "\n".join(self.target.parts)[:self.target.budget]
+
+
+def format_search_results(results):
+    """把結構化搜尋結果排成給 AI 閱讀的文字"""
+    lines = []
+    for i, r in enumerate(results, 1):
+        lines.append(f"{i}. {r['title']}\n{r['url']}" + (f"\n{r['snippet']}" if r['snippet'] else ""))
+    return "\n\n".join(lines)
+
+
+def charset_from_content_type(content_type):
+    """從 Content-Type 取出 charset (沒有時回傳 None)"""
+    for part in content_type.split(";")[1:]:
+        key, _, value = part.strip().partition("=")
+        if key.lower() == "charset" and value:
+            return value.strip('"\'')
+    return None
+
+
+def extract_html_summary(content, budget=2500, charset=None, structured=False):
+    """一次性版本：從完整的 HTML bytes 提取摘要"""
+    extractor = HtmlSummaryExtractor(budget, charset=charset, structured=structured)
+    extractor.feed(content)
+    return extractor.summary()
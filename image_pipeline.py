@@ -0,0 +1,140 @@
+"""
+使用者圖片前處理：送給視覺模型之前先縮圖、重新壓縮。
+- 下載內容逐塊寫入有上限的緩衝區 (超過上限就停止下載)
+- JPEG 以 draft 模式在解碼時直接縮小 (1/2、1/4、1/8)，其他格式以 reduce 縮小後再精確縮圖
+- 長邊縮到 max_edge，以 JPEG/WebP 重新編碼並逐步降低品質直到不超過 target_bytes
+- 以原始內容的 SHA-256 快取結果 (轉傳的同一張圖不重算)
+"""
+import io
+import base64
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_FORMATS = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+QUALITY_STEPS = (85, 75, 65, 55, 45, 35)
+MIN_EDGE = 256          # 品質降到最低仍太大時會縮小長邊，但不小於這個尺寸
+EDGE_SHRINK_RATIO = 0.75
+
+PreparedImage = namedtuple("PreparedImage", ["b64", "mime", "width", "height", "size", "original_size"])
+
+
+class ImageTooLargeError(Exception):
+    """下載內容超過 max_input_bytes"""
+
+
+class ImageProcessingError(Exception):
+    """無法解碼或編碼圖片"""
+
+
+def read_bounded(chunks, max_bytes):
+    """把逐塊下載的內容寫入緩衝區；超過 max_bytes 時拋出 ImageTooLargeError (呼叫端應關閉連線)"""
+    buf = bytearray()
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if len(buf) + len(chunk) > max_bytes:
+            raise ImageTooLargeError(f"圖片超過 {max_bytes} bytes")
+        buf += chunk
+    return bytes(buf)
+
+
+def _flatten_to_rgb(img):
+    """JPEG 不支援透明度：透明背景鋪白色，其他模式轉 RGB"""
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel("A"))
+        return background
+    if img.mode != "RGB":
+        return img.convert("RGB")
+    return img
+
+
+class ImagePreprocessor:
+    """縮圖 + 重新壓縮，結果依內容雜湊快取 (執行緒安全)"""
+
+    def __init__(self, max_edge=1024, target_bytes=300 * 1024, output_format="JPEG", max_input_bytes=20 * 1024 * 1024, cache_entries=256):
+        output_format = output_format.upper()
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"不支援的輸出格式: {output_format} (可用: {', '.join(OUTPUT_FORMATS)})")
+        self.max_edge = max(MIN_EDGE, int(max_edge))
+        self.target_bytes = int(target_bytes)
+        self.output_format = output_format
+        self.max_input_bytes = int(max_input_bytes)
+        self.cache_entries = int(cache_entries)
+        self._cache = OrderedDict()  # sha256 -> PreparedImage
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def read(self, chunks):
+        """read_bounded 的便利版本 (使用 max_input_bytes)"""
+        return read_bounded(chunks, self.max_input_bytes)
+
+    def process(self, raw):
+        """回傳 PreparedImage；相同內容直接回傳快取結果"""
+        key = hashlib.sha256(raw).hexdigest()
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return cached
+            self.misses += 1
+        prepared = self._process(raw)
+        if self.cache_entries > 0:
+            with self._lock:
+                self._cache[key] = prepared
+                self._cache.move_to_end(key)
+                while len(self._cache) > self.cache_entries:
+                    self._cache.popitem(last=False)
+        return prepared
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._cache), "hits": self.hits, "misses": self.misses}
+
+    # --- 內部 ---
+    def _process(self, raw):
+        try:
+            img = Image.open(io.BytesIO(raw))
+            if img.format == "JPEG":
+                img.draft("RGB", (self.max_edge, self.max_edge))  # 解碼時直接以 DCT 縮放，省下大部分解碼時間與記憶體
+            img.load()
+            img = ImageOps.exif_transpose(img)
+            img = _flatten_to_rgb(img)
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            raise ImageProcessingError(f"無法解碼圖片: {e}") from e
+
+        edge = self.max_edge
+        while True:
+            resized = img.copy()
+            resized.thumbnail((edge, edge), Image.LANCZOS, reducing_gap=2.0)  # 先以整數倍 reduce，再精確縮放
+            data = None
+            for quality in QUALITY_STEPS:
+                data = self._encode(resized, quality)
+                if len(data) <= self.target_bytes:
+                    break
+            if len(data) <= self.target_bytes or edge <= MIN_EDGE:
+                break
+            edge = max(MIN_EDGE, int(edge * EDGE_SHRINK_RATIO))
+
+        logger.info(f"圖片前處理: {len(raw)} bytes {img.size} -> {len(data)} bytes {resized.size} ({self.output_format} q={quality})")
+        return PreparedImage(
+            b64=base64.b64encode(data).decode("ascii"), mime=OUTPUT_FORMATS[self.output_format],
+            width=resized.width, height=resized.height, size=len(data), original_size=len(raw)
+        )
+
+    def _encode(self, img, quality):
+        out = io.BytesIO()
+        if self.output_format == "JPEG":
+            img.save(out, format="JPEG", quality=quality, optimize=True, progressive=True)
+        else:
+            img.save(out, format="WEBP", quality=quality, method=4)
+        return out.getvalue()
@@ -0,0 +1,204 @@
+"""
+程序生命週期：讓匯入 app 時不做任何網路呼叫或連線，gunicorn preload 後每個 worker 各自初始化。
+- LazyClient：第一次使用時才建立 SDK client (fork 後的子程序會重新建立)
+- WorkerLifecycle：登記每個程序要啟動/停止的背景元件 (事件佇列 consumer、健康檢查…)，由 worker 啟動後呼叫
+- HealthProbes / AsyncHealthProbes：在背景定期探測相依服務並快取結果，/healthz 只讀快取
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class LazyClient:
+    """屬性存取時才呼叫 factory() 建立物件；建立後直接轉呼叫 (呼叫端照原本的寫法使用)"""
+
+    def __init__(self, factory, name):
+        self._factory = factory
+        self._name = name
+        self._obj = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._obj is None or self._pid != os.getpid():
+            with self._lock:
+                if self._obj is None or self._pid != os.getpid():
+                    self._obj = self._factory()
+                    self._pid = os.getpid()
+                    logger.info(f"{self._name} 初始化完成 (pid={self._pid})。")
+        return self._obj
+
+    @property
+    def initialized(self):
+        return self._obj is not None and self._pid == os.getpid()
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+class WorkerLifecycle:
+    """
+    每個程序各自啟動一次的背景元件。匯入 app 時只登記不啟動：gunicorn preload 時 master 不會有背景執行緒 (執行緒不會跨 fork 存活)。
+    ensure_started() 可重複呼叫 (同一程序只執行一次)，由 gunicorn post_worker_init、python app.py 或第一個請求觸發。
+    """
+
+    def __init__(self):
+        self._start_hooks = []
+        self._stop_hooks = []
+        self._started_pid = None
+        self._lock = threading.Lock()
+
+    def on_start(self, fn):
+        self._start_hooks.append(fn)
+        return fn
+
+    def on_stop(self, fn):
+        self._stop_hooks.append(fn)
+        return fn
+
+    def ensure_started(self):
+        pid = os.getpid()
+        if self._started_pid == pid:
+            return False
+        with self._lock:
+            if self._started_pid == pid:
+                return False
+            start = time.monotonic()
+            for fn in self._start_hooks:
+                fn()
+            self._started_pid = pid
+        logger.info(f"worker {pid} 背景元件啟動完成，用時 {time.monotonic() - start:.2f} 秒。")
+        return True
+
+    def stop(self):
+        with self._lock:
+            if self._started_pid != os.getpid():
+                return
+            self._started_pid = None
+            for fn in reversed(self._stop_hooks):
+                try:
+                    fn()
+                except Exception as e:
+                    logger.error(f"停止背景元件時出錯: {type(e).__name__}: {e}")
+
+
+WORKER_LIFECYCLE = WorkerLifecycle()
+
+
+class _ProbeResults:
+    """探測結果的快取與 /healthz 的回應內容 (同步/非同步版本共用)"""
+
+    def __init__(self):
+        self.probes = {}   # name -> (fn, critical)
+        self.results = {}  # name -> dict
+        self._lock = threading.Lock()
+
+    def add(self, name, fn, critical=True):
+        """fn() 正常回傳即視為健康 (回傳值當作說明)；critical=False 的探測失敗只標記 degraded"""
+        self.probes[name] = (fn, critical)
+
+    def record(self, name, ok, latency, detail):
+        result = {
+            "ok": ok, "critical": self.probes[name][1], "latency_ms": round(latency * 1000, 1),
+            "checked_at": round(time.time(), 3), "detail": detail,
+        }
+        with self._lock:
+            previous = self.results.get(name)
+            self.results[name] = result
+        if previous is None or previous["ok"] != ok:
+            log = logger.info if ok else logger.warning
+            log(f"健康檢查 {name}: {'正常' if ok else '失敗'} ({detail})")
+
+    def snapshot(self):
+        """回傳 (HTTP 狀態碼, 內容)；還沒有任何結果時為 starting (200，避免部署時的健康檢查等待慢速服務)"""
+        with self._lock:
+            results = {name: dict(r) for name, r in self.results.items()}
+        if not results:
+            status = "starting"
+        elif any(not r["ok"] and r["critical"] for r in results.values()):
+            status = "unhealthy"
+        elif all(r["ok"] for r in results.values()):
+            status = "ok"
+        else:
+            status = "degraded"
+        return (503 if status == "unhealthy" else 200), {"status": status, "pid": os.getpid(), "checks": results}
+
+
+class HealthProbes(_ProbeResults):
+    """背景執行緒每 interval 秒依序執行所有探測 (探測本身應設定自己的逾時)"""
+
+    def __init__(self, interval=30.0):
+        super().__init__()
+        self.interval = interval
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def run_once(self):
+        for name, (fn, _) in list(self.probes.items()):
+            start = time.monotonic()
+            try:
+                detail = fn()
+                self.record(name, True, time.monotonic() - start, detail)
+            except Exception as e:
+                self.record(name, False, time.monotonic() - start, f"{type(e).__name__}: {e}")
+
+    def start(self):
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._loop, name="health-probes", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _loop(self):
+        while True:
+            self.run_once()
+            if self._stopping.wait(self.interval):
+                return
+
+
+class AsyncHealthProbes(_ProbeResults):
+    """asyncio 版本：探測為 async 函數，同時執行，各自以 timeout 秒為上限"""
+
+    def __init__(self, interval=30.0, timeout=5.0):
+        super().__init__()
+        self.interval = interval
+        self.timeout = timeout
+        self._task = None
+
+    async def _probe(self, name, fn):
+        start = time.monotonic()
+        try:
+            detail = await asyncio.wait_for(fn(), self.timeout)
+            self.record(name, True, time.monotonic() - start, detail)
+        except Exception as e:
+            self.record(name, False, time.monotonic() - start, f"{type(e).__name__}: {e}")
+
+    async def run_once(self):
+        await asyncio.gather(*(self._probe(name, fn) for name, (fn, _) in list(self.probes.items())))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            await self.run_once()
+            await asyncio.sleep(self.interval)
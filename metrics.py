@@ -0,0 +1,267 @@
+"""
+熱路徑量測：各階段延遲直方圖、計數器 (快取命中、依例外類別的錯誤數)、量表 (佇列深度、執行緒數)，以 Prometheus 文字格式輸出給 /metrics。
+記錄只做一次 bisect + 加法 (在鎖內)，不依賴 prometheus_client；量表與各元件既有的 stats() 在抓取 (scrape) 時才計算。
+另附選用的取樣式 profiler (定期讀取所有執行緒的 stack，輸出 flamegraph 用的 folded stacks)。
+/metrics 與 /debug/profile 會透露內部狀態，存取前以 access_allowed() 檢查 (不允許時兩個進入點都回 404)。
+"""
+import sys
+import hmac
+import time
+import logging
+import threading
+from bisect import bisect_left
+from collections import Counter as _TallyCounter
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# 涵蓋毫秒級 (快取、DB) 到數十秒 (AI 回覆) 的階段
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0)
+LOOPBACK_ADDRS = frozenset(["127.0.0.1", "::1", "localhost"])
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # labels -> [各 bucket 計數..., +Inf 計數, 總和]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((labels, list(series)) for labels, series in self._series.items())
+        for labels, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series[:-1]):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {series[-1]!r}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class CallbackMetric:
+    """抓取時才呼叫 fn()：回傳數值，或 {label 值 (tuple): 數值}"""
+
+    def __init__(self, name, help, fn, labelnames=(), kind="gauge"):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labelnames = tuple(labelnames)
+        self.kind = kind
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            value = self.fn()
+        except Exception as e:
+            logger.warning(f"量測 {self.name} 取值失敗: {type(e).__name__}: {e}")
+            return lines
+        if isinstance(value, dict):
+            for labels, v in sorted(value.items()):
+                if not isinstance(labels, tuple):
+                    labels = (labels,)
+                lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(v)}")
+        elif value is not None:
+            lines.append(f"{self.name} {_format_value(value)}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def gauge_callback(self, name, help, fn, labelnames=()):
+        return self.register(CallbackMetric(name, help, fn, labelnames, "gauge"))
+
+    def counter_callback(self, name, help, fn, labelnames=()):
+        return self.register(CallbackMetric(name, help, fn, labelnames, "counter"))
+
+    def render(self):
+        """Prometheus text exposition format (version 0.0.4)"""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# --- 兩種進入點共用的量測 ---
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.histogram("linebot_stage_seconds", "各處理階段耗時 (秒)", ["stage"])
+ERRORS = REGISTRY.counter("linebot_errors_total", "各階段發生的例外數 (依例外類別)", ["stage", "exception"])
+REGISTRY.gauge_callback("linebot_threads", "目前的執行緒數", threading.active_count)
+
+
+@contextmanager
+def stage(name):
+    """量測一個階段的耗時；例外往外傳時依例外類別計數"""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        ERRORS.inc(name, type(e).__name__)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, name)
+
+
+def record_error(stage_name, error):
+    """在已經自行捕捉例外的地方計數"""
+    ERRORS.inc(stage_name, type(error).__name__)
+
+
+def access_allowed(token, authorization, remote_addr):
+    """
+    量測端點的存取檢查：有設定 token 時比對 Authorization: Bearer <token> (固定時間比較)；
+    沒有設定時只允許本機連線 (benchmark.py、同機的 Prometheus)，平台的公開入口經由代理連入，不會是 loopback。
+    """
+    if token:
+        scheme, _, supplied = (authorization or "").partition(" ")
+        return scheme.lower() == "bearer" and hmac.compare_digest(supplied.strip().encode("utf-8"), token.encode("utf-8"))
+    return remote_addr in LOOPBACK_ADDRS
+
+
+_cache_sources = {}  # 快取名稱 -> (stats_fn, 要輸出的 key)
+
+
+def register_cache_stats(name, stats_fn, keys=("hits", "misses")):
+    """把元件 stats() 裡的快取計數輸出成 linebot_cache_events_total{cache, result}"""
+    _cache_sources[name] = (stats_fn, keys)
+
+
+def _collect_cache_events():
+    values = {}
+    for name, (stats_fn, keys) in list(_cache_sources.items()):
+        stats = stats_fn()
+        values.update({(name, k): stats[k] for k in keys if k in stats})
+    return values
+
+
+REGISTRY.counter_callback("linebot_cache_events_total", "各快取的命中/未命中次數", _collect_cache_events, ["cache", "result"])
+
+
+class SamplingProfiler:
+    """
+    每 interval 秒讀取一次所有執行緒的 stack (sys._current_frames)，累計 folded stacks。
+    只在啟用時有一條背景執行緒，關閉時沒有任何成本。
+    """
+
+    def __init__(self, interval=0.01, max_depth=40):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = _TallyCounter()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def start(self):
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._loop, name="sampling-profiler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _loop(self):
+        own_ident = threading.get_ident()
+        while not self._stopping.wait(self.interval):
+            frames = sys._current_frames()
+            stacks = []
+            for ident, frame in frames.items():
+                if ident == own_ident:
+                    continue
+                names = []
+                while frame is not None and len(names) < self.max_depth:
+                    code = frame.f_code
+                    names.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stacks.append(";".join(reversed(names)))
+            with self._lock:
+                self.samples.update(stacks)
+
+    def folded(self, top=None, reset=False):
+        """回傳 folded stacks 文字 (每行 "stack count")，可直接給 flamegraph.pl / speedscope"""
+        with self._lock:
+            items = self.samples.most_common(top)
+            if reset:
+                self.samples.clear()
+        return "\n".join(f"{stack} {count}" for stack, count in items) + "\n"
@@ -0,0 +1,56 @@
+"""
+一次性的資料庫遷移 (建立/升級資料表、搬移舊版 conversation_history)，與 worker 啟動分開執行：
+- gunicorn.conf.py 的 on_starting：master 在 fork worker 之前執行一次 (MIGRATE_ON_START=0 可關閉)
+- 直接執行 python app.py 時在啟動前執行；async_app.py (含 uvicorn async_app:app) 在 lifespan 啟動時執行
+- 部署流程另外執行: python migrate.py (之後可設 MIGRATE_ON_START=0；uvicorn --workers 多程序時建議如此，避免每個 worker 同時遷移)
+執行成功後設定環境變數 MIGRATED_ENV，之後 fork 出的 worker 繼承此變數，不會重複執行。
+"""
+import os
+import sys
+import time
+import logging
+
+import settings
+from event_queue import create_event_queue
+from history_store import create_history_repository
+
+logger = logging.getLogger("migrate")
+
+MIGRATED_ENV = "LINEBOT_MIGRATED"
+
+
+def run_migrations():
+    """依設定 (settings.py 的 DATABASE_URL、EVENT_QUEUE_BACKEND、EVENT_QUEUE_PATH) 建立資料表；連線用完即關閉，不留給 fork 後的 worker"""
+    database_url = settings.DATABASE_URL
+    if not database_url:
+        raise RuntimeError("DATABASE_URL 未設定")
+    start = time.monotonic()
+    repo = create_history_repository(database_url, minconn=0, maxconn=1)
+    try:
+        repo.init_schema()
+        repo.migrate_legacy()
+    finally:
+        repo.close()
+    queue = create_event_queue(
+        settings.EVENT_QUEUE_BACKEND, path=settings.EVENT_QUEUE_PATH, dsn=database_url
+    )
+    try:
+        queue.init_schema()
+    finally:
+        queue.close()
+    os.environ[MIGRATED_ENV] = "1"
+    logger.info(f"資料庫遷移完成，用時 {time.monotonic() - start:.2f} 秒。")
+
+
+def migrations_pending():
+    """MIGRATE_ON_START 開啟，且本程序與父程序 (gunicorn master) 都還沒執行過遷移"""
+    return settings.MIGRATE_ON_START and not os.environ.get(MIGRATED_ENV)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    try:
+        run_migrations()
+    except Exception as e:
+        logger.error(f"資料庫遷移失敗: {type(e).__name__}: {e}", exc_info=True)
+        sys.exit(1)
@@ -0,0 +1,187 @@
+"""依 token 預算組合提示：估算每則訊息的 token 數，超出預算時先摘要/捨棄最舊的對話，並保持系統提示前綴固定以利供應商的 prompt caching"""
+import math
+
+MESSAGE_OVERHEAD_TOKENS = 4     # 每則訊息的角色/格式開銷 (粗估)
+MIN_WEB_INFO_TOKENS = 50        # 剩餘預算不到這個數就不放搜尋資訊
+IMAGE_TOKENS = 1000             # 一張圖片的估計 token 數
+TRUNCATED_NOTE = "\n[內容過長，已截斷]"
+DROPPED_SUMMARY_PREFIX = "較早的對話摘要 (原文已省略)：\n"
+
+# 固定不變的系統提示 (放在最前面；時間等會變的資訊放到後面，避免每次都讓 prompt cache 失效)
+STABLE_SYSTEM_PROMPT = "指令：請永遠使用『繁體中文』回答。回答時間相關問題時，請以對話中提供的『目前時間』為準。"
+
+
+def _is_cjk(ch):
+    code = ord(ch)
+    return (0x2E80 <= code <= 0x9FFF) or (0xAC00 <= code <= 0xD7AF) or (0xF900 <= code <= 0xFAFF) or (0xFF00 <= code <= 0xFFEF) or (0x3000 <= code <= 0x303F)
+
+
+def estimate_text_tokens(text):
+    """粗估文字的 token 數：中日韓字元約 1 字 1 token，其他字元約 4 字 1 token"""
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if _is_cjk(ch))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def estimate_content_tokens(content):
+    """content 可能是字串或 [{type: text/image_url, ...}, ...]"""
+    if isinstance(content, str):
+        return estimate_text_tokens(content)
+    total = 0
+    for part in content or []:
+        if part.get("type") == "image_url":
+            total += IMAGE_TOKENS
+        else:
+            total += estimate_text_tokens(part.get("text", ""))
+    return total
+
+
+def estimate_message_tokens(message):
+    """單則訊息的 token 數；歷史訊息已存有 tokens 時直接使用"""
+    cached = message.get("tokens")
+    if cached is not None:
+        return cached
+    return estimate_content_tokens(message.get("content")) + MESSAGE_OVERHEAD_TOKENS
+
+
+def with_token_estimate(message):
+    """回傳附上 tokens 欄位的訊息 (存入歷史用，之後不需重算)"""
+    return dict(message, tokens=estimate_content_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS)
+
+
+def truncate_text_to_tokens(text, max_tokens):
+    """從頭保留文字直到約 max_tokens，並加上截斷註記"""
+    if estimate_text_tokens(text) <= max_tokens:
+        return text
+    budget = max(0, max_tokens - estimate_text_tokens(TRUNCATED_NOTE))
+    used = 0.0
+    for i, ch in enumerate(text):
+        used += 1 if _is_cjk(ch) else 0.25
+        if used > budget:
+            return text[:i] + TRUNCATED_NOTE
+    return text
+
+
+class PromptBuilder:
+    """
+    組合順序：固定系統提示 → 歷史 → (被捨棄對話的摘要) → 時間/搜尋資訊 → 目前訊息。
+    摘要放在歷史之後：每次捨棄對話時內容都會變，放在系統提示後面會讓整段快取前綴失效。
+    預算分配優先順序：系統提示 > 目前訊息 > 搜尋資訊 > 歷史 (由新到舊保留，以「一問一答」為單位捨棄)。
+    """
+
+    def __init__(self, budgets, default_budget=8000, summary_chars=300):
+        self.budgets = dict(budgets)  # model -> 提示 token 上限
+        self.default_budget = default_budget
+        self.summary_chars = summary_chars
+
+    def budget_for(self, model):
+        return self.budgets.get(model, self.default_budget)
+
+    def build(self, model, history, user_content, context_notes=(), web_info=None):
+        """
+        回傳 (messages, info)。
+        context_notes：放在目前訊息前的系統資訊 (例如目前時間)；web_info：搜尋摘要 (預算不足時會截斷)。
+        """
+        budget = self.budget_for(model)
+        system_msg = {"role": "system", "content": STABLE_SYSTEM_PROMPT}
+        used = estimate_message_tokens(system_msg)
+        info = {"budget": budget, "dropped_messages": 0, "truncated": []}
+
+        notes = [{"role": "system", "content": note} for note in context_notes if note]
+        used += sum(estimate_message_tokens(m) for m in notes)
+
+        # 目前訊息 (文字過長時截斷，至少保留一半預算給它以外的內容)
+        user_content = self._fit_user_content(user_content, min(budget // 2, budget - used - MESSAGE_OVERHEAD_TOKENS), info)
+        user_msg = {"role": "user", "content": user_content}
+        used += estimate_message_tokens(user_msg)
+
+        # 搜尋資訊
+        web_msg = None
+        if web_info:
+            remaining = budget - used - MESSAGE_OVERHEAD_TOKENS
+            web_text = web_info
+            if remaining < MIN_WEB_INFO_TOKENS:
+                web_text = ""
+                info["truncated"].append("web_info")
+            elif estimate_text_tokens(web_text) > remaining:
+                web_text = truncate_text_to_tokens(web_text, max(0, remaining))
+                info["truncated"].append("web_info")
+            if web_text.strip():
+                web_msg = {"role": "system", "content": web_text}
+                used += estimate_message_tokens(web_msg)
+
+        # 歷史：由新到舊，以完整的一問一答為單位放入
+        kept, dropped = self._fit_history(history, budget - used)
+        used += sum(estimate_message_tokens(m) for m in kept)
+        info["dropped_messages"] = len(dropped)
+
+        summary_msg = None
+        if dropped:
+            summary_msg = self._summarize(dropped, budget - used)
+            if summary_msg is not None:
+                used += estimate_message_tokens(summary_msg)
+
+        messages = [system_msg]
+        messages += [{"role": m["role"], "content": m["content"]} for m in kept] # 去掉 tokens 等內部欄位
+        if summary_msg is not None: messages.append(summary_msg)
+        messages += notes
+        if web_msg is not None: messages.append(web_msg)
+        messages.append(user_msg)
+        info["estimated_tokens"] = used
+        return messages, info
+
+    # --- 內部 ---
+    def _fit_user_content(self, content, max_tokens, info):
+        if isinstance(content, str):
+            if estimate_text_tokens(content) > max_tokens:
+                info["truncated"].append("user")
+                return truncate_text_to_tokens(content, max_tokens)
+            return content
+        fitted = []
+        for part in content:
+            if part.get("type") == "text" and estimate_text_tokens(part.get("text", "")) > max_tokens:
+                info["truncated"].append("user")
+                part = dict(part, text=truncate_text_to_tokens(part["text"], max_tokens))
+            fitted.append(part)
+        return fitted
+
+    @staticmethod
+    def _fit_history(history, remaining):
+        """回傳 (保留的訊息, 被捨棄的訊息)，兩者皆由舊到新"""
+        history = list(history)
+        keep_from = len(history)
+        used = 0
+        i = len(history)
+        while i > 0:
+            # 一個單位 = 一則 assistant 及其前面的 user (若有)
+            start = i - 1
+            if history[start]["role"] == "assistant" and start > 0 and history[start - 1]["role"] == "user":
+                start -= 1
+            cost = sum(estimate_message_tokens(m) for m in history[start:i])
+            if used + cost > remaining:
+                break
+            used += cost
+            keep_from = start
+            i = start
+        return history[keep_from:], history[:keep_from]
+
+    def _summarize(self, dropped, remaining):
+        """把被捨棄的較早對話壓成一則簡短摘要 (只列使用者問過的問題開頭)；預算不足時不加"""
+        if self.summary_chars <= 0 or remaining <= MESSAGE_OVERHEAD_TOKENS * 4:
+            return None
+        lines, total = [], 0
+        for m in reversed(dropped):  # 越新的越重要
+            if m["role"] != "user" or not isinstance(m["content"], str):
+                continue
+            line = "- " + " ".join(m["content"].split())[:60]
+            if total + len(line) > self.summary_chars:
+                break
+            lines.insert(0, line)
+            total += len(line)
+        if not lines:
+            return None
+        summary = {"role": "system", "content": DROPPED_SUMMARY_PREFIX + "\n".join(lines)}
+        if estimate_message_tokens(summary) > remaining:
+            return None
+        return summary
@@ -0,0 +1,246 @@
+"""自動搜尋結果快取：依關鍵字類別決定 TTL、過期後先回舊資料再背景更新 (stale-while-revalidate)、合併同時間的相同查詢"""
+import os
+import time
+import sqlite3
+import asyncio
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# (關鍵字, 新鮮秒數)：變化快的 (股價、天氣) 短，百科類 (介紹、什麼是) 長；同時命中多類時取最短
+CATEGORY_TTLS = [
+    (("股價",), 120),
+    (("天氣",), 600),
+    (("新聞", "今日", "今天", "最新"), 900),
+    (("查詢", "搜尋"), 3600),
+    (("誰是", "什麼是", "介紹"), 86400),
+]
+DEFAULT_TTL = 1800
+STALE_FACTOR = 1.0  # 過期後還能先回舊資料的時間 = TTL * STALE_FACTOR
+
+
+def normalize_query(query):
+    """快取 key：全形轉半形 (NFKC)、去頭尾空白、合併連續空白、英文轉小寫"""
+    return " ".join(unicodedata.normalize("NFKC", query).split()).lower()
+
+
+def ttl_for_query(query):
+    """依查詢命中的關鍵字類別回傳新鮮秒數"""
+    ttls = [ttl for keywords, ttl in CATEGORY_TTLS if any(k in query for k in keywords)]
+    return min(ttls) if ttls else DEFAULT_TTL
+
+
+class _DiskTier:
+    """以 SQLite 檔案保存的第二層快取，重啟後仍可使用"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = None  # 第一次 get/put 時才開啟 (gunicorn preload 時不會把連線帶過 fork)
+        self._pid = None
+
+    @property
+    def _conn(self):
+        if self._connection is None or self._pid != os.getpid():  # fork 後不沿用父程序的連線
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS search_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, fresh_until REAL NOT NULL, stale_until REAL NOT NULL)"
+            )
+            conn.execute("DELETE FROM search_cache WHERE stale_until < ?", (time.time(),))  # 開啟時順便清掉過期資料
+            self._connection, self._pid = conn, os.getpid()
+        return self._connection
+
+    def get(self, key):
+        with self._lock:
+            return self._conn.execute("SELECT value, fresh_until, stale_until FROM search_cache WHERE key = ?", (key,)).fetchone()
+
+    def put(self, key, value, fresh_until, stale_until):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO search_cache (key, value, fresh_until, stale_until) VALUES (?, ?, ?, ?)",
+                (key, value, fresh_until, stale_until),
+            )
+
+
+class SearchCache:
+    """
+    兩層快取：記憶體 LRU (以位元組數為上限) + 選用的 SQLite 檔案。
+    get_or_fetch() 給同步 (執行緒) 流程使用，aget_or_fetch() 給 async_app 使用；兩者共用同一份資料。
+    fetch_fn 回傳的結果經 is_cacheable 判斷為失敗訊息時不寫入快取。
+    同步流程的背景更新由 refresh_workers 條執行緒執行，排隊中的更新超過 max_refreshes 筆時略過 (先回舊資料，下次再更新)。
+    """
+
+    def __init__(self, max_bytes=8 * 1024 * 1024, disk_path=None, is_cacheable=None, refresh_workers=2, max_refreshes=32):
+        self.max_bytes = max(1, int(max_bytes))
+        self.is_cacheable = is_cacheable or (lambda value: bool(value))
+        self._lock = threading.Lock()
+        self._mem = OrderedDict()  # key -> (value, fresh_until, stale_until, nbytes)
+        self._bytes = 0
+        self._disk = None
+        if disk_path:
+            self._disk = _DiskTier(disk_path)  # 檔案在第一次讀寫時才開啟；開啟失敗時該次讀寫只記錄 log，仍使用記憶體快取
+        self._inflight = {}        # key -> threading.Event (同步流程)
+        self._inflight_async = {}  # key -> asyncio.Future (async 流程)
+        self.refresh_workers = max(1, int(refresh_workers))
+        self.max_refreshes = max(1, int(max_refreshes))
+        self._refreshes = 0        # 排隊中 + 執行中的背景更新數
+        self._refresh_pool = None  # 第一次背景更新時才建立 (gunicorn fork 前不建立執行緒)
+        self._counts = {"hits": 0, "stale_hits": 0, "misses": 0, "coalesced": 0, "refreshes": 0}
+
+    # --- 儲存層 ---
+    def _count(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    def _lookup(self, key):
+        """回傳 (value, state)，state 為 'fresh' / 'stale' / None"""
+        now = time.time()
+        with self._lock:
+            entry = self._mem.get(key)
+            if entry is not None:
+                self._mem.move_to_end(key)
+        if entry is None and self._disk is not None:
+            try:
+                row = self._disk.get(key)
+            except Exception as e:
+                logger.warning(f"讀取搜尋快取檔案失敗: {e}")
+                row = None
+            if row is not None:
+                entry = row
+                self._put_mem(key, *row)
+        if entry is None or entry[2] < now:
+            return None, None
+        return entry[0], ("fresh" if entry[1] >= now else "stale")
+
+    def _put_mem(self, key, value, fresh_until, stale_until):
+        nbytes = len(key.encode("utf-8")) + len(value.encode("utf-8"))
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._mem.pop(key, None)
+            if old is not None:
+                self._bytes -= old[3]
+            self._mem[key] = (value, fresh_until, stale_until, nbytes)
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes:
+                _, evicted = self._mem.popitem(last=False)
+                self._bytes -= evicted[3]
+
+    def _store(self, key, query, value):
+        if not self.is_cacheable(value):
+            return
+        ttl = ttl_for_query(query)
+        now = time.time()
+        fresh_until, stale_until = now + ttl, now + ttl * (1 + STALE_FACTOR)
+        self._put_mem(key, value, fresh_until, stale_until)
+        if self._disk is not None:
+            try:
+                self._disk.put(key, value, fresh_until, stale_until)
+            except Exception as e:
+                logger.warning(f"寫入搜尋快取檔案失敗: {e}")
+
+    # --- 同步介面 ---
+    def get_or_fetch(self, query, fetch_fn):
+        """查快取；新鮮直接回傳，過期但可用時回傳舊資料並在背景更新，沒有時呼叫 fetch_fn (相同查詢同時只抓一次)"""
+        key = normalize_query(query)
+        value, state = self._lookup(key)
+        if state == "fresh":
+            self._count("hits")
+            return value
+        if state == "stale":
+            self._count("stale_hits")
+            self._start_refresh(key, query, fetch_fn)
+            return value
+        self._count("misses")
+        return self._fetch_coalesced(key, query, fetch_fn)
+
+    def _fetch_coalesced(self, key, query, fetch_fn):
+        with self._lock:
+            event = self._inflight.get(key)
+            leader = event is None
+            if leader:
+                event = self._inflight[key] = threading.Event()
+        if not leader:
+            self._count("coalesced")
+            event.wait()
+            value, state = self._lookup(key)
+            if state is not None:
+                return value
+            return fetch_fn()  # 帶頭的那次抓取失敗 (沒寫入快取)，自己再試一次
+        try:
+            value = fetch_fn()
+            self._store(key, query, value)
+            return value
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            event.set()
+
+    def _start_refresh(self, key, query, fetch_fn):
+        with self._lock:
+            if key in self._inflight or self._refreshes >= self.max_refreshes:
+                return
+            self._inflight[key] = threading.Event()
+            self._refreshes += 1
+            if self._refresh_pool is None:
+                self._refresh_pool = ThreadPoolExecutor(max_workers=self.refresh_workers, thread_name_prefix="search-refresh")
+        self._count("refreshes")
+
+        def _refresh():
+            try:
+                self._store(key, query, fetch_fn())
+            except Exception as e:
+                logger.warning(f"背景更新搜尋快取失敗 ({query}): {e}")
+            finally:
+                with self._lock:
+                    event = self._inflight.pop(key, None)
+                    self._refreshes -= 1
+                if event is not None:
+                    event.set()
+
+        self._refresh_pool.submit(_refresh)
+
+    # --- async 介面 ---
+    async def aget_or_fetch(self, query, fetch_coro_fn):
+        """get_or_fetch 的 async 版本，fetch_coro_fn() 回傳 coroutine"""
+        key = normalize_query(query)
+        value, state = self._lookup(key)
+        if state == "fresh":
+            self._count("hits")
+            return value
+        if state == "stale":
+            self._count("stale_hits")
+            if key not in self._inflight_async:
+                self._count("refreshes")
+                self._run_async_fetch(key, query, fetch_coro_fn)
+            return value
+        self._count("misses")
+        future = self._inflight_async.get(key)
+        if future is not None:
+            self._count("coalesced")
+            return await asyncio.shield(future)
+        return await asyncio.shield(self._run_async_fetch(key, query, fetch_coro_fn))
+
+    def _run_async_fetch(self, key, query, fetch_coro_fn):
+        async def _fetch():
+            try:
+                value = await fetch_coro_fn()
+                self._store(key, query, value)
+                return value
+            finally:
+                self._inflight_async.pop(key, None)
+
+        task = asyncio.get_running_loop().create_task(_fetch())
+        self._inflight_async[key] = task
+        return task
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+            stats.update({"entries": len(self._mem), "bytes": self._bytes, "max_bytes": self.max_bytes, "disk": self._disk is not None})
+        return stats
@@ -0,0 +1,128 @@
+"""
+同步 (app.py) 與非同步 (async_app.py) 兩種進入點共用的環境變數設定 (依設定建立共用元件的函數見 bot_logic.py)。
+兩個進入點只從這裡讀取設定，預設值不會各自漂移；依進入點不同的預設值 (_SYNC / _ASYNC) 集中在這裡並註明原因。
+"""
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()  # 匯入時載入 .env (bot_logic 等模組的設定也從這裡讀取)
+
+
+def _int(name, default):
+    return int(os.getenv(name, str(default)))
+
+
+def _float(name, default):
+    return float(os.getenv(name, str(default)))
+
+
+def _flag(name, default="0"):
+    return os.getenv(name, default) == "1"
+
+
+# --- 必要設定與外部服務端點 ---
+LINE_CHANNEL_ACCESS_TOKEN = os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
+LINE_CHANNEL_SECRET = os.getenv('LINE_CHANNEL_SECRET')
+GROK_API_KEY = os.getenv('GROK_API_KEY') # 這裡仍用 GROK_API_KEY 這個名字讀取 xAI 的 Key (未去除空白，由進入點檢查)
+DATABASE_URL = os.getenv('DATABASE_URL')
+XAI_API_BASE_URL = os.getenv("XAI_API_BASE_URL", "https://api.x.ai/v1") # xAI API 端點 (如果需要可自訂)
+LINE_API_ENDPOINT = os.getenv("LINE_API_ENDPOINT", "https://api.line.me") # 壓力測試時指向 fake_services.py
+LINE_DATA_ENDPOINT = os.getenv("LINE_DATA_ENDPOINT", "https://api-data.line.me")
+SEARCH_URL_TEMPLATE = os.getenv("SEARCH_URL_TEMPLATE", "https://html.duckduckgo.com/html/?q={query}") # 可改指向相容的結果頁 (例如 fake_services.py)
+
+# --- 程序與並行 ---
+WEB_CONCURRENCY = _int("WEB_CONCURRENCY", 1) # gunicorn worker 數 (gunicorn.conf.py 會設定)
+GUNICORN_THREADS = _int("GUNICORN_THREADS", 8) # gthread 時每個 worker 的請求執行緒數 (gunicorn.conf.py 也讀這個值)
+DISPATCH_WORKERS = _int("DISPATCH_WORKERS", 8) # 同步模式：背景處理 worker 數 (每個 worker 同時最多佔用一條 DB 連線 + 一個 AI 呼叫)
+DISPATCH_QUEUE_SIZE = _int("DISPATCH_QUEUE_SIZE", 200) # 同步模式：dispatcher 待處理事件上限
+ASYNC_MAX_INFLIGHT = _int("ASYNC_MAX_INFLIGHT", 1000) # 非同步模式：同時處理中的對話數上限
+ASYNC_QUEUE_SIZE = _int("ASYNC_QUEUE_SIZE", 5000) # 非同步模式：dispatcher 待處理事件上限
+ASYNC_HTTP_MAX_CONNECTIONS = _int("ASYNC_HTTP_MAX_CONNECTIONS", 200) # 非同步模式：共用 httpx.AsyncClient 的連線數上限
+
+# --- 事件佇列 ---
+EVENT_QUEUE_BACKEND = os.getenv("EVENT_QUEUE_BACKEND") # sqlite (本機 WAL 檔案) 或 postgres (使用 DATABASE_URL，重新部署後仍保留)；未設定時 DATABASE_URL 為 Postgres 就用 postgres
+EVENT_QUEUE_PATH = os.getenv("EVENT_QUEUE_PATH", "event_queue.db")
+EVENT_QUEUE_LEASE_SECONDS = _int("EVENT_QUEUE_LEASE_SECONDS", 300) # 處理中的事件超過這個時間沒完成 (程序已不在) 就重新取出
+EVENT_QUEUE_MAX_ATTEMPTS = _int("EVENT_QUEUE_MAX_ATTEMPTS", 3)
+EVENT_QUEUE_RETENTION = _int("EVENT_QUEUE_RETENTION", 86400) # 處理完的事件保留秒數 (這段時間內 LINE 重送都能去重)
+EVENT_QUEUE_MAX_PENDING = _int("EVENT_QUEUE_MAX_PENDING", 2000) # 待處理 + 處理中的事件數達到上限時 /callback 回 503 (0 = 不限制)
+# Postgres 佇列的連線池上限：/callback 請求執行緒 + dispatcher worker + consumer 各一條，不會有人等連線
+EVENT_QUEUE_POOL_MAX = _int("EVENT_QUEUE_POOL_MAX", GUNICORN_THREADS + DISPATCH_WORKERS + 1)
+EVENT_QUEUE_POOL_TIMEOUT = _float("EVENT_QUEUE_POOL_TIMEOUT", 10) # 等不到連線超過這個秒數就放棄 (webhook 回 500 讓 LINE 重送)
+
+# --- 串流回覆 ---
+STREAM_RESPONSES = _flag("STREAM_RESPONSES") # 1 = 串流接收 AI 回覆，邊收邊分段推送
+STREAM_CHUNK_CHARS = _int("STREAM_CHUNK_CHARS", 200) # 累積多少字就在句尾切一段推送
+STREAM_CHUNK_SECONDS = _float("STREAM_CHUNK_SECONDS", 3) # 距上次推送超過幾秒也在句尾切一段
+STREAM_MAX_EARLY_PUSHES = _int("STREAM_MAX_EARLY_PUSHES", 3) # 最多提早推送幾次 (其餘在結束時一次送出)
+
+# --- xAI 呼叫限流 (每位使用者/每個模型的 token bucket + AIMD 同時呼叫數 + 公平排隊) ---
+# 限流狀態在每個 worker 程序內各自計算：多個 worker 時實際的每人/每模型上限與同時呼叫數為設定值 × worker 數
+AI_USER_RPM = _float("AI_USER_RPM", 10) # 每位使用者每分鐘最多幾次 AI 呼叫
+AI_USER_BURST = _int("AI_USER_BURST", 5)
+AI_MODEL_RPM = _int("AI_MODEL_RPM", 60) # 每個模型每分鐘最多幾次 (圖片生成另見 IMAGE_GEN_MODEL_RPM)
+IMAGE_GEN_MODEL_RPM = _int("IMAGE_GEN_MODEL_RPM", 10)
+# 同時呼叫數上限 (實際值依 429/延遲自動調整)：同步模式每個 worker 執行緒最多一個呼叫，預設與 worker 數相同；
+# 非同步模式不受執行緒限制，預設 64，並從 1/4 開始往上調整
+AI_MAX_CONCURRENCY_SYNC = _int("AI_MAX_CONCURRENCY", DISPATCH_WORKERS)
+AI_MAX_CONCURRENCY_ASYNC = _int("AI_MAX_CONCURRENCY", 64)
+AI_TARGET_LATENCY = _float("AI_TARGET_LATENCY", 20) # 首個 token (或換算後) 超過這個秒數視為壅塞，降低同時呼叫數
+AI_MAX_WAIT = _float("AI_MAX_WAIT", 30) # 排隊 + 重試最多等幾秒，超過就回覆請稍後再試
+AI_MAX_RETRIES = _int("AI_MAX_RETRIES", 2)
+
+# --- 提示 token 預算 ---
+TEXT_MODEL_PROMPT_TOKENS = _int("TEXT_MODEL_PROMPT_TOKENS", 8000) # 送給文字模型的提示 token 上限 (超過就捨棄最舊的對話)
+VISION_MODEL_PROMPT_TOKENS = _int("VISION_MODEL_PROMPT_TOKENS", 4000) # 送給視覺模型的提示 token 上限 (含圖片)
+
+# --- 資料庫 (連線池) ---
+DB_POOL_MIN = _int("DB_POOL_MIN", 1)
+# 同步模式預設與 worker 數相同 (不會有人等連線)；非同步模式的對話數遠多於連線，預設 10 條由 asyncpg 排隊
+DB_POOL_MAX_SYNC = _int("DB_POOL_MAX", DISPATCH_WORKERS)
+DB_POOL_MAX_ASYNC = _int("DB_POOL_MAX", 10)
+DB_POOL_TIMEOUT = _float("DB_POOL_TIMEOUT", 10)
+HISTORY_RETAIN_MESSAGES = _int("HISTORY_RETAIN_MESSAGES", 200) # 每位使用者在資料庫保留的訊息數 (0 = 不清理)
+HISTORY_PRUNE_EVERY = _int("HISTORY_PRUNE_EVERY", 20) # 每位使用者每幾次寫入清理一次超過保留數量的舊訊息
+HISTORY_WRITE_BEHIND = _flag("HISTORY_WRITE_BEHIND") # 1 = 背景批次寫入 (多位使用者合併成一次 INSERT；同步模式)
+HISTORY_FLUSH_INTERVAL = _float("HISTORY_FLUSH_INTERVAL", 0.5)
+HISTORY_BATCH_SIZE = _int("HISTORY_BATCH_SIZE", 500)
+
+# --- 快取 ---
+REDIS_URL = os.getenv("REDIS_URL") # 設定時歷史快取由多個 worker 共用 (同步模式)
+HISTORY_CACHE_TTL = _int("HISTORY_CACHE_TTL", 600) # 秒
+HISTORY_CACHE_MAX_BYTES = _int("HISTORY_CACHE_MAX_BYTES", 16 * 1024 * 1024)
+HISTORY_CACHE_MAX_ENTRIES = _int("HISTORY_CACHE_MAX_ENTRIES", 10000)
+SEARCH_CACHE_MAX_BYTES = _int("SEARCH_CACHE_MAX_BYTES", 8 * 1024 * 1024)
+SEARCH_CACHE_PATH = os.getenv("SEARCH_CACHE_PATH") # 設定時搜尋結果另存 SQLite 檔案，重啟後仍保留
+
+# --- 使用者圖片前處理 ---
+IMAGE_MAX_EDGE = _int("IMAGE_MAX_EDGE", 1024) # 長邊像素上限
+IMAGE_TARGET_BYTES = _int("IMAGE_TARGET_BYTES", 300 * 1024) # 壓縮後的目標大小
+IMAGE_OUTPUT_FORMAT = os.getenv("IMAGE_OUTPUT_FORMAT", "JPEG") # JPEG 或 WEBP
+IMAGE_MAX_INPUT_BYTES = _int("IMAGE_MAX_INPUT_BYTES", 20 * 1024 * 1024) # 下載超過這個大小即放棄
+IMAGE_CACHE_ENTRIES = _int("IMAGE_CACHE_ENTRIES", 256)
+
+# --- 生成圖片儲存 (需要對外網址，未設定時直接使用供應商的暫時網址) ---
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL") or os.getenv("RENDER_EXTERNAL_URL")
+GENERATED_IMAGE_MAX_BYTES = _int("GENERATED_IMAGE_MAX_BYTES", 10 * 1024 * 1024) # LINE 原圖上限 10MB
+GENERATED_IMAGE_DIR = os.getenv("GENERATED_IMAGE_DIR", "generated_images")
+IMAGE_S3_BUCKET = os.getenv("IMAGE_S3_BUCKET")
+IMAGE_S3_PREFIX = os.getenv("IMAGE_S3_PREFIX", "generated/")
+IMAGE_S3_ENDPOINT_URL = os.getenv("IMAGE_S3_ENDPOINT_URL")
+IMAGE_S3_REGION = os.getenv("IMAGE_S3_REGION")
+IMAGE_PREVIEW_EDGE = _int("IMAGE_PREVIEW_EDGE", 240)
+GENERATED_IMAGE_CACHE_TTL = _int("GENERATED_IMAGE_CACHE_TTL", 86400)
+GENERATED_IMAGE_CACHE_MAX_ENTRIES = _int("GENERATED_IMAGE_CACHE_MAX_ENTRIES", 1000)
+GENERATED_IMAGE_CACHE_MAX_BYTES = _int("GENERATED_IMAGE_CACHE_MAX_BYTES", 256 * 1024 * 1024)
+GENERATED_IMAGE_STORE_MAX_BYTES = _int("GENERATED_IMAGE_STORE_MAX_BYTES", 256 * 1024 * 1024) # 儲存的圖片總量上限 (超過時從最舊的刪起)
+GENERATED_IMAGE_MAX_AGE = _int("GENERATED_IMAGE_MAX_AGE", 30 * 86400) # 圖片保留秒數 (之後聊天記錄中的舊圖片會無法載入)
+
+# --- 維運 ---
+PROFILER_ENABLED = _flag("PROFILER_ENABLED")
+PROFILER_INTERVAL = _float("PROFILER_INTERVAL", 0.01)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN") # /metrics 與 /debug/profile 需要 Authorization: Bearer <token>；未設定時只允許本機連線 (反向代理在同一台機器時務必設定)
+HEALTH_PROBE_INTERVAL = _float("HEALTH_PROBE_INTERVAL", 30)
+HEALTH_PROBE_TIMEOUT = _float("HEALTH_PROBE_TIMEOUT", 5)
+MIGRATE_ON_START = _flag("MIGRATE_ON_START", "1") # 啟動時執行資料庫遷移 (gunicorn master、python app.py、async_app 的 lifespan)；0 = 由部署步驟執行 python migrate.py
+PORT = _int("PORT", 5000)
+
@@ -0,0 +1,97 @@
+"""串流回覆：把 chat completion 的串流切成句子完整的段落，提早推送給使用者，同時遵守 LINE 的訊息數與字數上限"""
+import time
+
+LINE_MAX_TEXT_CHARS = 5000       # 單則文字訊息字數上限
+LINE_MAX_MESSAGES_PER_PUSH = 5   # 單次 push 訊息數上限
+SENTENCE_ENDINGS = ("。", "！", "？", "!", "?", "\n", "；", "…")
+
+
+def _last_boundary(text, limit=None):
+    """text[:limit] 內最後一個句尾 (回傳切點，含標點)；找不到回傳 0"""
+    end = len(text) if limit is None else min(limit, len(text))
+    best = 0
+    for mark in SENTENCE_ENDINGS:
+        idx = text.rfind(mark, 0, end)
+        if idx >= 0:
+            best = max(best, idx + len(mark))
+    dot = text.rfind(". ", 0, end)  # 英文句點需後接空白，避免切到小數點或網址
+    if dot >= 0:
+        best = max(best, dot + 1)
+    return best
+
+
+def split_for_line(text, max_chars=LINE_MAX_TEXT_CHARS):
+    """把長文字切成每則不超過 max_chars 的訊息，盡量在句尾切開"""
+    messages = []
+    text = text.strip()
+    while len(text) > max_chars:
+        cut = _last_boundary(text, max_chars) or max_chars
+        messages.append(text[:cut].strip())
+        text = text[cut:].strip()
+    if text:
+        messages.append(text)
+    return [m for m in messages if m]
+
+
+def group_for_push(messages, per_push=LINE_MAX_MESSAGES_PER_PUSH):
+    """每 per_push 則一組 (一次 push)"""
+    return [messages[i:i + per_push] for i in range(0, len(messages), per_push)]
+
+
+class StreamChunker:
+    """
+    累積串流文字，累積到 min_chars 字、或距離上次推送已超過 max_wait 秒時，在最後一個句尾切出一段提早推送。
+    最多提早推送 max_early_chunks 次 (控制 push 次數)，之後的內容留到 finish() 一次送出。
+    """
+
+    def __init__(self, min_chars=200, max_wait=3.0, max_early_chunks=3, min_wait_chars=20, clock=time.monotonic):
+        self.min_chars = min_chars
+        self.max_wait = max_wait
+        self.max_early_chunks = max_early_chunks
+        self.min_wait_chars = min_wait_chars  # 時間到了也至少要有這麼多字才推送
+        self.clock = clock
+        self.buffer = ""
+        self.early_chunks = 0
+        self._last_emit = clock()
+
+    def add(self, delta):
+        """加入一段串流文字，回傳現在可以推送的段落 (list，通常是空的或一段)"""
+        self.buffer += delta
+        if self.early_chunks >= self.max_early_chunks:
+            return []
+        waited = self.clock() - self._last_emit
+        if len(self.buffer) < self.min_chars and not (waited >= self.max_wait and len(self.buffer) >= self.min_wait_chars):
+            return []
+        cut = _last_boundary(self.buffer, LINE_MAX_TEXT_CHARS)
+        if not cut:
+            if len(self.buffer) < LINE_MAX_TEXT_CHARS:
+                return []
+            cut = LINE_MAX_TEXT_CHARS  # 整段沒有句尾又超過單則上限，只好硬切
+        chunk, self.buffer = self.buffer[:cut].strip(), self.buffer[cut:]
+        if not chunk:
+            return []
+        self.early_chunks += 1
+        self._last_emit = self.clock()
+        return [chunk]
+
+    def finish(self, extra=None):
+        """串流結束：剩餘內容 (可附加 extra，例如錯誤訊息) 切成訊息並分組，回傳 [[msg, ...], ...] 每組一次 push"""
+        text = self.buffer
+        if extra:
+            text = f"{text.rstrip()}\n{extra}" if text.strip() else extra
+        self.buffer = ""
+        return group_for_push(split_for_line(text))
+
+
+def stream_deltas(stream):
+    """從 chat completion 串流取出文字片段"""
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+async def astream_deltas(stream):
+    """stream_deltas 的 async 版本"""
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
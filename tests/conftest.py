@@ -0,0 +1,5 @@
+"""測試直接匯入專案根目錄的模組 (扁平結構，沒有套件)"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
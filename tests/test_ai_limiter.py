@@ -0,0 +1,147 @@
+"""ai_limiter：AIMD 調整、延遲換算、依使用者輪流放行、429 重試、本地限流"""
+import time
+import asyncio
+import threading
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from openai import RateLimitError
+
+from ai_limiter import AiLimiter, AsyncAiLimiter, AimdConcurrency, LocalRateLimitError, congestion_latency
+
+
+def _rate_limit_error(retry_after="0"):
+    request = httpx.Request("POST", "https://api.x.ai/v1/chat/completions")
+    response = httpx.Response(429, request=request, headers={"retry-after": retry_after})
+    return RateLimitError("rate limited", response=response, body=None)
+
+
+def _wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.005)
+    return False
+
+
+def test_aimd_additive_increase_and_multiplicative_decrease():
+    aimd = AimdConcurrency(initial=4, maximum=8, target_latency=10, cooldown=2.0)
+    for _ in range(5):
+        aimd.on_success(1.0, now=0.0)  # 每次 +1/limit，約一輪 (limit 次成功) +1
+    assert aimd.current == 5
+    before = aimd.limit
+    aimd.on_throttled(now=10.0)
+    assert aimd.limit == pytest.approx(before * 0.5)
+    aimd.on_throttled(now=11.0)  # cooldown 內不再降
+    assert aimd.limit == pytest.approx(before * 0.5)
+    before = aimd.limit
+    aimd.on_success(30.0, now=20.0)  # 延遲超過 target_latency
+    assert aimd.limit == pytest.approx(before * 0.9)
+
+
+def test_congestion_latency_scales_long_completions():
+    long_reply = SimpleNamespace(usage=SimpleNamespace(completion_tokens=1500))
+    short_reply = SimpleNamespace(usage=SimpleNamespace(completion_tokens=100))
+    assert congestion_latency(long_reply, 40.0) == pytest.approx(8.0)
+    assert congestion_latency(short_reply, 4.0) == 4.0
+    assert congestion_latency(object(), 12.0) == 12.0  # 圖片等沒有 usage 的回應
+
+
+def test_long_completion_does_not_shrink_concurrency():
+    limiter = AiLimiter(default_model_rpm=6000, max_concurrency=4, initial_concurrency=4, target_latency=0.05)
+    reply = SimpleNamespace(usage=SimpleNamespace(completion_tokens=30000))
+
+    def slow_long_reply():
+        time.sleep(0.1)  # 超過 target_latency，但換算成 300 token 只有 0.001 秒
+        return reply
+
+    limiter.call("u1", "grok", slow_long_reply)
+    limiter.call("u1", "grok", lambda: None, latency_fn=lambda result, elapsed: None)
+    assert limiter.stats()["limit"] == 4
+
+
+def test_waiting_calls_are_granted_round_robin_by_user():
+    """heavy 已有兩個請求在排隊時，light 的請求排在 heavy 的第二個之前"""
+    limiter = AiLimiter(user_rpm=6000, user_burst=10, default_model_rpm=6000, max_concurrency=1, initial_concurrency=1)
+    gate = threading.Event()
+    order = []
+
+    def run(user_id, label, block=False):
+        def fn():
+            order.append(label)
+            if block:
+                gate.wait(5)
+        limiter.call(user_id, "grok", fn)
+
+    threads = [threading.Thread(target=run, args=("heavy", "h1", True))]
+    threads[0].start()
+    assert _wait_for(lambda: order == ["h1"])
+    for user_id, label in (("heavy", "h2"), ("heavy", "h3"), ("light", "l1")):
+        t = threading.Thread(target=run, args=(user_id, label))
+        t.start()
+        threads.append(t)
+        expected = len(threads) - 1
+        assert _wait_for(lambda: limiter.stats()["waiting"] == expected)
+    gate.set()
+    for t in threads:
+        t.join(5)
+    assert order == ["h1", "h2", "l1", "h3"]
+
+
+def test_rate_limit_error_is_retried_and_halves_concurrency():
+    limiter = AiLimiter(default_model_rpm=6000, max_concurrency=8, initial_concurrency=8, backoff_base=0.01)
+    calls = []
+
+    def fn():
+        calls.append(1)
+        if len(calls) == 1:
+            raise _rate_limit_error()
+        return "ok"
+
+    assert limiter.call("u1", "grok", fn) == "ok"
+    stats = limiter.stats()
+    assert (len(calls), stats["retries"], stats["throttled"], stats["limit"]) == (2, 1, 1, 4)
+
+
+def test_user_bucket_rejects_when_wait_exceeds_max_wait():
+    limiter = AiLimiter(user_rpm=1, user_burst=1, default_model_rpm=6000, max_wait=0.2)
+    limiter.call("u1", "grok", lambda: None)
+    with pytest.raises(LocalRateLimitError):
+        limiter.call("u1", "grok", lambda: None)
+    limiter.call("u2", "grok", lambda: None)  # 其他使用者不受影響
+    assert limiter.stats()["rejected"] == 1
+
+
+def test_async_limiter_round_robin_and_retry():
+    async def main():
+        limiter = AsyncAiLimiter(user_rpm=6000, user_burst=10, default_model_rpm=6000, max_concurrency=1, initial_concurrency=1, backoff_base=0.01)
+        gate = asyncio.Event()
+        order = []
+        failed = []
+
+        def make(label, block=False, fail_once=False):
+            async def fn():
+                order.append(label)
+                if block:
+                    await gate.wait()
+                if fail_once and not failed:
+                    failed.append(label)
+                    raise _rate_limit_error()
+                return label
+            return fn
+
+        first = asyncio.create_task(limiter.call("heavy", "grok", make("h1", block=True)))
+        await asyncio.sleep(0.01)
+        rest = [asyncio.create_task(limiter.call(user_id, "grok", make(label, fail_once=(label == "h2"))))
+                for user_id, label in (("heavy", "h2"), ("heavy", "h3"), ("light", "l1"))]
+        await asyncio.sleep(0.01)
+        gate.set()
+        results = await asyncio.gather(first, *rest)
+        return order, results, limiter.stats()
+
+    order, results, stats = asyncio.run(main())
+    assert results == ["h1", "h2", "h3", "l1"]
+    assert order.index("l1") < order.index("h3")
+    assert (stats["retries"], stats["throttled"], stats["inflight"], stats["waiting"]) == (1, 1, 0, 0)
@@ -0,0 +1,14 @@
+"""benchmark.percentile：nearest-rank (第 ceil(p/100 * n) 個值)"""
+from benchmark import percentile
+
+
+def test_percentile_nearest_rank():
+    values = list(range(1, 101))
+    assert percentile(values, 99) == 99
+    assert percentile(values, 50) == 50
+    assert percentile(values, 7) == 7
+    assert percentile(values, 100) == 100
+    assert percentile(list(range(1, 11)), 10) == 1
+    assert percentile(list(range(1, 11)), 0) == 1
+    assert percentile([5], 99) == 5
+    assert percentile([], 50) is None
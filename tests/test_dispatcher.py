@@ -0,0 +1,99 @@
+"""KeyedDispatcher / AsyncKeyedDispatcher：同一個 key 依序且不同時處理、不同 key 輪流、待處理上限"""
+import time
+import asyncio
+import threading
+
+from dispatcher import KeyedDispatcher, AsyncKeyedDispatcher
+
+
+def test_same_key_runs_in_order_and_never_concurrently():
+    lock = threading.Lock()
+    active = set()
+    overlaps = []
+    seen = {}
+
+    def handler(key, n):
+        with lock:
+            if key in active:
+                overlaps.append(key)
+            active.add(key)
+        time.sleep(0.005)
+        with lock:
+            active.discard(key)
+            seen.setdefault(key, []).append(n)
+
+    dispatcher = KeyedDispatcher(handler, workers=4, max_pending=100)
+    for n in range(10):
+        for key in ("a", "b", "c"):
+            assert dispatcher.submit(key, n)
+    dispatcher.stop(timeout=5)
+    assert overlaps == []
+    assert seen == {key: list(range(10)) for key in ("a", "b", "c")}
+
+
+def test_keys_take_turns():
+    """一個 key 洗版時，其他 key 的事件不用等它全部處理完"""
+    gate = threading.Event()
+    order = []
+
+    def handler(key, n):
+        if not order:
+            gate.wait(5)
+        order.append((key, n))
+
+    dispatcher = KeyedDispatcher(handler, workers=1, max_pending=100)
+    dispatcher.submit("heavy", 0)
+    time.sleep(0.05)  # 讓唯一的 worker 卡在第一個事件
+    for n in range(1, 4):
+        dispatcher.submit("heavy", n)
+    dispatcher.submit("light", 0)
+    gate.set()
+    dispatcher.stop(timeout=5)
+    assert order == [("heavy", 0), ("light", 0), ("heavy", 1), ("heavy", 2), ("heavy", 3)]
+
+
+def test_submit_rejects_when_full_and_exceptions_do_not_kill_workers():
+    gate = threading.Event()
+    done = []
+
+    def handler(key, n):
+        gate.wait(5)
+        if n == 0:
+            raise RuntimeError("boom")
+        done.append(n)
+
+    dispatcher = KeyedDispatcher(handler, workers=1, max_pending=3)
+    assert all(dispatcher.submit("k", n) for n in range(3))
+    assert dispatcher.submit("other", 3) is False
+    assert dispatcher.stats()["pending"] == 3
+    gate.set()
+    dispatcher.stop(timeout=5)
+    assert done == [1, 2]
+    assert dispatcher.stats()["pending"] == 0
+
+
+def test_async_dispatcher_orders_per_key_and_limits_concurrency():
+    async def main():
+        running = 0
+        peak = 0
+        seen = {}
+
+        async def handler(key, n):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+            seen.setdefault(key, []).append(n)
+
+        dispatcher = AsyncKeyedDispatcher(handler, concurrency=2, max_pending=12)
+        for n in range(4):
+            for key in ("a", "b", "c"):
+                assert dispatcher.submit(key, n)
+        assert dispatcher.submit("d", 0) is False
+        await dispatcher.stop()
+        return peak, seen
+
+    peak, seen = asyncio.run(main())
+    assert peak <= 2
+    assert seen == {key: list(range(4)) for key in ("a", "b", "c")}
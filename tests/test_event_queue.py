@@ -0,0 +1,211 @@
+"""事件佇列：去重、每位使用者依序取出、租約過期後重新取出與 renew 的 attempts 檢查、consumer 不重複處理、佇列深度上限"""
+import json
+import time
+import threading
+from collections import Counter
+
+import pytest
+
+import event_queue
+from event_queue import SqliteEventQueue, PostgresEventQueue, EventQueueConsumer, QueueDepthGate, QueueFullError, create_event_queue
+
+
+def _row(key, user_id):
+    return (key, user_id, json.dumps({"key": key}))
+
+
+@pytest.fixture
+def queue(tmp_path):
+    q = SqliteEventQueue(str(tmp_path / "events.db"), lease_seconds=60, max_attempts=3, retry_delay=0)
+    yield q
+    q.close()
+
+
+def _wait_for(predicate, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_enqueue_ignores_redelivered_events(queue):
+    assert queue.enqueue_many([_row("m1", "u1"), _row("m2", "u2")]) == 2
+    assert queue.enqueue_many([_row("m1", "u1"), _row("m3", "u1")]) == 1
+    queue.ack(queue.claim(10)[0].id)
+    assert queue.enqueue_many([_row("m1", "u1")]) == 0  # 處理完的事件在保留期間內仍去重
+
+
+def test_claim_only_oldest_unfinished_event_per_user(queue):
+    queue.enqueue_many([_row("a1", "alice"), _row("a2", "alice"), _row("b1", "bob")])
+    claimed = queue.claim(10)
+    assert [e.payload["key"] for e in claimed] == ["a1", "b1"]
+    assert queue.claim(10) == []  # a2 要等 a1 完成
+    queue.ack(claimed[0].id)
+    assert [e.payload["key"] for e in queue.claim(10)] == ["a2"]
+
+
+def test_failed_event_is_retried_before_later_events_of_same_user(queue):
+    queue.enqueue_many([_row("a1", "alice"), _row("a2", "alice")])
+    first = queue.claim(10)[0]
+    queue.fail(first.id, first.attempts, RuntimeError("boom"))
+    retried = queue.claim(10)
+    assert [(e.payload["key"], e.attempts) for e in retried] == [("a1", 2)]
+    queue.fail(retried[0].id, retried[0].attempts, RuntimeError("boom"))
+    third = queue.claim(10)[0]
+    queue.fail(third.id, third.attempts, RuntimeError("boom"))  # 第 3 次 (max_attempts) 失敗後不再重試
+    assert [e.payload["key"] for e in queue.claim(10)] == ["a2"]
+    assert queue.stats()["failed"] == 1
+
+
+def test_release_does_not_count_as_attempt(queue):
+    queue.enqueue_many([_row("a1", "alice")])
+    event = queue.claim(1)[0]
+    queue.release(event.id)
+    assert queue.claim(1)[0].attempts == 1
+
+
+def test_expired_lease_is_reclaimed_and_stale_renew_is_rejected(tmp_path):
+    q = SqliteEventQueue(str(tmp_path / "events.db"), lease_seconds=0.1)
+    try:
+        q.enqueue_many([_row("a1", "alice")])
+        first = q.claim(1)[0]
+        assert q.claim(1) == []  # 租約還沒過期
+        time.sleep(0.15)
+        second = q.claim(1)[0]
+        assert (second.id, second.attempts) == (first.id, 2)
+        assert q.renew(first.id, first.attempts) is False  # 舊的取出已經失效，不應再處理
+        assert q.renew(second.id, second.attempts) is True
+        q.ack(second.id)
+        assert q.renew(second.id, second.attempts) is False
+    finally:
+        q.close()
+
+
+def test_create_event_queue_picks_backend_from_dsn(tmp_path):
+    assert isinstance(create_event_queue(dsn="postgresql://db/app"), PostgresEventQueue)
+    assert isinstance(create_event_queue(dsn="postgres://db/app"), PostgresEventQueue)
+    assert isinstance(create_event_queue(path=str(tmp_path / "q.db"), dsn="sqlite:///history.db"), SqliteEventQueue)
+    assert isinstance(create_event_queue("sqlite", path=str(tmp_path / "q.db"), dsn="postgres://db/app"), SqliteEventQueue)
+
+
+def test_consumer_processes_each_event_once_despite_redelivery_and_short_lease(tmp_path):
+    """處理時間比租約長、LINE 又重送同一批事件時，每個事件仍只處理一次，同一位使用者依序處理"""
+    q = SqliteEventQueue(str(tmp_path / "events.db"), lease_seconds=0.1, retry_delay=0)
+    handled = Counter()
+    order = []
+    lock = threading.Lock()
+
+    def handler(user_id, payload):
+        time.sleep(0.25)  # 比租約長：租約過期後會被自己的 consumer 重新取出
+        with lock:
+            handled[payload["key"]] += 1
+            order.append((user_id, payload["key"]))
+
+    rows = [_row(f"{user}-{i}", user) for i in range(3) for user in ("alice", "bob")]
+    consumer = EventQueueConsumer(q, handler, workers=2, max_pending=10, poll_interval=0.02)
+    try:
+        q.enqueue_many(rows)
+        consumer.start()
+        q.enqueue_many(rows)  # 重送
+        consumer.notify()
+        assert _wait_for(lambda: q.stats().get("done", 0) == len(rows))
+        time.sleep(0.3)  # 確認沒有遲來的重複處理
+    finally:
+        consumer.stop(timeout=5)
+        q.close()
+    assert handled == Counter({key: 1 for key, _, _ in rows})
+    for user in ("alice", "bob"):
+        assert [key for u, key in order if u == user] == [f"{user}-{i}" for i in range(3)]
+
+
+def test_consumer_retries_failed_event_before_next_event_of_same_user(tmp_path):
+    q = SqliteEventQueue(str(tmp_path / "events.db"), lease_seconds=60, retry_delay=0)
+    calls = []
+    lock = threading.Lock()
+
+    def handler(user_id, payload):
+        with lock:
+            calls.append(payload["key"])
+            if calls.count("a1") == 1 and payload["key"] == "a1":
+                raise RuntimeError("temporary")
+
+    consumer = EventQueueConsumer(q, handler, workers=4, max_pending=10, poll_interval=0.02)
+    try:
+        q.enqueue_many([_row("a1", "alice"), _row("a2", "alice")])
+        consumer.start()
+        assert _wait_for(lambda: q.stats().get("done", 0) == 2)
+    finally:
+        consumer.stop(timeout=5)
+        q.close()
+    assert calls == ["a1", "a1", "a2"]
+
+
+def test_consumer_retries_ack_and_keeps_worker_alive(tmp_path, monkeypatch):
+    """ack 暫時失敗 (例如等不到連線) 時重試，不讓例外離開 worker，也不會等租約過期後重複處理"""
+    monkeypatch.setattr(event_queue, "SETTLE_RETRY_DELAY", 0.01)
+
+    class FlakyAckQueue(SqliteEventQueue):
+        ack_failures = 1
+
+        def ack(self, event_id):
+            if self.ack_failures:
+                self.ack_failures -= 1
+                raise event_queue.QueueTimeoutError("pool exhausted")
+            super().ack(event_id)
+
+    q = FlakyAckQueue(str(tmp_path / "events.db"), lease_seconds=60, retry_delay=0)
+    handled = Counter()
+    consumer = EventQueueConsumer(q, lambda user_id, payload: handled.update([payload["key"]]), workers=1, max_pending=10, poll_interval=0.02)
+    try:
+        q.enqueue_many([_row("a1", "alice"), _row("a2", "alice")])
+        consumer.start()
+        assert _wait_for(lambda: q.stats().get("done", 0) == 2)
+    finally:
+        consumer.stop(timeout=5)
+        q.close()
+    assert handled == Counter({"a1": 1, "a2": 1})
+
+
+def test_postgres_queue_waits_for_a_free_connection_slot():
+    """連線都借出時排隊等待，超過 checkout_timeout 才丟 QueueTimeoutError (不是立即 PoolError)"""
+    q = PostgresEventQueue("postgresql://db/app", maxconn=1, checkout_timeout=0.1)
+    assert q._slots.acquire(timeout=0)  # 模擬另一個執行緒借走唯一的連線
+    start = time.monotonic()
+    with pytest.raises(event_queue.QueueTimeoutError):
+        q.stats()
+    assert time.monotonic() - start >= 0.1
+    assert q._pool is None  # 沒拿到名額就不會建立連線
+
+
+def test_depth_gate_rejects_when_queue_is_full(queue):
+    now = [0.0]
+    gate = QueueDepthGate(queue, max_pending=3, refresh_interval=1.0, clock=lambda: now[0])
+    assert gate.enqueue_many([_row("a1", "alice"), _row("b1", "bob")]) == 2
+    assert gate.enqueue_many([_row("c1", "carol")]) == 1
+    with pytest.raises(QueueFullError):
+        gate.enqueue_many([_row("d1", "dave")])  # 還沒重新查詢：以寫入數估算的深度已達上限
+    assert (gate.depth, gate.rejected) == (3, 1)
+    for event in queue.claim(10):
+        queue.ack(event.id)
+    now[0] = 2.0  # 超過 refresh_interval，重新查詢
+    assert gate.enqueue_many([_row("d1", "dave")]) == 1
+    assert gate.depth == 1
+
+
+def test_depth_gate_caches_stats_between_refreshes(queue):
+    calls = []
+    original = queue.stats
+    queue.stats = lambda: calls.append(1) or original()
+    now = [0.0]
+    gate = QueueDepthGate(queue, max_pending=100, refresh_interval=1.0, clock=lambda: now[0])
+    for n in range(5):
+        gate.enqueue_many([_row(f"m{n}", "alice")])
+    assert len(calls) == 1
+    now[0] = 1.5
+    assert gate.refresh() == 5
+    assert len(calls) == 2
+    unlimited = QueueDepthGate(queue, max_pending=0)
+    unlimited.enqueue_many([_row("x", "bob")])
+    assert len(calls) == 2  # 不限制時不查詢
@@ -0,0 +1,142 @@
+"""generated_images：內容定址存放與預覽圖、檔名檢查、儲存空間清理 (存放時間/總量/剛存入的寬限)、相同提示只生成一次、圖片被清掉後重新生成"""
+import io
+import os
+import time
+import threading
+
+import pytest
+from PIL import Image
+
+from generated_images import GeneratedImageStore, LocalImageBackend, PromptResultCache, PREVIEW_SUFFIX
+
+
+def _image_bytes(color, size=(64, 64), fmt="PNG"):
+    out = io.BytesIO()
+    Image.new("RGB", size, color).save(out, format=fmt)
+    return out.getvalue()
+
+
+@pytest.fixture
+def backend(tmp_path):
+    return LocalImageBackend(str(tmp_path / "images"))
+
+
+def _store(backend, **kwargs):
+    kwargs.setdefault("sweep_interval", 3600)
+    return GeneratedImageStore(backend, "https://bot.example.com/", **kwargs)
+
+
+def _age(backend, name, seconds):
+    """把原圖與預覽圖的修改時間往前調"""
+    digest = name[:64]
+    for n in (name, digest + PREVIEW_SUFFIX):
+        path = backend._path(n)
+        mtime = time.time() - seconds
+        os.utime(path, (mtime, mtime))
+
+
+def test_save_is_content_addressed_with_preview(backend):
+    store = _store(backend)
+    name, size = store.save(_image_bytes((255, 0, 0)))
+    assert name.endswith(".png") and len(name) == 68
+    assert store.save(_image_bytes((255, 0, 0)))[0] == name
+    assert sorted(n for n, _, _ in backend.list_objects()) == sorted([name, name[:64] + PREVIEW_SUFFIX])
+    assert store.urls(name) == (f"https://bot.example.com/images/{name}", f"https://bot.example.com/images/{name[:64]}{PREVIEW_SUFFIX}")
+    assert store.read(name)[1] == "image/png"
+    preview, content_type = store.read(name[:64] + PREVIEW_SUFFIX)
+    assert content_type == "image/jpeg" and Image.open(io.BytesIO(preview)).size == (64, 64)
+    webp, _ = store.save(_image_bytes((0, 255, 0), fmt="WEBP"))
+    assert webp.endswith(".jpg")  # LINE 只接受 JPEG/PNG
+
+
+def test_read_rejects_invalid_names(backend):
+    store = _store(backend)
+    assert store.read("../secret.png") == (None, None)
+    assert store.read("a" * 64 + ".gif") == (None, None)
+    assert store.read("a" * 64 + ".png") == (None, None)  # 不存在
+
+
+def test_sweep_deletes_images_older_than_max_age(backend):
+    store = _store(backend, max_age=100, max_storage_bytes=0)
+    old, _ = store.save(_image_bytes((1, 1, 1)))
+    new, _ = store.save(_image_bytes((2, 2, 2)))
+    _age(backend, old, 200)
+    assert store.sweep() == 1
+    assert not backend.exists(old) and not backend.exists(old[:64] + PREVIEW_SUFFIX)
+    assert backend.exists(new)
+    assert store.stats()["swept"] == 1
+
+
+def test_sweep_trims_oldest_images_over_storage_limit_but_keeps_recent_ones(backend):
+    store = _store(backend, max_age=0, sweep_interval=60)
+    names = [store.save(_image_bytes((n, n, n)))[0] for n in range(4)]
+    per_image = sum(size for _, size, _ in backend.list_objects()) / 4
+    store.max_storage_bytes = int(per_image * 2.5)
+    assert store.sweep() == 0  # 全部都是剛存入的圖片
+    for i, name in enumerate(names[:3]):
+        _age(backend, name, 1000 - i)  # names[0] 最舊，names[3] 剛存入
+    assert store.sweep() == 2
+    assert [backend.exists(n) for n in names] == [False, False, True, True]
+
+
+def test_save_triggers_sweep_at_most_once_per_interval(backend):
+    store = _store(backend, max_age=100, sweep_interval=3600)
+    old, _ = store.save(_image_bytes((1, 1, 1)))
+    _age(backend, old, 200)
+    store._last_sweep = time.monotonic()  # 剛清理過
+    store.save(_image_bytes((2, 2, 2)))
+    assert backend.exists(old)  # 距上次清理不到 sweep_interval
+    store.sweep_interval = 0
+    store.save(_image_bytes((3, 3, 3)))
+    assert not backend.exists(old)
+
+
+def test_same_prompt_is_generated_once(backend):
+    store = _store(backend)
+    release = threading.Event()
+    calls = []
+
+    def generate():
+        calls.append(1)
+        release.wait(5)
+        return _image_bytes((9, 9, 9))
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(store.get_or_generate("  一隻 貓 ", generate))) for _ in range(3)]
+    for t in threads:
+        t.start()
+    deadline = time.monotonic() + 5
+    while store.stats()["coalesced"] < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    release.set()
+    for t in threads:
+        t.join(5)
+    assert len(calls) == 1
+    assert sorted(hit for _, hit in results) == [False, True, True]
+    assert len({name for name, _ in results}) == 1
+    assert store.get_or_generate("一隻 貓", generate) == (results[0][0], True)
+
+
+def test_prompt_is_regenerated_after_its_image_is_swept(backend):
+    store = _store(backend, max_age=100)
+    name, hit = store.get_or_generate("夕陽", lambda: _image_bytes((5, 5, 5)))
+    assert hit is False
+    _age(backend, name, 200)
+    store.sweep()
+    calls = []
+    assert store.get_or_generate("夕陽", lambda: calls.append(1) or _image_bytes((5, 5, 5))) == (name, False)
+    assert calls == [1]
+
+
+def test_prompt_cache_evicts_by_entries_and_bytes():
+    cache = PromptResultCache(ttl=60, max_entries=2, max_bytes=100)
+    cache.put("a", "a.png", 40)
+    cache.put("b", "b.png", 40)
+    cache.get("a")
+    cache.put("c", "c.png", 40)  # 擠掉最久沒用的 b
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == ("a.png", None, "c.png")
+    cache.put("d", "d.png", 90)
+    assert len(cache) == 1 and cache.total_bytes == 90
+    expired = PromptResultCache(ttl=0)
+    expired.put("a", "a.png", 1)
+    assert expired.get("a") is None and expired.total_bytes == 0
@@ -0,0 +1,68 @@
+"""history_cache：裁剪到 limit、write-through 附加、TTL、筆數/位元組上限淘汰、多 worker 時停用程序內快取"""
+
+from history_cache import HistoryCache, NullHistoryCache, create_history_cache, estimate_bytes, ENTRY_OVERHEAD_BYTES
+
+
+def _msgs(*texts):
+    return [{"role": "user", "content": t} for t in texts]
+
+
+def test_put_trims_to_limit_and_get_returns_copy():
+    cache = HistoryCache(limit=2)
+    cache.put("u1", _msgs("a", "b", "c"))
+    history = cache.get("u1")
+    assert history == _msgs("b", "c")
+    history.append("x")
+    assert cache.get("u1") == _msgs("b", "c")
+    assert cache.get("u2") is None
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 1
+
+
+def test_append_updates_cached_users_only():
+    cache = HistoryCache(limit=3)
+    cache.put("u1", _msgs("a", "b"))
+    cache.append("u1", _msgs("c", "d"))
+    assert cache.get("u1") == _msgs("b", "c", "d")
+    cache.append("u2", _msgs("x"))  # 沒有快取的使用者不建立 (下次從資料庫載入完整資料)
+    assert cache.get("u2") is None
+    cache.invalidate("u1")
+    assert cache.get("u1") is None
+
+
+def test_expired_entries_are_misses():
+    cache = HistoryCache(limit=5, ttl=-1)
+    cache.put("u1", _msgs("a"))
+    assert cache.get("u1") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_evicts_least_recently_used_by_entries_and_bytes():
+    cache = HistoryCache(limit=5, max_entries=2)
+    cache.put("u1", _msgs("a"))
+    cache.put("u2", _msgs("b"))
+    cache.get("u1")
+    cache.put("u3", _msgs("c"))
+    assert (cache.get("u1"), cache.get("u2"), cache.get("u3")) == (_msgs("a"), None, _msgs("c"))
+    assert cache.stats()["evictions"] == 1
+
+    per_entry = estimate_bytes(_msgs("x"))
+    small = HistoryCache(limit=5, max_bytes=per_entry * 2)
+    small.put("u1", _msgs("x"))
+    small.put("u2", _msgs("y"))
+    small.put("u3", _msgs("z"))
+    assert small.get("u1") is None and small.stats()["bytes"] == per_entry * 2
+    small.put("big", _msgs("x", "y", "z"))  # 單筆就超過上限，不快取
+    assert small.get("big") is None
+
+
+def test_estimate_bytes():
+    assert estimate_bytes(_msgs("你好")) == ENTRY_OVERHEAD_BYTES + 6
+
+
+def test_create_history_cache_picks_backend():
+    assert isinstance(create_history_cache(10), HistoryCache)
+    assert isinstance(create_history_cache(10, processes=4), NullHistoryCache)
+    null = NullHistoryCache()
+    null.put("u1", _msgs("a"))
+    assert null.get("u1") is None
+    assert null.stats()["backend"] == "disabled"
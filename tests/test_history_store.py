@@ -0,0 +1,109 @@
+"""history_store：SQLite 版讀寫、清理週期、write-behind 批次寫入與讀取前落地、PostgreSQL 單一使用者寫入走 prepared INSERT"""
+import pytest
+
+from history_store import HistoryRepository, SqliteHistoryRepository, PruneSchedule, create_history_repository, PREPARED_STATEMENTS
+
+
+def _msgs(*texts):
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": t, "tokens": len(t)} for i, t in enumerate(texts)]
+
+
+@pytest.fixture
+def make_repo(tmp_path):
+    repos = []
+
+    def make(**kwargs):
+        repo = create_history_repository(f"sqlite:///{tmp_path / 'history.db'}", **kwargs)
+        repo.init_schema()
+        repos.append(repo)
+        return repo
+
+    yield make
+    for repo in repos:
+        repo.close()
+
+
+def _count(repo, user_id):
+    return repo._run(lambda conn, cur: cur.execute("SELECT COUNT(*) FROM conversation_messages WHERE user_id = ?", (user_id,)).fetchone()[0])
+
+
+def test_append_and_load_recent_messages_in_order(make_repo):
+    repo = make_repo()
+    assert isinstance(repo, SqliteHistoryRepository)
+    repo.append("u1", _msgs("a", "b"))
+    repo.append("u1", _msgs("c\x00", "d"))
+    repo.append("u2", _msgs("x", "y"))
+    assert [m["content"] for m in repo.load("u1", 3)] == ["b", "c", "d"]
+    assert repo.load("u1", 1) == [{"role": "assistant", "content": "d", "tokens": 1}]
+    assert repo.load("nobody", 10) == []
+    assert repo.stats()["checked_out"] == 0
+
+
+def test_prune_schedule_counts_appends_per_user():
+    schedule = PruneSchedule(every=3)
+    assert [schedule.due(["u1", "u2"]) for _ in range(3)] == [[], [], ["u1", "u2"]]
+    assert schedule.due(["u1"]) == []
+    assert PruneSchedule(every=1).due(["u1"]) == ["u1"]
+    bounded = PruneSchedule(every=3, max_tracked=1)
+    assert bounded.due(["u1"]) == []
+    assert bounded.due(["u2"]) == ["u2"]  # 記錄已滿：未記錄的使用者直接清理
+
+
+def test_old_messages_are_pruned_every_n_appends(make_repo):
+    repo = make_repo(retain_messages=4, prune_every=3)
+    for n in range(5):
+        repo.append("u1", _msgs(f"q{n}", f"a{n}"))
+        assert _count(repo, "u1") == [2, 4, 4, 6, 8][n]  # 第 3 次寫入才清理，之間最多多留 prune_every 次的訊息
+    assert [m["content"] for m in repo.load("u1", 4)] == ["q3", "a3", "q4", "a4"]
+
+
+def test_write_behind_batches_users_and_flushes_before_load(make_repo):
+    repo = make_repo(write_behind=True, flush_interval=60, batch_size=100)
+    inserted = []
+    original = repo.insert_rows
+    repo.insert_rows = lambda rows: (inserted.append(len(rows)), original(rows))
+    repo.append("u1", _msgs("a", "b"))
+    repo.append("u2", _msgs("c", "d"))
+    assert repo.stats()["write_behind_pending"] == 4
+    assert [m["content"] for m in repo.load("u1", 10)] == ["a", "b"]  # 讀取前先寫入這位使用者的訊息
+    assert inserted == [4]  # 兩位使用者合併成一次 INSERT
+    assert [m["content"] for m in repo.load("u2", 10)] == ["c", "d"]
+
+
+def test_write_behind_close_flushes_remaining_rows(make_repo):
+    repo = make_repo(write_behind=True, flush_interval=60, batch_size=100)
+    repo.append("u1", _msgs("a"))
+    repo.close()
+    reader = make_repo()
+    assert [m["content"] for m in reader.load("u1", 10)] == ["a"]
+
+
+class _FakeCursor:
+    def __init__(self, log):
+        self.log = log
+
+    def execute(self, sql, params=None):
+        self.log.append((sql, params))
+
+
+class _FakeConnection:
+    def __init__(self):
+        self.prepared = set()
+
+
+def test_postgres_single_user_append_uses_prepared_insert():
+    repo = HistoryRepository("postgresql://db/app", retain_messages=10, prune_every=2)
+    conn, log = _FakeConnection(), []
+    repo._run = lambda fn: fn(conn, _FakeCursor(log))
+    repo.append("u1", _msgs("q1", "a1"))
+    repo.append("u1", _msgs("q2", "a2"))
+    statements = [sql for sql, _ in log]
+    assert statements[0] == PREPARED_STATEMENTS["history_insert"]
+    assert statements[1:] == [
+        "EXECUTE history_insert (%s, %s::text[], %s::text[], %s::int[])",
+        "EXECUTE history_insert (%s, %s::text[], %s::text[], %s::int[])",  # 同一條連線只 PREPARE 一次
+        statements[3],
+    ]
+    assert "DELETE FROM conversation_messages" in statements[3]  # 第 2 次寫入才清理
+    assert log[1][1] == ("u1", ["user", "assistant"], ["q1", "a1"], [2, 2])
+    assert log[3][1] == (["u1"], 10)
@@ -0,0 +1,71 @@
+"""html_extract：排除標籤、摘要額度用完即停止、charset 處理 (含多位元組字元跨塊)、DuckDuckGo 結果頁結構化解析"""
+from html_extract import (
+    HtmlSummaryExtractor, extract_html_summary, charset_from_content_type, format_search_results,
+    is_search_results_url, _resolve_result_url,
+)
+
+PAGE = "<html><head><style>.a{}</style><script>var x = 1;</script></head><body><nav>選單</nav><p>第一段</p><div>第二段<br>第三段</div><footer>頁尾</footer></body></html>"
+
+
+def test_extracts_text_outside_excluded_tags():
+    assert extract_html_summary(PAGE.encode("utf-8")) == "第一段\n第二段\n第三段"
+
+
+def test_stops_when_budget_is_used():
+    extractor = HtmlSummaryExtractor(budget=10)
+    assert extractor.feed("<p>一二三四五</p><p>六七八九十</p>".encode("utf-8")) is True
+    assert extractor.feed("<p>不應出現</p>".encode("utf-8")) is True
+    summary = extractor.summary()
+    assert len(summary) <= 10
+    assert summary.startswith("一二三四五")
+    assert "不應出現" not in summary
+
+
+def test_charset_from_content_type():
+    assert charset_from_content_type("text/html; charset=Big5") == "Big5"
+    assert charset_from_content_type('text/html; Charset="gbk"') == "gbk"
+    assert charset_from_content_type("text/html") is None
+    assert charset_from_content_type("text/html; charset=") is None
+
+
+def test_decodes_declared_charset_and_falls_back_to_utf8():
+    assert extract_html_summary("<p>繁體中文</p>".encode("big5"), charset="big5") == "繁體中文"
+    assert extract_html_summary("<p>简体中文</p>".encode("gbk"), charset="gbk") == "简体中文"
+    assert extract_html_summary("<p>未知編碼</p>".encode("utf-8"), charset="x-no-such-charset") == "未知編碼"
+
+
+def test_multibyte_character_split_across_chunks():
+    data = "<p>中文字</p>".encode("utf-8")
+    extractor = HtmlSummaryExtractor()
+    for i in range(len(data)):  # 一次餵一個 byte
+        extractor.feed(data[i:i + 1])
+    assert extractor.summary() == "中文字"
+
+
+def test_search_results_page_is_parsed_into_records():
+    html = (
+        '<div class="result"><a class="result__a" href="//duckduckgo.com/l/?uddg=https%3A%2F%2Fexample.com%2Fa%3Fb%3D1">範例 <b>標題</b></a>'
+        '<a class="result__snippet">範例  摘要</a></div>'
+        '<div class="result"><a class="result__a" href="https://duckduckgo.com/y.js?ad=1">廣告</a></div>'
+        '<div class="result"><a class="result__a" href="https://example.org/">第二筆</a></div>'
+    )
+    extractor = HtmlSummaryExtractor(structured=True)
+    extractor.feed(html.encode("utf-8"))
+    summary = extractor.summary()
+    assert extractor.results == [
+        {"title": "範例 標題", "url": "https://example.com/a?b=1", "snippet": "範例 摘要"},
+        {"title": "第二筆", "url": "https://example.org/", "snippet": ""},
+    ]
+    assert summary == format_search_results(extractor.results)
+    assert summary.startswith("1. 範例 標題\nhttps://example.com/a?b=1\n範例 摘要")
+
+
+def test_structured_mode_falls_back_to_text_without_results():
+    assert extract_html_summary("<p>沒有結果</p>".encode("utf-8"), structured=True) == "沒有結果"
+
+
+def test_search_result_urls():
+    assert is_search_results_url("https://html.duckduckgo.com/html/?q=x")
+    assert not is_search_results_url("https://example.com/")
+    assert _resolve_result_url("") == ""
+    assert _resolve_result_url("https://example.com/") == "https://example.com/"
@@ -0,0 +1,74 @@
+"""image_pipeline：下載大小上限、長邊縮到 max_edge、壓到 target_bytes 以下、透明背景、無法解碼、相同內容快取"""
+import io
+import base64
+import random
+
+import pytest
+from PIL import Image
+
+from image_pipeline import ImagePreprocessor, ImageTooLargeError, ImageProcessingError, read_bounded, MIN_EDGE
+
+
+def _image_bytes(size, fmt="PNG", mode="RGB", noise=False):
+    img = Image.new(mode, size, (200, 100, 50, 128) if mode == "RGBA" else (200, 100, 50))
+    if noise:  # 雜訊圖不容易壓縮，用來測試降品質/縮圖
+        rng = random.Random(0)
+        img.putdata([tuple(rng.randrange(256) for _ in mode) for _ in range(size[0] * size[1])])
+    out = io.BytesIO()
+    img.save(out, format=fmt)
+    return out.getvalue()
+
+
+def _decode(prepared):
+    return Image.open(io.BytesIO(base64.b64decode(prepared.b64)))
+
+
+def test_read_bounded():
+    assert read_bounded([b"ab", b"", b"cd"], max_bytes=4) == b"abcd"
+    with pytest.raises(ImageTooLargeError):
+        read_bounded(iter([b"ab", b"cd", b"e"]), max_bytes=4)
+    assert ImagePreprocessor(max_input_bytes=3).read([b"abc"]) == b"abc"
+
+
+def test_long_edge_is_scaled_to_max_edge():
+    prepared = ImagePreprocessor(max_edge=512).process(_image_bytes((2000, 1000), fmt="JPEG"))
+    img = _decode(prepared)
+    assert img.format == "JPEG" and prepared.mime == "image/jpeg"
+    assert (prepared.width, prepared.height) == img.size == (512, 256)
+    assert prepared.size == len(base64.b64decode(prepared.b64))
+
+
+def test_small_image_is_not_upscaled():
+    prepared = ImagePreprocessor(max_edge=1024).process(_image_bytes((300, 200)))
+    assert (prepared.width, prepared.height) == (300, 200)
+
+
+def test_output_is_compressed_below_target_bytes():
+    raw = _image_bytes((800, 800), noise=True)
+    prepared = ImagePreprocessor(max_edge=800, target_bytes=40 * 1024).process(raw)
+    assert prepared.size <= 40 * 1024
+    assert prepared.original_size == len(raw)
+    assert MIN_EDGE <= max(prepared.width, prepared.height) <= 800
+
+
+def test_transparent_png_is_flattened_and_webp_output():
+    prepared = ImagePreprocessor(output_format="webp").process(_image_bytes((100, 100), mode="RGBA"))
+    img = _decode(prepared)
+    assert prepared.mime == "image/webp" and img.format == "WEBP"
+    assert img.mode == "RGB"
+
+
+def test_invalid_image_and_unknown_format():
+    with pytest.raises(ImageProcessingError):
+        ImagePreprocessor().process(b"not an image")
+    with pytest.raises(ValueError):
+        ImagePreprocessor(output_format="GIF")
+
+
+def test_same_content_is_cached():
+    processor = ImagePreprocessor(cache_entries=1)
+    first, second = _image_bytes((100, 100)), _image_bytes((120, 100))
+    assert processor.process(first) is processor.process(first)
+    processor.process(second)  # 擠掉 first
+    processor.process(first)
+    assert processor.stats() == {"entries": 1, "hits": 1, "misses": 3}
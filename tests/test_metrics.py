@@ -0,0 +1,100 @@
+"""metrics：Prometheus 文字格式輸出 (計數器、直方圖、抓取時計算的量表)、階段計時與錯誤計數、量測端點的存取檢查、取樣 profiler"""
+import time
+import threading
+
+import pytest
+
+from metrics import Registry, CallbackMetric, SamplingProfiler, REGISTRY, stage, record_error, register_cache_stats, access_allowed
+
+
+def test_counter_and_histogram_render():
+    registry = Registry()
+    counter = registry.counter("test_total", "計數", ["kind"])
+    counter.inc("a")
+    counter.inc("a", amount=2)
+    counter.inc('b"\n')
+    histogram = registry.histogram("test_seconds", "耗時", ["stage"], buckets=(0.1, 1.0))
+    histogram.observe(0.05, "x")
+    histogram.observe(0.5, "x")
+    histogram.observe(5.0, "x")
+    lines = registry.render().splitlines()
+    assert "# TYPE test_total counter" in lines
+    assert 'test_total{kind="a"} 3' in lines
+    assert 'test_total{kind="b\\"\\n"} 1' in lines
+    assert 'test_seconds_bucket{stage="x",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{stage="x",le="1.0"} 2' in lines
+    assert 'test_seconds_bucket{stage="x",le="+Inf"} 3' in lines
+    assert 'test_seconds_sum{stage="x"} 5.55' in lines
+    assert 'test_seconds_count{stage="x"} 3' in lines
+
+
+def test_callback_metrics_are_computed_at_scrape_time():
+    registry = Registry()
+    depth = [1]
+    registry.gauge_callback("test_depth", "深度", lambda: depth[0])
+    registry.gauge_callback("test_states", "狀態", lambda: {"pending": 2, "done": 3}, ["status"])
+    registry.register(CallbackMetric("test_broken", "壞掉", lambda: 1 / 0))
+    depth[0] = 7
+    text = registry.render()
+    assert "test_depth 7\n" in text
+    assert 'test_states{status="done"} 3\n' in text and 'test_states{status="pending"} 2\n' in text
+    assert "# TYPE test_broken gauge\n" in text  # 取值失敗只略過數值，不影響其他量測
+
+
+def test_stage_times_and_counts_errors():
+    with stage("test_stage"):
+        pass
+    with pytest.raises(ValueError):
+        with stage("test_stage"):
+            raise ValueError("boom")
+    record_error("test_stage", KeyError())
+    text = REGISTRY.render()
+    assert 'linebot_stage_seconds_count{stage="test_stage"} 2' in text
+    assert 'linebot_errors_total{stage="test_stage",exception="ValueError"} 1' in text
+    assert 'linebot_errors_total{stage="test_stage",exception="KeyError"} 1' in text
+
+
+def test_cache_stats_are_exported():
+    register_cache_stats("test_cache", lambda: {"hits": 4, "misses": 1, "entries": 9})
+    text = REGISTRY.render()
+    assert 'linebot_cache_events_total{cache="test_cache",result="hits"} 4' in text
+    assert 'linebot_cache_events_total{cache="test_cache",result="misses"} 1' in text
+    assert 'result="entries"' not in text
+
+
+def test_access_allowed():
+    assert access_allowed("s3cret", "Bearer s3cret", "10.0.0.5")
+    assert access_allowed("s3cret", "bearer s3cret", "10.0.0.5")
+    assert not access_allowed("s3cret", "Bearer wrong", "127.0.0.1")  # 設定 token 後本機也要帶 token
+    assert not access_allowed("s3cret", None, "127.0.0.1")
+    assert not access_allowed("s3cret", "s3cret", "10.0.0.5")
+    assert access_allowed(None, None, "127.0.0.1")
+    assert access_allowed("", None, "::1")
+    assert not access_allowed(None, None, "10.0.0.5")  # 沒有 token 時只允許本機
+    assert not access_allowed(None, None, None)
+
+
+def test_sampling_profiler_collects_folded_stacks():
+    stop = threading.Event()
+
+    def busy_wait_for_profiler():
+        while not stop.is_set():
+            time.sleep(0.001)
+
+    worker = threading.Thread(target=busy_wait_for_profiler)
+    worker.start()
+    profiler = SamplingProfiler(interval=0.005)
+    profiler.start()
+    try:
+        deadline = time.monotonic() + 5
+        while "busy_wait_for_profiler" not in profiler.folded() and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        profiler.stop()
+        stop.set()
+        worker.join()
+    text = profiler.folded(top=1000, reset=True)
+    line = next(line for line in text.splitlines() if "busy_wait_for_profiler" in line)
+    stack, count = line.rsplit(" ", 1)
+    assert int(count) >= 1 and ";" in stack
+    assert profiler.folded() == "\n"
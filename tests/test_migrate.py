@@ -0,0 +1,41 @@
+"""migrate：建立歷史與事件佇列資料表、執行後標記環境變數讓 worker (async_app 的 lifespan) 不重複執行"""
+import pytest
+
+import migrate
+import settings
+from history_store import create_history_repository
+
+
+@pytest.fixture
+def sqlite_settings(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "DATABASE_URL", f"sqlite:///{tmp_path / 'history.db'}")
+    monkeypatch.setattr(settings, "EVENT_QUEUE_BACKEND", "sqlite")
+    monkeypatch.setattr(settings, "EVENT_QUEUE_PATH", str(tmp_path / "events.db"))
+    monkeypatch.setattr(settings, "MIGRATE_ON_START", True)
+    monkeypatch.delenv(migrate.MIGRATED_ENV, raising=False)
+    return tmp_path
+
+
+def test_run_migrations_creates_tables_and_marks_done(sqlite_settings):
+    assert migrate.migrations_pending()
+    migrate.run_migrations()
+    assert not migrate.migrations_pending()
+    assert (sqlite_settings / "events.db").exists()
+    repo = create_history_repository(settings.DATABASE_URL)
+    try:
+        repo.append("u1", [{"role": "user", "content": "hi"}])  # 資料表已存在
+        assert repo.load("u1", 10)[0]["content"] == "hi"
+    finally:
+        repo.close()
+
+
+def test_migrations_not_pending_when_disabled(sqlite_settings, monkeypatch):
+    monkeypatch.setattr(settings, "MIGRATE_ON_START", False)
+    assert not migrate.migrations_pending()
+
+
+def test_missing_database_url_raises(sqlite_settings, monkeypatch):
+    monkeypatch.setattr(settings, "DATABASE_URL", None)
+    with pytest.raises(RuntimeError):
+        migrate.run_migrations()
+    assert migrate.migrations_pending()
@@ -0,0 +1,84 @@
+"""prompt_builder：token 估算、目前訊息最多佔一半預算、以一問一答為單位捨棄歷史、摘要位置不影響快取前綴"""
+from prompt_builder import (
+    PromptBuilder, STABLE_SYSTEM_PROMPT, DROPPED_SUMMARY_PREFIX, TRUNCATED_NOTE,
+    estimate_text_tokens, estimate_content_tokens, estimate_message_tokens, truncate_text_to_tokens, with_token_estimate,
+)
+
+
+def _turns(n, text="這是一段對話內容"):
+    history = []
+    for i in range(n):
+        history.append(with_token_estimate({"role": "user", "content": f"問題{i} {text}"}))
+        history.append(with_token_estimate({"role": "assistant", "content": f"回答{i} {text}"}))
+    return history
+
+
+def test_token_estimates():
+    assert estimate_text_tokens("") == 0
+    assert estimate_text_tokens("你好") == 2
+    assert estimate_text_tokens("abcdefgh") == 2
+    assert estimate_content_tokens([{"type": "text", "text": "你好"}, {"type": "image_url", "image_url": {"url": "x"}}]) == 1002
+    assert estimate_message_tokens({"role": "user", "content": "很長" * 100, "tokens": 7}) == 7  # 已存的估算直接使用
+
+
+def test_truncate_text_to_tokens():
+    text = "字" * 100
+    truncated = truncate_text_to_tokens(text, 50)
+    assert truncated.endswith(TRUNCATED_NOTE)
+    assert estimate_text_tokens(truncated) <= 50
+    assert truncate_text_to_tokens("短", 50) == "短"
+
+
+def test_long_paste_is_capped_at_half_the_budget():
+    """貼上 7500 字時，目前訊息最多佔一半預算，歷史與搜尋資訊仍保留"""
+    builder = PromptBuilder({}, default_budget=8000)
+    history = _turns(1)
+    web_info = "搜尋結果" * 500  # 約 2000 tokens
+    messages, info = builder.build("grok", history, "貼" * 7500, context_notes=["目前時間：2026-10-17 12:00"], web_info=web_info)
+    user_text = messages[-1]["content"]
+    assert estimate_text_tokens(user_text) <= 4000
+    assert info["truncated"] == ["user"]
+    assert info["dropped_messages"] == 0
+    assert web_info in [m["content"] for m in messages]
+    assert info["estimated_tokens"] <= 8000
+
+
+def test_short_message_is_not_truncated():
+    builder = PromptBuilder({}, default_budget=8000)
+    messages, info = builder.build("grok", [], "你好")
+    assert messages == [{"role": "system", "content": STABLE_SYSTEM_PROMPT}, {"role": "user", "content": "你好"}]
+    assert info["truncated"] == []
+
+
+def test_history_is_dropped_oldest_first_in_whole_turns():
+    history = _turns(10, text="內容" * 40)
+    per_turn = sum(m["tokens"] for m in history[:2])
+    builder = PromptBuilder({}, default_budget=per_turn * 3 + 100, summary_chars=0)
+    messages, info = builder.build("grok", history, "現在的問題")
+    kept = [m for m in messages if m["role"] in ("user", "assistant")][:-1]
+    assert info["dropped_messages"] % 2 == 0 and info["dropped_messages"] > 0
+    assert kept == [{"role": m["role"], "content": m["content"]} for m in history[info["dropped_messages"]:]]
+    assert kept[0]["role"] == "user"
+    assert info["estimated_tokens"] <= builder.default_budget
+
+
+def test_dropped_summary_does_not_change_cached_prefix():
+    """摘要放在保留的歷史之後：系統提示與最舊的保留訊息維持在最前面"""
+    history = _turns(10, text="內容" * 150)
+    per_turn = sum(m["tokens"] for m in history[:2])
+    builder = PromptBuilder({}, default_budget=per_turn * 3 + 400, summary_chars=300)
+    messages, info = builder.build("grok", history, "現在的問題", context_notes=["目前時間"])
+    assert info["dropped_messages"] > 0
+    assert messages[0] == {"role": "system", "content": STABLE_SYSTEM_PROMPT}
+    assert messages[1]["content"] == history[info["dropped_messages"]]["content"]
+    summary_index = next(i for i, m in enumerate(messages) if m["content"].startswith(DROPPED_SUMMARY_PREFIX))
+    last_history_index = max(i for i, m in enumerate(messages[:-1]) if m["role"] in ("user", "assistant"))
+    assert summary_index == last_history_index + 1
+    assert messages[summary_index + 1]["content"] == "目前時間"
+    assert f"問題{info['dropped_messages'] // 2 - 1} " in messages[summary_index]["content"]  # 摘要優先保留最新被捨棄的問題
+
+
+def test_budget_per_model():
+    builder = PromptBuilder({"vision": 100}, default_budget=8000)
+    assert builder.budget_for("vision") == 100
+    assert builder.budget_for("other") == 8000
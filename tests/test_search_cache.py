@@ -0,0 +1,145 @@
+"""SearchCache：相同查詢合併成一次抓取、失敗結果不快取、過期資料先回舊值再背景更新 (更新數有上限)"""
+import time
+import asyncio
+import threading
+
+import pytest
+
+import search_cache
+from search_cache import SearchCache
+
+
+def _wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+@pytest.fixture
+def short_ttl(monkeypatch):
+    """所有查詢 0.05 秒後過期，之後 60 秒內仍可先回舊資料"""
+    monkeypatch.setattr(search_cache, "ttl_for_query", lambda query: 0.05)
+    monkeypatch.setattr(search_cache, "STALE_FACTOR", 1200)
+
+
+def test_concurrent_misses_are_coalesced_into_one_fetch():
+    cache = SearchCache()
+    release = threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        release.wait(5)
+        return "result"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_fetch("  Python  教學 ", fetch))) for _ in range(5)]
+    for t in threads:
+        t.start()
+    assert _wait_for(lambda: cache.stats()["coalesced"] == 4)
+    release.set()
+    for t in threads:
+        t.join(5)
+    assert results == ["result"] * 5
+    assert len(calls) == 1
+    assert cache.get_or_fetch("python 教學", fetch) == "result"  # 正規化後是同一個 key
+    assert cache.stats()["hits"] == 1
+
+
+def test_failed_results_are_not_cached():
+    cache = SearchCache(is_cacheable=lambda value: not value.startswith("error"))
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        return "error: timeout" if len(calls) == 1 else "result"
+
+    assert cache.get_or_fetch("q", fetch) == "error: timeout"
+    assert cache.get_or_fetch("q", fetch) == "result"
+    assert cache.get_or_fetch("q", fetch) == "result"
+    assert len(calls) == 2
+
+
+def test_stale_hit_returns_old_value_and_refreshes_in_background(short_ttl):
+    cache = SearchCache()
+    cache.get_or_fetch("q", lambda: "old")
+    time.sleep(0.1)
+    release = threading.Event()
+    calls = []
+
+    def refresh():
+        calls.append(1)
+        release.wait(5)
+        return "new"
+
+    assert cache.get_or_fetch("q", refresh) == "old"
+    assert cache.get_or_fetch("q", refresh) == "old"  # 更新中不再重複觸發
+    release.set()
+    assert _wait_for(lambda: cache.stats()["entries"] == 1 and cache._lookup("q")[0] == "new")
+    assert len(calls) == 1
+    assert cache.stats()["refreshes"] == 1
+
+
+def test_background_refreshes_are_bounded(short_ttl):
+    cache = SearchCache(refresh_workers=1, max_refreshes=2)
+    for n in range(5):
+        cache.get_or_fetch(f"q{n}", lambda n=n: f"old{n}")
+    time.sleep(0.1)
+    release = threading.Event()
+    started = []
+
+    def refresh():
+        started.append(1)
+        release.wait(5)
+        return "new"
+
+    threads_before = threading.active_count()
+    assert [cache.get_or_fetch(f"q{n}", refresh) for n in range(5)] == [f"old{n}" for n in range(5)]
+    assert cache.stats()["refreshes"] == 2
+    assert threading.active_count() - threads_before <= 1
+    release.set()
+    assert _wait_for(lambda: len(started) == 2 and cache._refreshes == 0)
+
+
+def test_async_misses_are_coalesced():
+    async def main():
+        cache = SearchCache()
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return "result"
+
+        results = await asyncio.gather(*(cache.aget_or_fetch("q", fetch) for _ in range(5)))
+        return results, len(calls), cache.stats()["coalesced"]
+
+    assert asyncio.run(main()) == (["result"] * 5, 1, 4)
+
+
+def test_disk_tier_survives_restart(tmp_path):
+    path = str(tmp_path / "search.db")
+    SearchCache(disk_path=path).get_or_fetch("q", lambda: "result")
+    assert SearchCache(disk_path=path).get_or_fetch("q", lambda: pytest.fail("不應重新抓取")) == "result"
+
+
+def test_disk_tier_opens_lazily_and_purges_expired_rows_on_first_use(tmp_path):
+    """建構時不開啟 SQLite 連線 (gunicorn preload 後 fork 的 worker 不會共用同一條連線)"""
+    path = str(tmp_path / "search.db")
+    old = SearchCache(disk_path=path)
+    old._disk.put("expired", "value", time.time() - 20, time.time() - 10)
+    old._disk.put("q", "result", time.time() + 60, time.time() + 120)
+    cache = SearchCache(disk_path=path)
+    assert cache._disk._connection is None
+    assert cache.get_or_fetch("q", lambda: pytest.fail("不應重新抓取")) == "result"
+    assert cache._disk._connection is not None
+    assert cache._disk.get("expired") is None
+
+
+def test_unwritable_disk_path_falls_back_to_memory(tmp_path):
+    cache = SearchCache(disk_path=str(tmp_path / "missing" / "search.db"))
+    assert cache.get_or_fetch("q", lambda: "result") == "result"
+    assert cache.get_or_fetch("q", lambda: pytest.fail("應由記憶體快取回傳")) == "result"
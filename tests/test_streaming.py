@@ -0,0 +1,83 @@
+"""streaming：在句尾切段、提早推送的次數與時間條件、LINE 單則字數與單次訊息數上限"""
+from types import SimpleNamespace
+
+from streaming import StreamChunker, split_for_line, group_for_push, stream_deltas, LINE_MAX_TEXT_CHARS
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_split_for_line_cuts_at_sentence_end():
+    text = "第一句。" * 3 + "第二段沒有句尾"
+    assert split_for_line(text, max_chars=10) == ["第一句。第一句。", "第一句。", "第二段沒有句尾"]
+    assert split_for_line("  短訊息  ") == ["短訊息"]
+    assert split_for_line("   ") == []
+
+
+def test_split_for_line_does_not_cut_decimals_or_urls():
+    text = "價格是 3.14 元，網址 example.com/a.b 請參考. 下一句"
+    messages = split_for_line(text, max_chars=len(text) - 1)
+    assert messages == ["價格是 3.14 元，網址 example.com/a.b 請參考.", "下一句"]
+
+
+def test_group_for_push():
+    assert group_for_push(list("abcdefg"), per_push=5) == [list("abcde"), list("fg")]
+
+
+def test_chunker_emits_at_last_sentence_boundary_after_min_chars():
+    chunker = StreamChunker(min_chars=10, max_wait=100, clock=FakeClock())
+    assert chunker.add("你好。今天") == []  # 還不到 min_chars
+    assert chunker.add("天氣很好！明天也") == ["你好。今天天氣很好！"]
+    assert chunker.buffer == "明天也"
+
+
+def test_chunker_waits_for_a_boundary():
+    chunker = StreamChunker(min_chars=5, max_wait=100, clock=FakeClock())
+    assert chunker.add("沒有句尾的一長段文字") == []
+    assert chunker.add("。後面") == ["沒有句尾的一長段文字。"]
+
+
+def test_chunker_emits_after_max_wait_with_enough_text():
+    clock = FakeClock()
+    chunker = StreamChunker(min_chars=200, max_wait=3, min_wait_chars=8, clock=clock)
+    assert chunker.add("短。") == []
+    clock.now = 5
+    assert chunker.add("再一句。") == []  # 時間到了但字數不到 min_wait_chars
+    assert chunker.add("第三句。") == ["短。再一句。第三句。"]
+
+
+def test_chunker_limits_early_pushes_and_finish_flushes_rest():
+    chunker = StreamChunker(min_chars=3, max_wait=100, max_early_chunks=2, clock=FakeClock())
+    assert chunker.add("一句話。") == ["一句話。"]
+    assert chunker.add("兩句話。") == ["兩句話。"]
+    assert chunker.add("三句話。") == []  # 已達提早推送次數
+    assert chunker.add("四句話。") == []
+    assert chunker.finish(extra="(已中斷)") == [["三句話。四句話。\n(已中斷)"]]
+    assert chunker.finish() == []
+
+
+def test_chunker_hard_cuts_text_without_boundaries():
+    chunker = StreamChunker(min_chars=10, max_wait=100, clock=FakeClock())
+    chunks = chunker.add("字" * (LINE_MAX_TEXT_CHARS + 10))
+    assert chunks == ["字" * LINE_MAX_TEXT_CHARS]
+    assert chunker.buffer == "字" * 10
+
+
+def test_finish_respects_line_limits():
+    chunker = StreamChunker(max_early_chunks=0)
+    chunker.add(("句" * 999 + "。") * 30)
+    groups = chunker.finish()
+    assert [len(g) for g in groups] == [5, 1]
+    assert all(len(m) <= LINE_MAX_TEXT_CHARS for g in groups for m in g)
+
+
+def test_stream_deltas_skips_empty_chunks():
+    def chunk(content):
+        return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content))])
+    stream = [chunk("你"), SimpleNamespace(choices=[]), chunk(None), chunk("好")]
+    assert list(stream_deltas(stream)) == ["你", "好"]